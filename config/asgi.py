@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Импорт после инициализации Django: модуль использует модели
+from merch_store.streaming import websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """HTTP (включая SSE /api/events) обслуживает Django, WebSocket — merch_store.streaming."""
+    if scope['type'] == 'websocket':
+        await websocket_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -0,0 +1,61 @@
+"""
+Конфигурация gunicorn для продакшена.
+
+Запуск: gunicorn -c config/gunicorn.conf.py
+Количество воркеров и потоков задается переменными окружения.
+
+SERVER_INTERFACE выбирает профиль: wsgi — воркеры gthread для API (сервис app),
+asgi — воркеры uvicorn для потока событий /api/events, SSE и WebSocket
+(отдельный сервис events). Под WSGI поток событий недоступен.
+"""
+import multiprocessing
+import os
+import time
+
+interface = os.getenv('SERVER_INTERFACE') or 'wsgi'
+if interface == 'asgi':
+    wsgi_app = 'config.asgi:application'
+    default_worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'config.wsgi:application'
+    default_worker_class = 'gthread'
+bind = os.getenv('GUNICORN_BIND') or '0.0.0.0:8080'
+workers = int(os.getenv('GUNICORN_WORKERS') or multiprocessing.cpu_count() * 2 + 1)
+threads = int(os.getenv('GUNICORN_THREADS') or 4)
+worker_class = os.getenv('GUNICORN_WORKER_CLASS') or default_worker_class
+timeout = int(os.getenv('GUNICORN_TIMEOUT') or 30)
+# Перезапуск воркеров ограничивает рост памяти при долгой работе
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS') or 10000)
+max_requests_jitter = max_requests // 10
+# Модели, URLconf и сериализаторы импортируются один раз в мастере до fork
+preload_app = True
+accesslog = '-'
+
+_master_started = time.perf_counter()
+
+
+def when_ready(server):
+    from config.warmup import preload, record_startup
+
+    preload_ms = preload()
+    server.log.info('startup stage=master duration_ms=%s preload_ms=%s',
+                    record_startup('master', _master_started), preload_ms)
+
+
+def post_fork(server, worker):
+    worker.started_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    """Вызывается после инициализации приложения и до приема первого запроса."""
+    from config.warmup import record_startup, warm_up
+
+    if interface == 'asgi':
+        # Под ASGI синхронный код запроса выполняется в отдельном потоке на каждый запрос,
+        # соединения с БД не переиспользуются (CONN_MAX_AGE = 0): прогревать нечего
+        warm_up_ms = None
+    else:
+        # У воркера gthread запросы обрабатывают потоки пула tpool: прогреваются они
+        warm_up_ms = warm_up(getattr(worker, 'tpool', None), worker.cfg.threads)
+    worker.log.info('startup stage=worker pid=%s duration_ms=%s warm_up_ms=%s',
+                    worker.pid, record_startup('worker', worker.started_at), warm_up_ms)
@@ -92,6 +92,53 @@ DATABASES = {
     }
 }
 
+# Реплики только для чтения: хосты через запятую, учетные данные как у основной БД.
+# В тестах реплики "зеркалят" основную тестовую БД.
+DATABASE_REPLICAS = []
+for _index, _host in enumerate(filter(None, (os.getenv('DATABASE_REPLICA_HOSTS') or '').split(',')), start=1):
+    _alias = f'replica_{_index}'
+    DATABASES[_alias] = {
+        **DATABASES['default'],
+        'HOST': _host.strip(),
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(_alias)
+
+# Шарды пользователей: хосты через запятую, учетные данные как у основной БД.
+# Основная БД всегда является первым шардом и хранит справочник пользователей.
+# Если дополнительных шардов нет, шардирование выключено.
+DATABASE_SHARDS = ['default']
+for _index, _host in enumerate(filter(None, (os.getenv('DATABASE_SHARD_HOSTS') or '').split(',')), start=1):
+    _alias = f'shard_{_index}'
+    DATABASES[_alias] = {
+        **DATABASES['default'],
+        'HOST': _host.strip(),
+    }
+    DATABASE_SHARDS.append(_alias)
+
+DATABASE_ROUTERS = ['merch_store.routers.ShardRouter', 'merch_store.routers.ReplicaRouter']
+
+# Сколько секунд после записи пользователь читает только с основной БД
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS') or 5)
+
+# Повтор транзакций переводов и покупок при взаимоблокировках, ошибках
+# сериализации и превышении lock_timeout (см. merch_store/retry.py)
+TRANSACTION_RETRY = {
+    'MAX_ATTEMPTS': int(os.getenv('TRANSACTION_RETRY_ATTEMPTS') or 5),
+    'BUDGET': float(os.getenv('TRANSACTION_RETRY_BUDGET') or 1.0),  # секунды на все повторы
+    'BASE_DELAY': 0.01,
+    'MAX_DELAY': 0.2,
+    'LOCK_TIMEOUT_MS': int(os.getenv('DATABASE_LOCK_TIMEOUT_MS') or 2000),
+    'SERIALIZABLE': os.getenv('TRANSACTION_SERIALIZABLE') == '1',
+}
+
+# Процессов для хеширования паролей при импорте сотрудников (0 — по числу CPU)
+PROVISIONING_WORKERS = int(os.getenv('PROVISIONING_WORKERS') or 0)
+
+# Хранение инвентаря (см. merch_store/inventory.py): rows — строки Inventory,
+# dual — строки и компактная карта UserInventory (переходный режим), compact — только карта
+INVENTORY_STORAGE = os.getenv('INVENTORY_STORAGE') or 'rows'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -138,7 +185,7 @@ AUTH_USER_MODEL = 'merch_store.User'
 # Настройки JWT-токенов
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'merch_store.authentication.ShardedJWTAuthentication',
     ],
 }
 
@@ -146,4 +193,54 @@ REST_FRAMEWORK = {
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=15),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
+    'TOKEN_REFRESH_SERIALIZER': 'merch_store.serializers.RevocableTokenRefreshSerializer',
+}
+
+# Отзыв токенов (см. merch_store/revocation.py): фильтр Блума в памяти процесса,
+# синхронизируемый с таблицей отозванных токенов
+TOKEN_REVOCATION = {
+    'SYNC_SECONDS': float(os.getenv('TOKEN_REVOCATION_SYNC_SECONDS') or 1),
+    'REBUILD_SECONDS': float(os.getenv('TOKEN_REVOCATION_REBUILD_SECONDS') or 300),
+    'FILTER_CAPACITY': int(os.getenv('TOKEN_REVOCATION_FILTER_CAPACITY') or 100000),
+    'FILTER_ERROR_RATE': 0.001,
+}
+
+# Кэш хранит, в том числе, "прилипание" пользователей к основной БД и использованные
+# билеты потока событий. При нескольких процессах нужен общий бэкенд (например, Redis),
+# с репликами config.settings_production без него не запускается.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND') or 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': os.getenv('CACHE_LOCATION') or '',
+    }
+}
+
+# Приемники событий outbox, которые доставляет команда dispatch_outbox.
+# Пример: {'BACKEND': 'merch_store.outbox.CallbackSink', 'OPTIONS': {'callback': 'path.to.func'}}
+OUTBOX_SINKS = []
+if os.getenv('OUTBOX_FILE'):
+    OUTBOX_SINKS.append({
+        'BACKEND': 'merch_store.outbox.FileSink',
+        'OPTIONS': {'path': os.getenv('OUTBOX_FILE')},
+    })
+
+# Повтор доставки событий outbox: пауза растет от BASE_DELAY до MAX_DELAY секунд,
+# после MAX_ATTEMPTS неудачных попыток событие помечается отказом
+OUTBOX_RETRY = {
+    'MAX_ATTEMPTS': int(os.getenv('OUTBOX_MAX_ATTEMPTS') or 20),
+    'BASE_DELAY': 1,
+    'MAX_DELAY': 300,
+}
+
+# Push-уведомления об изменении баланса и инвентаря (SSE /api/events и WebSocket /api/events/ws).
+# LocalBackend доставляет события только соединениям того же процесса, PostgresBackend —
+# всем процессам через LISTEN/NOTIFY (по умолчанию в config.settings_production).
+EVENTS_BACKEND = {
+    'BACKEND': os.getenv('EVENTS_BACKEND') or 'merch_store.events.LocalBackend',
+    'OPTIONS': {},
 }
+EVENTS_HEARTBEAT_SECONDS = int(os.getenv('EVENTS_HEARTBEAT_SECONDS') or 15)
+EVENTS_QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE') or 100)
+EVENTS_STREAM_SECONDS = int(os.getenv('EVENTS_STREAM_SECONDS') or 300)
+# Срок действия билета для подключения к потоку событий (POST /api/events/ticket)
+EVENTS_TICKET_SECONDS = int(os.getenv('EVENTS_TICKET_SECONDS') or 30)
@@ -0,0 +1,64 @@
+"""
+Production settings for config project.
+
+Включается через DJANGO_SETTINGS_MODULE=config.settings_production
+и используется вместе с config/gunicorn.conf.py (профиль выбирает SERVER_INTERFACE).
+"""
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+
+from config.settings import *  # noqa: F401,F403
+from config.settings import BASE_DIR, CACHES, DATABASE_REPLICAS, DATABASES
+
+# При DEBUG = True Django хранит каждый SQL-запрос в connection.queries,
+# что под постоянной нагрузкой приводит к утечке памяти.
+DEBUG = False
+
+# Хосты задаются явно: без проверки заголовка Host ссылки, которые строит
+# приложение, можно подменить
+if not os.getenv('DJANGO_ALLOWED_HOSTS'):
+    raise ImproperlyConfigured('Задайте DJANGO_ALLOWED_HOSTS: хосты приложения через запятую.')
+ALLOWED_HOSTS = [host.strip() for host in os.getenv('DJANGO_ALLOWED_HOSTS').split(',') if host.strip()]
+
+SERVER_INTERFACE = os.getenv('SERVER_INTERFACE') or 'wsgi'
+
+# "Прилипание" к основной БД после записи (merch_store/routers.py) хранится в кэше:
+# с кэшем в памяти процесса следующий запрос, попавший в другой воркер, прочитает
+# устаревшую реплику
+if DATABASE_REPLICAS and CACHES['default']['BACKEND'].endswith(('LocMemCache', 'DummyCache')):
+    raise ImproperlyConfigured('С репликами (DATABASE_REPLICA_HOSTS) нужен общий кэш: задайте CACHE_BACKEND '
+                               'и CACHE_LOCATION (например, Redis).')
+
+# Постоянные соединения с БД: воркер не открывает новое соединение на каждый запрос.
+# Под ASGI (сервис потока событий) Django выполняет синхронный код каждого запроса
+# в новом потоке, и постоянные соединения не переиспользуются, а копятся, поэтому
+# там по умолчанию они выключены.
+# За pgbouncer в режиме транзакций серверные курсоры (QuerySet.iterator()) нужно
+# выключить: DATABASE_DISABLE_SERVER_SIDE_CURSORS=1.
+for _database in DATABASES.values():
+    _database['CONN_MAX_AGE'] = int(os.getenv('DATABASE_CONN_MAX_AGE') or (0 if SERVER_INTERFACE == 'asgi' else 60))
+    _database['CONN_HEALTH_CHECKS'] = True
+    _database['DISABLE_SERVER_SIDE_CURSORS'] = os.getenv('DATABASE_DISABLE_SERVER_SIDE_CURSORS') == '1'
+
+# Несколько воркеров: события потока рассылаются всем процессам через PostgreSQL
+EVENTS_BACKEND = {
+    'BACKEND': os.getenv('EVENTS_BACKEND') or 'merch_store.events.PostgresBackend',
+    'OPTIONS': {},
+}
+
+STATIC_ROOT = BASE_DIR / 'static'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'root': {
+        'handlers': ['console'],
+        'level': os.getenv('DJANGO_LOG_LEVEL') or 'INFO',
+    },
+}
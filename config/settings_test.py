@@ -0,0 +1,14 @@
+"""
+Test settings for config project.
+
+Включается через DJANGO_SETTINGS_MODULE=config.settings_test python manage.py test.
+"""
+from config.settings import *  # noqa: F401,F403
+from config.settings import DATABASE_REPLICAS, DATABASES
+
+# Без настоящих реплик добавляется зеркало основной БД с отдельным соединением:
+# на нем тесты проверяют, что чтения действительно уходят на второй алиас.
+# В DATABASE_REPLICAS оно не входит — тесты включают его через override_settings.
+TEST_REPLICA_ALIAS = 'replica_test'
+if not DATABASE_REPLICAS:
+    DATABASES[TEST_REPLICA_ALIAS] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
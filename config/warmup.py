@@ -0,0 +1,79 @@
+"""
+Прогрев приложения перед приемом трафика.
+
+preload() выполняется в мастер-процессе один раз до fork: импортирует
+URLconf, представления и сериализаторы, чтобы воркеры получили их готовыми.
+warm_up() выполняется в каждом воркере: открывает соединения с БД
+и обращается к кэшу, чтобы первый запрос не платил за установку соединений.
+Соединения Django принадлежат потоку, поэтому у воркера gthread прогреваются
+потоки его пула, которые и обрабатывают запросы, а не главный поток.
+"""
+import threading
+import time
+
+from django.core.cache import caches
+from django.db import connections
+from django.urls import get_resolver
+
+# Последние измеренные длительности этапов запуска, в миллисекундах
+STARTUP_METRICS = {}
+
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def preload():
+    """Импортирует URLconf и все, что он тянет за собой. Не обращается к БД."""
+    started = time.perf_counter()
+    get_resolver()._populate()
+    import merch_store.serializers  # noqa: F401
+    STARTUP_METRICS['preload_ms'] = _elapsed_ms(started)
+    return STARTUP_METRICS['preload_ms']
+
+
+# Сколько секунд поток пула ждет, пока запустятся остальные задачи прогрева
+POOL_WARM_UP_TIMEOUT = 30
+
+
+def _open_connections():
+    for alias in connections:
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT 1')
+    for alias in caches:
+        caches[alias].get('warmup')
+
+
+def _open_connections_in_pool(executor, threads):
+    barrier = threading.Barrier(threads)
+
+    def task():
+        # Поток не освобождается, пока не запущены все задачи,
+        # поэтому каждая задача выполняется в своем потоке пула
+        barrier.wait(timeout=POOL_WARM_UP_TIMEOUT)
+        _open_connections()
+
+    for future in [executor.submit(task) for _ in range(threads)]:
+        future.result()
+
+
+def warm_up(executor=None, threads=1):
+    """
+    Открывает соединения со всеми БД и кэшами.
+
+    Если запросы обрабатывают threads потоков пула executor, соединения
+    открываются в каждом из них, иначе — в текущем потоке.
+    """
+    started = time.perf_counter()
+    if executor is None:
+        _open_connections()
+    else:
+        _open_connections_in_pool(executor, threads)
+    STARTUP_METRICS['warm_up_ms'] = _elapsed_ms(started)
+    return STARTUP_METRICS['warm_up_ms']
+
+
+def record_startup(stage, started):
+    """Запоминает длительность этапа запуска и возвращает ее в миллисекундах."""
+    STARTUP_METRICS[f'{stage}_ms'] = _elapsed_ms(started)
+    return STARTUP_METRICS[f'{stage}_ms']
@@ -1,9 +1,134 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
 
-from merch_store.models import User, Merch, Transaction
+from merch_store.models import CoinGrant, ProvisioningJob, RevokedToken, User, Merch, Transaction
 
-# Register your models here.
 
-admin.site.register(User)
-admin.site.register(Merch)
-admin.site.register(Transaction)
+class EstimatedCountPaginator(Paginator):
+    """
+    Пагинатор, который для нефильтрованного списка берет оценку числа строк
+    из статистики PostgreSQL вместо точного COUNT(*) по всей таблице.
+
+    Для отфильтрованных выборок, небольших таблиц и других СУБД
+    выполняется обычный COUNT(*).
+    """
+    # Ниже этого порога точный подсчет дешев и предпочтителен
+    exact_count_threshold = 10000
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        if query.where:
+            return super().count
+        estimate = self._estimate(query.model._meta.db_table, self.object_list.db)
+        if estimate is None or estimate < self.exact_count_threshold:
+            return super().count
+        return estimate
+
+    @staticmethod
+    def _estimate(table, using):
+        connection = connections[using]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+            row = cursor.fetchone()
+        return row[0] if row and row[0] >= 0 else None
+
+
+@admin.register(User)
+class UserAdmin(admin.ModelAdmin):
+    list_display = ('email', 'first_name', 'coins', 'is_staff', 'is_active')
+    list_filter = ('is_staff', 'is_active')
+    # Поиск по префиксу email использует индекс уникальности
+    search_fields = ('email__startswith',)
+    ordering = ('-id',)
+    show_full_result_count = False
+
+
+@admin.register(Merch)
+class MerchAdmin(admin.ModelAdmin):
+    list_display = ('name', 'price', 'is_limited')
+    search_fields = ('name',)
+
+
+@admin.register(Transaction)
+class TransactionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'sender_email', 'recipient_email', 'amount', 'maked_at')
+    list_select_related = ('sender', 'recipient')
+    autocomplete_fields = ('sender', 'recipient')
+    # Поиск переопределен в get_search_results; поля нужны, чтобы показать строку поиска
+    search_fields = ('sender__email', 'recipient__email')
+    search_help_text = 'Точный email отправителя или получателя'
+    # Фильтр по диапазонам дат вместо date_hierarchy: тот строит список лет и месяцев
+    # через DISTINCT по всей таблице
+    list_filter = ('maked_at',)
+    ordering = ('-id',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Email один раз переводится в id пользователя по индексу уникальности,
+        а транзакции фильтруются по индексам sender_id и recipient_id без соединений.
+        """
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        user_id = User.objects.filter(email=search_term).values_list('pk', flat=True).first()
+        if user_id is None:
+            return queryset.none(), False
+        return queryset.filter(Q(sender_id=user_id) | Q(recipient_id=user_id)), False
+
+    @admin.display(description='Отправитель')
+    def sender_email(self, obj):
+        return obj.sender.email
+
+    @admin.display(description='Получатель')
+    def recipient_email(self, obj):
+        return obj.recipient.email
+
+
+@admin.register(CoinGrant)
+class CoinGrantAdmin(admin.ModelAdmin):
+    """Только просмотр: начисления создаются через API или команду grant_coins."""
+    list_display = ('reason', 'amount', 'state', 'granted', 'created_by', 'created_at', 'finished_at')
+    list_filter = ('state',)
+    ordering = ('-created_at',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ProvisioningJob)
+class ProvisioningJobAdmin(admin.ModelAdmin):
+    """Только просмотр: импорт запускается через API или команду provision_users."""
+    list_display = ('id', 'state', 'total', 'created', 'skipped', 'invalid', 'created_by', 'created_at')
+    list_filter = ('state',)
+    ordering = ('-created_at',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(RevokedToken)
+class RevokedTokenAdmin(admin.ModelAdmin):
+    """Только просмотр: токены отзываются через /api/auth/logout и /api/auth/revoke."""
+    list_display = ('key', 'user_id', 'revoked_at', 'expires_at')
+    search_fields = ('key',)
+    ordering = ('-revoked_at',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,30 @@
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from merch_store import revocation, sharding
+
+
+class ShardedJWTAuthentication(JWTAuthentication):
+    """
+    JWT-аутентификация, которая загружает пользователя с его шарда.
+
+    Шард определяется по глобальному id из токена через справочник
+    пользователей (с кэшированием). Без шардирования работает как JWTAuthentication.
+    Отозванные токены отклоняются (см. revocation.py).
+    """
+
+    def get_validated_token(self, raw_token):
+        validated_token = super().get_validated_token(raw_token)
+        if revocation.is_revoked(validated_token):
+            raise InvalidToken('Token has been revoked')
+        return validated_token
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+
+        with sharding.use_shard(sharding.locate_id(user_id)):
+            return super().get_user(validated_token)
@@ -0,0 +1,23 @@
+"""
+Изолированные БД для нагрузочных команд (bench_*).
+
+Команды создают товары и пользователей с большим балансом и покупают от их
+имени. В рабочей БД такие товары могли бы купить настоящие пользователи,
+а события покупок ушли бы в приемники outbox, поэтому команды работают
+с тестовыми копиями всех БД (test_<имя>, как у manage.py test): копии создаются
+с миграциями перед замером и удаляются после него. Пользователю БД нужно
+право CREATEDB.
+"""
+from contextlib import contextmanager
+
+from django.test.utils import setup_databases, teardown_databases
+
+
+@contextmanager
+def isolated_databases(verbosity=0):
+    """Переключает все соединения на новые тестовые БД на время блока."""
+    old_config = setup_databases(verbosity=verbosity, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=verbosity)
@@ -0,0 +1,221 @@
+"""
+Рассылка изменений баланса и инвентаря открытым соединениям пользователя.
+
+Переводы и покупки вызывают notify(): после фиксации транзакции дельта
+(новый баланс, новая транзакция или изменение инвентаря) уходит в брокер,
+а брокер раздает ее подпискам пользователя — SSE- и WebSocket-соединениям
+этого процесса (см. streaming.py).
+
+Транспорт между процессами задает бэкенд (settings.EVENTS_BACKEND). LocalBackend
+доставляет события только внутри процесса: этого достаточно, когда потоковые
+соединения и запросы на запись обслуживает один процесс. PostgresBackend
+рассылает события всем процессам через LISTEN/NOTIFY основной БД. Другие
+бэкенды (например, поверх Redis pub/sub) реализуют тот же интерфейс:
+start(dispatch) и publish(user_id, event), где dispatch вызывается в каждом
+процессе для каждого полученного события; dispatch(None, event) отправляет
+событие всем подпискам процесса.
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+RESYNC = 'resync'
+
+
+class Subscription:
+    """
+    Подписка одного соединения. Создается внутри цикла событий соединения.
+
+    Если клиент не успевает читать и очередь переполнена, накопленные дельты
+    заменяются одним событием resync: клиент должен перечитать /api/info.
+    """
+
+    def __init__(self, broker, user_id, max_size):
+        self.broker = broker
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_size)
+
+    def deliver(self, event):
+        # Выполняется в потоке цикла событий соединения
+        if self.queue.full():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = {'type': RESYNC}
+        self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    """Подписки соединений этого процесса и рассылка событий по ним."""
+
+    def __init__(self, backend, queue_size=100):
+        self.backend = backend
+        self.queue_size = queue_size
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+        backend.start(self.dispatch)
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id, self.queue_size)
+        with self._lock:
+            self._subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def subscribers(self, user_id):
+        with self._lock:
+            return len(self._subscriptions.get(user_id, ()))
+
+    def publish(self, user_id, event):
+        self.backend.publish(user_id, event)
+
+    def dispatch(self, user_id, event):
+        """Передает событие всем подпискам пользователя или, если user_id None, всем (из любого потока)."""
+        with self._lock:
+            if user_id is None:
+                subscriptions = [subscription for group in self._subscriptions.values() for subscription in group]
+            else:
+                subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+            except RuntimeError:
+                # Цикл событий соединения уже закрыт
+                self.unsubscribe(subscription)
+
+
+class LocalBackend:
+    """Доставка событий только внутри текущего процесса."""
+
+    def start(self, dispatch):
+        self.dispatch = dispatch
+
+    def publish(self, user_id, event):
+        self.dispatch(user_id, event)
+
+
+class PostgresBackend:
+    """
+    Доставка событий всем процессам через LISTEN/NOTIFY PostgreSQL.
+
+    publish выполняет pg_notify через соединение Django: notify() вызывает его
+    после фиксации транзакции, поэтому уведомление уходит сразу. Каждый процесс
+    слушает канал в фоновом потоке на отдельном соединении. Уведомления,
+    пришедшие, пока соединение было разорвано, теряются, поэтому после
+    переподключения все подписки процесса получают resync.
+    """
+
+    def __init__(self, channel='merch_store_events', using=DEFAULT_DB_ALIAS, poll_seconds=5, reconnect_seconds=1):
+        self.channel = channel
+        self.using = using
+        self.poll_seconds = poll_seconds
+        self.reconnect_seconds = reconnect_seconds
+
+    def start(self, dispatch):
+        self.dispatch = dispatch
+        threading.Thread(target=self._listen, name='events-listener', daemon=True).start()
+
+    def publish(self, user_id, event):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)',
+                           [self.channel, json.dumps({'user_id': user_id, 'event': event})])
+
+    def receive(self, payload):
+        try:
+            message = json.loads(payload)
+            user_id, event = message['user_id'], message['event']
+        except (ValueError, TypeError, KeyError):
+            logger.warning('Malformed event notification: %.200s', payload)
+            return
+        self.dispatch(user_id, event)
+
+    def _connect(self):
+        import psycopg2
+
+        database = connections[self.using]
+        listener = psycopg2.connect(**database.get_connection_params())
+        listener.autocommit = True
+        with listener.cursor() as cursor:
+            cursor.execute(f'LISTEN {database.ops.quote_name(self.channel)}')
+        return listener
+
+    def _listen(self):
+        connected_before = False
+        while True:
+            try:
+                listener = self._connect()
+            except Exception:
+                logger.exception('Events listener failed to connect')
+                time.sleep(self.reconnect_seconds)
+                continue
+            if connected_before:
+                self.dispatch(None, {'type': RESYNC})
+            connected_before = True
+            try:
+                while True:
+                    if select.select([listener], [], [], self.poll_seconds) == ([], [], []):
+                        continue
+                    listener.poll()
+                    while listener.notifies:
+                        self.receive(listener.notifies.pop(0).payload)
+            except Exception:
+                logger.exception('Events listener lost connection')
+            finally:
+                listener.close()
+            time.sleep(self.reconnect_seconds)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            config = settings.EVENTS_BACKEND
+            backend = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+            _broker = Broker(backend, queue_size=settings.EVENTS_QUEUE_SIZE)
+        return _broker
+
+
+def _publish(user_id, event):
+    try:
+        get_broker().publish(user_id, event)
+    except Exception:
+        # Рассылка не должна влиять на уже зафиксированную операцию
+        logger.exception('Failed to publish %s event for user %s', event.get('type'), user_id)
+
+
+def notify(user, event_type, using=None, **changes):
+    """
+    Отправляет пользователю дельту после фиксации текущей транзакции.
+
+    Дельта содержит новый баланс и переданные изменения, например
+    transaction={...} или inventory={...}. При откате транзакции ничего не отправляется.
+    """
+    event = {'type': event_type, 'balance': user.coins, **changes}
+    transaction.on_commit(lambda: _publish(user.pk, event), using=using)
@@ -0,0 +1,153 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+from itertools import chain, islice
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from merch_store import sharding
+from merch_store.models import Transaction
+
+EXPORT_FIELDS = ('sender', 'recipient', 'amount', 'maked_at')
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_CHUNK_SIZE = 2000
+_EXPORT_VALUES = ('sender__email', 'recipient__email', 'amount', 'maked_at')
+
+
+class ExportError(ValueError):
+    """Некорректные параметры выгрузки"""
+
+
+def _parse_bound(value, name, end_of_day=False):
+    if not value:
+        return None
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ExportError(f"Параметр '{name}' должен быть датой в формате ISO 8601.")
+        if end_of_day:
+            day += timedelta(days=1)
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def parse_period(since=None, until=None):
+    """
+    Разбирает границы периода выгрузки: даты (YYYY-MM-DD) или даты со временем.
+
+    Возвращает полуинтервал [начало, конец). Дата в 'until' включается целиком.
+    """
+    return _parse_bound(since, 'since'), _parse_bound(until, 'until', end_of_day=True)
+
+
+def export_queryset(since=None, until=None, user_email=None, using=None):
+    """
+    Возвращает строки транзакций для выгрузки.
+
+    Email отправителя и получателя берутся через JOIN в одном запросе,
+    поэтому на каждую строку не выполняются дополнительные запросы.
+    """
+    queryset = Transaction.objects.all()
+    if using:
+        queryset = queryset.using(using)
+    if sharding.is_sharded():
+        # Перевод между шардами записан на обоих шардах; выгружается запись шарда
+        # отправителя (на шарде получателя отправитель — теневая копия)
+        queryset = queryset.filter(sender__is_shadow=False)
+    if since:
+        queryset = queryset.filter(maked_at__gte=since)
+    if until:
+        queryset = queryset.filter(maked_at__lt=until)
+    if user_email:
+        queryset = queryset.filter(Q(sender__email=user_email) | Q(recipient__email=user_email))
+    return queryset.order_by('id').values_list(*_EXPORT_VALUES)
+
+
+def export_rows(since=None, until=None, user_email=None, using=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Строки выгрузки со всех шардов: шарды выгружаются по очереди, внутри шарда — по id.
+    using (реплика) учитывается только без шардирования.
+    """
+    if not sharding.is_sharded():
+        return iter_rows(export_queryset(since, until, user_email, using=using), chunk_size)
+    return chain.from_iterable(
+        iter_rows(export_queryset(since, until, user_email, using=alias), chunk_size)
+        for alias in sharding.shard_aliases()
+    )
+
+
+def iter_rows(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Итерирует строки через серверный курсор, не загружая выборку в память целиком.
+
+    Если серверные курсоры выключены (DISABLE_SERVER_SIDE_CURSORS, нужно при pgbouncer
+    в режиме транзакций), драйвер прочитал бы выборку целиком, поэтому строки
+    читаются страницами по id.
+    """
+    if not connections[queryset.db].settings_dict.get('DISABLE_SERVER_SIDE_CURSORS'):
+        return queryset.iterator(chunk_size=chunk_size)
+    return _iter_pages(queryset, chunk_size)
+
+
+def _iter_pages(queryset, chunk_size):
+    last_id = 0
+    while True:
+        page = list(queryset.filter(id__gt=last_id).values_list('id', *_EXPORT_VALUES)[:chunk_size])
+        for row in page:
+            yield row[1:]
+        if len(page) < chunk_size:
+            return
+        last_id = page[-1][0]
+
+
+def iter_ndjson(rows):
+    for sender, recipient, amount, maked_at in rows:
+        yield json.dumps({
+            'sender': sender,
+            'recipient': recipient,
+            'amount': amount,
+            'maked_at': maked_at.isoformat(),
+        }, ensure_ascii=False) + '\n'
+
+
+class _Echo:
+    """Псевдо-буфер: csv.writer пишет строку и сразу ее возвращает"""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for sender, recipient, amount, maked_at in rows:
+        yield writer.writerow((sender, recipient, amount, maked_at.isoformat()))
+
+
+async def aiter_chunks(lines, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Асинхронный итератор выгрузки для ASGI-сервера.
+
+    Синхронный поток Django под ASGI сначала собирает в список целиком.
+    Здесь строки забираются порциями через sync_to_async в потоке запроса
+    (в нем же открыт серверный курсор), и каждая порция сразу отправляется клиенту.
+    """
+    next_chunk = sync_to_async(lambda: list(islice(lines, chunk_size)))
+    while chunk := await next_chunk():
+        yield ''.join(chunk)
+
+
+def iter_export(export_format, rows):
+    """Возвращает генератор строк выгрузки в выбранном формате."""
+    if export_format not in EXPORT_FORMATS:
+        raise ExportError(f"Формат выгрузки должен быть одним из: {', '.join(EXPORT_FORMATS)}.")
+    if export_format == 'csv':
+        return iter_csv(rows)
+    return iter_ndjson(rows)
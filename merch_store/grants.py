@@ -0,0 +1,204 @@
+"""
+Массовые начисления монет (премии, airdrop).
+
+Начисление выполняется пачками по диапазонам id пользователей: на каждую
+пачку — одна короткая транзакция с одним SELECT id, одной массовой вставкой
+CoinGrantCredit и одним UPDATE coins = coins + amount по всей пачке.
+Строки пользователей блокируются только на время своей пачки.
+
+Повторная обработка пачки ничего не начисляет дважды: пользователи, у которых
+уже есть CoinGrantCredit этого начисления, пропускаются, а уникальный индекс
+(grant_id, user) не дает двум процессам начислить одному пользователю.
+Пачка повторяется целиком при взаимоблокировке или таймауте блокировки.
+
+Выполняющее начисление отмечает heartbeat_at при создании и после каждой пачки.
+Если процесс, запустивший начисление (например, поток процесса API), завершился,
+отметка устаревает, и команда resume_grants продолжает начисление с контрольной точки.
+"""
+import time
+from datetime import timedelta
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import F, Q
+from django.utils import timezone
+
+from merch_store import sharding
+from merch_store.exports import ExportError, parse_period
+from merch_store.jobs import run_in_background
+from merch_store.models import CoinGrant, CoinGrantCredit, User
+from merch_store.retry import retry_atomic
+
+DEFAULT_CHUNK_SIZE = 1000
+# Через сколько секунд без новых пачек начисление считается брошенным
+STALE_SECONDS = 300
+FILTER_NAMES = ('email_domain', 'emails', 'joined_after', 'joined_before')
+
+
+class GrantError(ValueError):
+    """Некорректные параметры начисления"""
+
+
+class GrantBusy(Exception):
+    """Начисление уже выполняется другим процессом"""
+
+
+def clean_filters(filters):
+    """Проверяет фильтр получателей и возвращает его без пустых значений."""
+    filters = {name: value for name, value in (filters or {}).items() if value not in (None, '', [])}
+    unknown = set(filters) - set(FILTER_NAMES)
+    if unknown:
+        raise GrantError(f"Неизвестные фильтры: {', '.join(sorted(unknown))}.")
+    emails = filters.get('emails')
+    if emails is not None and not (isinstance(emails, list) and all(isinstance(email, str) for email in emails)):
+        raise GrantError("Фильтр 'emails' должен быть списком строк.")
+    try:
+        parse_period(filters.get('joined_after'), filters.get('joined_before'))
+    except ExportError:
+        raise GrantError("Фильтры 'joined_after' и 'joined_before' должны быть датами в формате ISO 8601.")
+    return filters
+
+
+def recipients(filters, using=DEFAULT_DB_ALIAS):
+    """Активные пользователи шарда using, подходящие под фильтр."""
+    queryset = User.objects.using(using).filter(is_active=True, is_shadow=False)
+    joined_after, joined_before = parse_period(filters.get('joined_after'), filters.get('joined_before'))
+    if joined_after:
+        queryset = queryset.filter(date_joined__gte=joined_after)
+    if joined_before:
+        queryset = queryset.filter(date_joined__lt=joined_before)
+    if filters.get('email_domain'):
+        queryset = queryset.filter(email__iendswith='@' + filters['email_domain'].lstrip('@'))
+    if filters.get('emails'):
+        queryset = queryset.filter(email__in=filters['emails'])
+    return queryset
+
+
+def create_grant(amount, reason, filters=None, created_by=''):
+    if not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+        raise GrantError("Количество монет должно быть положительным целым числом.")
+    if not reason:
+        raise GrantError("Нужно указать основание начисления.")
+    # Отметка при создании: пока создавший процесс запускает начисление, resume_grants его не берет
+    return CoinGrant.objects.using(DEFAULT_DB_ALIAS).create(
+        amount=amount, reason=reason, filters=clean_filters(filters), created_by=created_by,
+        heartbeat_at=timezone.now(),
+    )
+
+
+@retry_atomic(using=lambda grant, after_id, chunk_size=DEFAULT_CHUNK_SIZE, using=DEFAULT_DB_ALIAS: using)
+def grant_chunk(grant, after_id, chunk_size=DEFAULT_CHUNK_SIZE, using=DEFAULT_DB_ALIAS):
+    """
+    Начисляет монеты следующей пачке пользователей с id больше after_id.
+
+    Возвращает (id последнего обработанного пользователя или None, число начислений).
+    """
+    user_ids = list(recipients(grant.filters, using)
+                    .filter(id__gt=after_id)
+                    .exclude(coin_grants__grant_id=grant.pk)
+                    .order_by('id')
+                    .values_list('id', flat=True)[:chunk_size])
+    if not user_ids:
+        return None, 0
+    CoinGrantCredit.objects.using(using).bulk_create(
+        [CoinGrantCredit(grant_id=grant.pk, user_id=user_id, amount=grant.amount) for user_id in user_ids],
+        batch_size=chunk_size,
+    )
+    User.objects.using(using).filter(
+        id__gte=user_ids[0], id__lte=user_ids[-1], id__in=user_ids
+    ).update(coins=F('coins') + grant.amount)
+    return user_ids[-1], len(user_ids)
+
+
+def _claimable(now, stale_seconds=STALE_SECONDS):
+    """Условие на начисления, которые можно взять в работу: не завершенные и без свежей отметки."""
+    return (~Q(state=CoinGrant.COMPLETED)
+            & (Q(heartbeat_at__isnull=True) | Q(heartbeat_at__lt=now - timedelta(seconds=stale_seconds))
+               | Q(state=CoinGrant.FAILED)))
+
+
+def stale(stale_seconds=STALE_SECONDS):
+    """Начисления в состоянии RUNNING, которые никто не продолжает дольше stale_seconds."""
+    return (CoinGrant.objects.using(DEFAULT_DB_ALIAS)
+            .filter(_claimable(timezone.now(), stale_seconds), state=CoinGrant.RUNNING)
+            .order_by('created_at'))
+
+
+def run(grant, chunk_size=DEFAULT_CHUNK_SIZE, progress=None, stale_seconds=STALE_SECONDS, new=False):
+    """
+    Выполняет (или продолжает) начисление по всем шардам.
+
+    После каждой пачки контрольная точка и heartbeat_at сохраняются в CoinGrant,
+    а функция progress (если передана) получает словарь с прогрессом и скоростью.
+    new — начисление только что создано вызывающим (create_grant): оно запускается,
+    если его отметку с тех пор никто не менял. Если начисление выполняет другой
+    процесс, бросается GrantBusy.
+    """
+    grants_of = CoinGrant.objects.using(DEFAULT_DB_ALIAS)
+    now = timezone.now()
+    claimable = _claimable(now, stale_seconds)
+    if new:
+        claimable |= Q(state=CoinGrant.RUNNING, heartbeat_at=grant.heartbeat_at)
+    claimed = grants_of.filter(claimable, pk=grant.pk).update(state=CoinGrant.RUNNING, heartbeat_at=now)
+    if not claimed:
+        raise GrantBusy(f'Начисление {grant.pk} уже выполняется или завершено.')
+    # Продолжаем с сохраненной контрольной точки, а не с той, что была при загрузке объекта
+    grant.refresh_from_db(using=DEFAULT_DB_ALIAS, fields=['checkpoint'])
+    started = time.monotonic()
+    credited_now = 0
+    try:
+        for alias in sharding.shard_aliases():
+            last_id = grant.checkpoint.get(alias, 0)
+            while True:
+                next_id, credited = grant_chunk(grant, last_id, chunk_size, using=alias)
+                if next_id is None:
+                    break
+                last_id = next_id
+                credited_now += credited
+                grant.checkpoint[alias] = last_id
+                grants_of.filter(pk=grant.pk).update(checkpoint=grant.checkpoint, heartbeat_at=timezone.now(),
+                                                     granted=F('granted') + credited)
+                if progress:
+                    elapsed = time.monotonic() - started
+                    progress({
+                        'database': alias,
+                        'last_user_id': last_id,
+                        'granted': credited_now,
+                        'rows_per_sec': credited_now / elapsed if elapsed else 0.0,
+                    })
+    except Exception as error:
+        grants_of.filter(pk=grant.pk).update(state=CoinGrant.FAILED, last_error=repr(error))
+        raise
+
+    # Точное число начислений: счетчик мог отстать, если процесс падал между пачкой и контрольной точкой
+    granted = sum(CoinGrantCredit.objects.using(alias).filter(grant_id=grant.pk).count()
+                  for alias in sharding.shard_aliases())
+    grants_of.filter(pk=grant.pk).update(state=CoinGrant.COMPLETED, granted=granted,
+                                         finished_at=timezone.now(), last_error='')
+    grant.refresh_from_db(using=DEFAULT_DB_ALIAS)
+    return grant
+
+
+def summary(grant):
+    """Состояние начисления для API: прогресс и средняя скорость."""
+    elapsed = ((grant.finished_at or timezone.now()) - grant.created_at).total_seconds()
+    return {
+        "id": str(grant.pk),
+        "reason": grant.reason,
+        "amount": grant.amount,
+        "filters": grant.filters,
+        "state": grant.state,
+        "granted": grant.granted,
+        "rows_per_sec": round(grant.granted / elapsed, 1) if elapsed > 0 else None,
+        "created_at": grant.created_at,
+        "finished_at": grant.finished_at,
+        "last_error": grant.last_error,
+    }
+
+
+def launch(grant, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Запускает начисление в фоновом потоке (для API).
+
+    Если процесс завершится раньше, начисление продолжит команда resume_grants.
+    """
+    return run_in_background(f'coin-grant-{grant.pk}', run, grant, chunk_size, new=True)
@@ -0,0 +1,20 @@
+"""
+Функции процессов пула хеширования паролей.
+
+Модуль не импортирует модели: процесс пула импортирует его до настройки
+Django (метод запуска spawn), а django.setup() выполняется в init_worker.
+"""
+import os
+
+import django
+
+
+def init_worker(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    django.setup()
+
+
+def hash_password(password):
+    from django.contrib.auth.hashers import make_password
+
+    return make_password(password)
@@ -0,0 +1,207 @@
+"""
+Хранение инвентаря пользователей.
+
+Два представления:
+
+  * строки Inventory — по строке на пару (пользователь, товар);
+  * UserInventory — одна строка на пользователя с картой {id товара: количество}
+    (jsonb в PostgreSQL). Покупка увеличивает счетчик одним оператором
+    INSERT ... ON CONFLICT DO UPDATE прямо в карте, а /api/info читает одну
+    строку по первичному ключу вместо соединения строк Inventory с Merch.
+
+Оба представления хранят и сумму, уплаченную за товар по цене на момент
+покупки (Inventory.spent и карта UserInventory.costs): сверка балансов
+и пересчет рейтингов не зависят от последующих изменений цен.
+
+Режим задает settings.INVENTORY_STORAGE:
+
+  * rows — только строки Inventory (по умолчанию);
+  * dual — запись в оба представления, чтение из строк (переходный режим);
+  * compact — только карта UserInventory.
+
+Переход: миграция 0014 заполняет карты из Inventory; после включения dual
+команда backfill_inventory дописывает покупки, сделанные между миграцией
+и перезапуском, после чего можно включать compact.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Sum
+
+from merch_store.models import Inventory, Merch, User, UserInventory
+
+ROWS = 'rows'
+DUAL = 'dual'
+COMPACT = 'compact'
+MODES = (ROWS, DUAL, COMPACT)
+DEFAULT_CHUNK_SIZE = 1000
+
+_UPSERT_SQL = {
+    'postgresql': (
+        'INSERT INTO {table} (user_id, items, costs) VALUES (%(user_id)s, '
+        'jsonb_build_object(%(key)s::text, %(quantity)s::int), jsonb_build_object(%(key)s::text, %(cost)s::bigint)) '
+        'ON CONFLICT (user_id) DO UPDATE SET '
+        'items = {table}.items || jsonb_build_object('
+        '%(key)s::text, COALESCE(({table}.items ->> %(key)s)::int, 0) + %(quantity)s), '
+        'costs = {table}.costs || jsonb_build_object('
+        '%(key)s::text, COALESCE(({table}.costs ->> %(key)s)::bigint, 0) + %(cost)s) '
+        'RETURNING (items ->> %(key)s)::int'
+    ),
+    'sqlite': (
+        'INSERT INTO {table} (user_id, items, costs) VALUES (%(user_id)s, '
+        'json_object(%(key)s, %(quantity)s), json_object(%(key)s, %(cost)s)) '
+        'ON CONFLICT (user_id) DO UPDATE SET '
+        'items = json_set({table}.items, %(path)s, COALESCE(json_extract({table}.items, %(path)s), 0) + %(quantity)s), '
+        'costs = json_set({table}.costs, %(path)s, COALESCE(json_extract({table}.costs, %(path)s), 0) + %(cost)s) '
+        'RETURNING json_extract(items, %(path)s)'
+    ),
+}
+
+
+def storage():
+    if settings.INVENTORY_STORAGE not in MODES:
+        raise ValueError(f"INVENTORY_STORAGE должен быть одним из: {', '.join(MODES)}.")
+    return settings.INVENTORY_STORAGE
+
+
+def reads_compact():
+    return storage() == COMPACT
+
+
+def _increment_compact(user_id, merch_id, quantity, cost, using):
+    """
+    Увеличивает количество товара и сумму, уплаченную за него, в карте
+    пользователя одним оператором. Возвращает новое количество.
+    """
+    connection = connections[using]
+    key = str(merch_id)
+    template = _UPSERT_SQL.get(connection.vendor)
+    if template is None:
+        # Для остальных СУБД — чтение карты под блокировкой и запись целиком
+        with transaction.atomic(using=using):
+            compact, _ = UserInventory.objects.using(using).select_for_update().get_or_create(user_id=user_id)
+            compact.items[key] = compact.items.get(key, 0) + quantity
+            compact.costs[key] = compact.costs.get(key, 0) + cost
+            compact.save(update_fields=['items', 'costs'])
+        return compact.items[key]
+
+    sql = template.format(table=connection.ops.quote_name(UserInventory._meta.db_table))
+    params = {'user_id': user_id, 'key': key, 'quantity': quantity, 'cost': cost}
+    if connection.vendor == 'sqlite':
+        params['path'] = f'$."{key}"'
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()[0]
+
+
+def _add_row(user, merch, quantity, cost, using):
+    item, created = Inventory.objects.using(using).get_or_create(
+        user=user, merch=merch, defaults={'quantity': quantity, 'spent': cost}
+    )
+    if not created:
+        item.quantity += quantity
+        item.spent += cost
+        item.save()
+    return item.quantity
+
+
+def add_item(user, merch, quantity=1, using=None):
+    """
+    Добавляет товар в инвентарь (внутри транзакции покупки) вместе с уплаченной
+    суммой по текущей цене merch. Возвращает новое количество.
+    """
+    using = using or user._state.db or DEFAULT_DB_ALIAS
+    cost = merch.price * quantity
+    mode = storage()
+    result = None
+    if mode in (ROWS, DUAL):
+        result = _add_row(user, merch, quantity, cost, using)
+    if mode in (DUAL, COMPACT):
+        compact_quantity = _increment_compact(user.pk, merch.pk, quantity, cost, using)
+        if result is None:
+            result = compact_quantity
+    return result
+
+
+def items_of(user):
+    """Инвентарь для /api/info: список {"type": название, "quantity": количество}."""
+    if not reads_compact():
+        return [{"type": item.merch.name, "quantity": item.quantity}
+                for item in user.inventory.select_related('merch')]
+    # Как и user.inventory в режиме строк: шард пользователя, а без шардирования — реплика
+    # из read_replica() или основная БД
+    hints = {'instance': user}
+    items = (UserInventory.objects.db_manager(hints=hints).filter(user_id=user.pk)
+             .values_list('items', flat=True).first() or {})
+    names = dict(Merch.objects.db_manager(hints=hints).filter(pk__in=[int(key) for key in items])
+                 .values_list('pk', 'name'))
+    return [{"type": names[merch_id], "quantity": items[str(merch_id)]}
+            for merch_id in sorted(int(key) for key in items) if merch_id in names]
+
+
+def holders(merch, using=DEFAULT_DB_ALIAS):
+    """Сколько пользователей шарда using владеют товаром."""
+    if reads_compact():
+        return UserInventory.objects.using(using).filter(items__has_key=str(merch.pk)).count()
+    return Inventory.objects.using(using).filter(merch_id=merch.pk).count()
+
+
+def spent_by(user_ids, using=DEFAULT_DB_ALIAS):
+    """Сколько монет пользователи заплатили за мерч по ценам покупки: {user_id: монет}."""
+    if not reads_compact():
+        return dict(Inventory.objects.using(using).filter(user_id__in=user_ids)
+                    .values_list('user_id').annotate(total=Sum('spent')).order_by())
+    return {
+        user_id: sum(costs.values())
+        for user_id, costs in UserInventory.objects.using(using).filter(user_id__in=user_ids)
+        .values_list('user_id', 'costs')
+    }
+
+
+def sales_of(merch, using=DEFAULT_DB_ALIAS):
+    """Продажи товара по инвентарю шарда using: (продано штук, выручка по ценам покупки)."""
+    if not reads_compact():
+        totals = Inventory.objects.using(using).filter(merch=merch).aggregate(sold=Sum('quantity'),
+                                                                              revenue=Sum('spent'))
+        return totals['sold'] or 0, totals['revenue'] or 0
+    key = str(merch.pk)
+    sold = revenue = 0
+    for items, costs in (UserInventory.objects.using(using).filter(items__has_key=key)
+                         .values_list('items', 'costs').iterator(chunk_size=5000)):
+        sold += items.get(key, 0)
+        revenue += costs.get(key, 0)
+    return sold, revenue
+
+
+def backfill_users(user_ids, using=DEFAULT_DB_ALIAS):
+    """
+    Пересобирает карты пользователей user_ids из строк Inventory.
+
+    Строки пользователей блокируются (как при покупке), поэтому покупка
+    в режиме dual не может потеряться между чтением строк и записью карты.
+    """
+    with transaction.atomic(using=using):
+        list(User.objects.using(using).select_for_update().filter(pk__in=user_ids).values_list('pk', flat=True))
+        maps = {}
+        for user_id, merch_id, quantity, spent in (Inventory.objects.using(using).filter(user_id__in=user_ids)
+                                                   .values_list('user_id', 'merch_id', 'quantity', 'spent')):
+            items, costs = maps.setdefault(user_id, ({}, {}))
+            items[str(merch_id)] = quantity
+            costs[str(merch_id)] = spent
+        UserInventory.objects.using(using).bulk_create(
+            [UserInventory(user_id=user_id, items=items, costs=costs) for user_id, (items, costs) in maps.items()],
+            update_conflicts=True, unique_fields=['user'], update_fields=['items', 'costs'],
+        )
+        UserInventory.objects.using(using).filter(user_id__in=user_ids).exclude(user_id__in=list(maps)).delete()
+    return len(maps)
+
+
+def backfill(using=DEFAULT_DB_ALIAS, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Пересобирает карты всех пользователей шарда using пачками. Возвращает число карт."""
+    users = User.objects.using(using).filter(is_shadow=False).order_by('pk').values_list('pk', flat=True)
+    last_id, filled = 0, 0
+    while user_ids := list(users.filter(pk__gt=last_id)[:chunk_size]):
+        filled += backfill_users(user_ids, using)
+        last_id = user_ids[-1]
+        if progress:
+            progress({'database': using, 'last_user_id': last_id, 'filled': filled})
+    return filled
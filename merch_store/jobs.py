@@ -0,0 +1,29 @@
+"""
+Фоновое выполнение длительных операций, запущенных сотрудником через API.
+
+Операция выполняется в отдельном потоке процесса, принявшего запрос, и сама
+сохраняет свой прогресс в БД, поэтому ответ API возвращается сразу, а статус
+можно запросить у любого процесса. Тяжелые вычисления внутри операции
+(например, хеширование паролей) выносятся в отдельные процессы.
+"""
+import logging
+import threading
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+def run_in_background(name, target, *args, **kwargs):
+    """Запускает target(*args, **kwargs) в фоновом потоке и возвращает поток."""
+    def run():
+        try:
+            target(*args, **kwargs)
+        except Exception:
+            logger.exception('Background job %s failed', name)
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,23 @@
+from django.core.management import BaseCommand, CommandError
+
+from merch_store import inventory, sharding
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает компактный инвентарь (UserInventory) из строк Inventory на всех шардах'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=inventory.DEFAULT_CHUNK_SIZE)
+
+    def _progress(self, report):
+        self.stdout.write(f"{report['database']}: last_user_id={report['last_user_id']} filled={report['filled']}")
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] <= 0:
+            raise CommandError('Размер пачки должен быть положительным.')
+        if inventory.reads_compact():
+            # В режиме compact строки Inventory не пополняются: пересборка потеряла бы покупки
+            raise CommandError("Пересборка возможна только при INVENTORY_STORAGE = 'rows' или 'dual'.")
+        for alias in sharding.shard_aliases():
+            filled = inventory.backfill(using=alias, chunk_size=options['chunk_size'], progress=self._progress)
+            self.stdout.write(self.style.SUCCESS(f'{alias}: {filled} inventories rebuilt'))
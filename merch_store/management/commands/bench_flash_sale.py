@@ -0,0 +1,72 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management import BaseCommand
+from django.db import DatabaseError, connections
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from merch_store import inventory, sharding, stock
+from merch_store.benchmarks import isolated_databases
+from merch_store.models import Merch, User
+from merch_store.views import BuyItemAPIView
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест распродажи: множество пользователей одновременно '
+        'покупают один товар ограниченного тиража. Запускать на PostgreSQL. '
+        'Выполняется на отдельных тестовых БД (см. merch_store/benchmarks.py).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=2000)
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--stock', type=int, default=100)
+        parser.add_argument('--buckets', type=int, nargs='+', default=[1, stock.DEFAULT_BUCKETS],
+                            help='Число частей остатка; можно перечислить несколько для сравнения')
+
+    def handle(self, *args, **options):
+        with isolated_databases():
+            for run, buckets in enumerate(options['buckets']):
+                self._run(run, options['buyers'], options['threads'], options['stock'], buckets)
+
+    def _run(self, run, buyers, threads, quantity, buckets):
+        merch = Merch.objects.create(name=f'flash-{run}', price=1)
+        sharding.sync_catalog()
+        stock.add_stock(merch, quantity, buckets=buckets)
+        users = []
+        for index in range(buyers):
+            user = User(email=f'flash-{run}-{index}@bench.local')
+            user.set_unusable_password()
+            user.save(using=sharding.shard_for_email(user.email))
+            users.append(user)
+
+        view = BuyItemAPIView.as_view()
+        factory = APIRequestFactory()
+
+        def buy(user):
+            request = factory.get(f'/api/buy/{merch.name}')
+            force_authenticate(request, user=user)
+            try:
+                return view(request, item_name=merch.name).status_code
+            except DatabaseError:
+                return None
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            statuses = list(pool.map(buy, users))
+        elapsed = time.perf_counter() - started
+
+        sold = sum(inventory.holders(merch, using=alias) for alias in sharding.shard_aliases())
+        remaining = stock.remaining_stock(merch)
+        self.stdout.write(
+            f'buckets={buckets} buyers={buyers} threads={threads} '
+            f'requests_per_sec={buyers / elapsed:.0f} elapsed_s={elapsed:.2f} '
+            f'sold={sold} sold_out={statuses.count(409)} '
+            f'errors={len(statuses) - statuses.count(200) - statuses.count(409)} '
+            f'remaining={remaining}'
+        )
+        if sold > quantity or sold + remaining != quantity:
+            self.stderr.write(self.style.ERROR(f'Oversell detected: sold {sold} of {quantity}'))
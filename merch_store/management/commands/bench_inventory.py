@@ -0,0 +1,142 @@
+import random
+import statistics
+import time
+from contextlib import ExitStack
+
+from django.core.management import BaseCommand
+from django.db import connections
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from merch_store import inventory, sharding
+from merch_store.benchmarks import isolated_databases
+from merch_store.models import Inventory, Merch, User, UserInventory
+from merch_store.views import BuyItemAPIView, InfoAPIView
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает хранение инвентаря строками Inventory и компактной картой UserInventory: '
+        'объем данных и задержку /api/info и покупки. Выполняется на отдельных тестовых БД '
+        '(см. merch_store/benchmarks.py), пользователи размещаются по всем шардам. '
+        'Объем считается только в PostgreSQL.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--catalog', type=int, default=10, help='Товаров в каталоге')
+        parser.add_argument('--requests', type=int, default=300, help='Запросов на каждый замер')
+
+    def handle(self, *args, **options):
+        with isolated_databases():
+            self._bench(options)
+
+    def _bench(self, options):
+        catalog = Merch.objects.bulk_create(
+            [Merch(name=f'inv-{index}', price=1) for index in range(options['catalog'])]
+        )
+        sharding.sync_catalog()
+        users = self._create_users(options['users'])
+        self._fill(users, catalog)
+        self._report_storage(users)
+        sample = random.choices(users, k=options['requests'])
+        for mode in inventory.MODES:
+            with override_settings(INVENTORY_STORAGE=mode):
+                self._report_latency(mode, sample, catalog)
+
+    def _create_users(self, count):
+        """Пользователи на шардах по email, как при регистрации."""
+        users = []
+        for index in range(count):
+            user = User(email=f'inv-{index}@bench.local', coins=10 ** 9)
+            user.set_unusable_password()
+            user.save(using=sharding.shard_for_email(user.email))
+            users.append(user)
+        return users
+
+    def _by_shard(self, users):
+        by_shard = {}
+        for user in users:
+            by_shard.setdefault(user._state.db, []).append(user)
+        return by_shard
+
+    def _fill(self, users, catalog):
+        """Одинаковый инвентарь в обоих представлениях: у каждого пользователя часть каталога."""
+        total = 0
+        for alias, shard_users in self._by_shard(users).items():
+            rows = [
+                Inventory(user=user, merch_id=merch.pk, quantity=quantity, spent=quantity * merch.price)
+                for user in shard_users
+                for merch in random.sample(catalog, random.randint(1, len(catalog)))
+                for quantity in [random.randint(1, 5)]
+            ]
+            Inventory.objects.using(alias).bulk_create(rows, batch_size=5000)
+            user_ids = [user.pk for user in shard_users]
+            for start in range(0, len(user_ids), inventory.DEFAULT_CHUNK_SIZE):
+                inventory.backfill_users(user_ids[start:start + inventory.DEFAULT_CHUNK_SIZE], using=alias)
+            total += len(rows)
+        self.stdout.write(f'users={len(users)} catalog={len(catalog)} inventory_rows={total} '
+                          f'shards={len(sharding.shard_aliases())}')
+
+    def _report_storage(self, users):
+        by_shard = self._by_shard(users)
+        if any(connections[alias].vendor != 'postgresql' for alias in by_shard):
+            self.stdout.write('storage: skipped (PostgreSQL only)')
+            return
+        for model in (Inventory, UserInventory):
+            rows = row_bytes = total_bytes = 0
+            for alias, shard_users in by_shard.items():
+                connection = connections[alias]
+                table = connection.ops.quote_name(model._meta.db_table)
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f'SELECT COUNT(*), COALESCE(SUM(pg_column_size(t.*)), 0) FROM {table} t '
+                        f'WHERE t.user_id = ANY(%s)', [[user.pk for user in shard_users]],
+                    )
+                    shard_rows, shard_bytes = cursor.fetchone()
+                    cursor.execute('SELECT pg_total_relation_size(%s)', [model._meta.db_table])
+                    total_bytes += cursor.fetchone()[0]
+                rows += shard_rows
+                row_bytes += shard_bytes
+            self.stdout.write(
+                f'storage layout={model._meta.model_name} rows={rows} '
+                f'row_bytes_per_user={row_bytes / len(users):.0f} table_with_indexes_bytes={total_bytes}'
+            )
+
+    def _timed(self, view, requests):
+        timings = []
+        for request, kwargs in requests:
+            started = time.perf_counter()
+            response = view(request, **kwargs)
+            timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f'Unexpected status {response.status_code}: {response.data}')
+        timings.sort()
+        return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+    def _report_latency(self, mode, sample, catalog):
+        factory = APIRequestFactory()
+
+        def request_for(user, path):
+            request = factory.get(path)
+            force_authenticate(request, user=user)
+            return request
+
+        info_view, buy_view = InfoAPIView.as_view(), BuyItemAPIView.as_view()
+        info_requests = [(request_for(user, '/api/info'), {}) for user in sample]
+        purchases = [(user, random.choice(catalog)) for user in sample]
+        buy_requests = [(request_for(user, f'/api/buy/{merch.name}'), {'item_name': merch.name})
+                        for user, merch in purchases]
+
+        # Запросы /api/info считаются на всех БД: без шардирования это одна основная БД
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(connections[alias]))
+                        for alias in sharding.shard_aliases()]
+            info_view(request_for(sample[0], '/api/info'))
+        info_queries = sum(len(queries) for queries in captured)
+        info_p50, info_p95 = self._timed(info_view, info_requests)
+        buy_p50, buy_p95 = self._timed(buy_view, buy_requests)
+        self.stdout.write(
+            f'mode={mode} info_p50_ms={info_p50:.2f} info_p95_ms={info_p95:.2f} '
+            f'info_queries={info_queries} buy_p50_ms={buy_p50:.2f} buy_p95_ms={buy_p95:.2f}'
+        )
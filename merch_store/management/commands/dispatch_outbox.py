@@ -0,0 +1,52 @@
+import time
+from datetime import timedelta
+
+from django.core.management import BaseCommand, CommandError
+from django.utils import timezone
+
+from merch_store import outbox, sharding
+
+
+class Command(BaseCommand):
+    help = 'Доставляет события из outbox во внешние приемники'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--follow', action='store_true',
+                            help='Не завершаться, а ждать новые события')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Пауза между опросами в режиме --follow, секунды')
+        parser.add_argument('--purge-days', type=int,
+                            help='Удалить доставленные события старше N дней')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Вернуть в очередь события, исчерпавшие попытки доставки')
+
+    def handle(self, *args, **options):
+        sinks = outbox.get_sinks()
+        if not sinks:
+            raise CommandError('Не настроен ни один приемник в settings.OUTBOX_SINKS.')
+
+        if options['retry_failed']:
+            requeued = sum(outbox.retry_failed(using=alias) for alias in sharding.shard_aliases())
+            self.stdout.write(f'Requeued {requeued} failed events')
+
+        total = 0
+        while True:
+            # Шарды опрашиваются по очереди; пауза — только когда пусто на всех
+            delivered = sum(
+                outbox.dispatch_batch(sinks, batch_size=options['batch_size'], using=alias)
+                for alias in sharding.shard_aliases()
+            )
+            total += delivered
+            if delivered:
+                continue
+            if not options['follow']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(f'Dispatched {total} events')
+
+        if options['purge_days'] is not None:
+            older_than = timezone.now() - timedelta(days=options['purge_days'])
+            purged = sum(outbox.purge_dispatched(older_than, using=alias) for alias in sharding.shard_aliases())
+            self.stdout.write(f'Purged {purged} events')
@@ -0,0 +1,35 @@
+from django.core.management import BaseCommand, CommandError
+
+from merch_store.exports import (
+    EXPORT_CHUNK_SIZE, EXPORT_FORMATS, ExportError, export_rows, iter_export, parse_period,
+)
+
+
+class Command(BaseCommand):
+    help = 'Потоковая выгрузка истории транзакций в NDJSON или CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', dest='export_format', choices=EXPORT_FORMATS, default='ndjson')
+        parser.add_argument('--since', help='Начало периода (YYYY-MM-DD или ISO 8601)')
+        parser.add_argument('--until', help='Конец периода включительно (YYYY-MM-DD или ISO 8601)')
+        parser.add_argument('--user', help='Email отправителя или получателя')
+        parser.add_argument('--output', help='Файл для записи (по умолчанию stdout)')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+        parser.add_argument('--database', default=None,
+                            help='Алиас БД (например, реплика); при шардировании выгружаются все шарды')
+
+    def handle(self, *args, **options):
+        try:
+            since, until = parse_period(options['since'], options['until'])
+            rows = export_rows(since=since, until=until, user_email=options['user'],
+                               using=options['database'], chunk_size=options['chunk_size'])
+            stream = iter_export(options['export_format'], rows)
+        except ExportError as error:
+            raise CommandError(error)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(stream)
+        else:
+            for line in stream:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,55 @@
+from django.core.management import BaseCommand, CommandError
+
+from merch_store import grants
+from merch_store.models import CoinGrant
+
+
+class Command(BaseCommand):
+    help = 'Массово начисляет монеты всем пользователям или выбранным по фильтру'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--amount', type=int, help='Монет на пользователя')
+        parser.add_argument('--reason', help='Основание начисления')
+        parser.add_argument('--email-domain', help='Только пользователи с email в этом домене')
+        parser.add_argument('--joined-after', help='Зарегистрированные начиная с даты (YYYY-MM-DD)')
+        parser.add_argument('--joined-before', help='Зарегистрированные до даты включительно (YYYY-MM-DD)')
+        parser.add_argument('--resume', metavar='GRANT_ID', help='Продолжить прерванное начисление')
+        parser.add_argument('--chunk-size', type=int, default=grants.DEFAULT_CHUNK_SIZE)
+
+    def _progress(self, report):
+        self.stdout.write(
+            f"{report['database']}: last_user_id={report['last_user_id']} "
+            f"granted={report['granted']} rows_per_sec={report['rows_per_sec']:.0f}"
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] <= 0:
+            raise CommandError('Размер пачки должен быть положительным.')
+        if options['resume']:
+            try:
+                grant = CoinGrant.objects.using('default').get(pk=options['resume'])
+            except (CoinGrant.DoesNotExist, ValueError):
+                raise CommandError(f"Начисление {options['resume']} не найдено.")
+            if grant.state == CoinGrant.COMPLETED:
+                raise CommandError(f'Начисление {grant.pk} уже завершено.')
+        else:
+            try:
+                grant = grants.create_grant(options['amount'], options['reason'], filters={
+                    'email_domain': options['email_domain'],
+                    'joined_after': options['joined_after'],
+                    'joined_before': options['joined_before'],
+                })
+            except grants.GrantError as error:
+                raise CommandError(error)
+            self.stdout.write(f'Grant {grant.pk} started')
+
+        try:
+            grant = grants.run(grant, chunk_size=options['chunk_size'], progress=self._progress,
+                               new=not options['resume'])
+        except grants.GrantBusy as error:
+            raise CommandError(error)
+        summary = grants.summary(grant)
+        self.stdout.write(self.style.SUCCESS(
+            f"Grant {grant.pk} completed: {grant.granted} users, "
+            f"{grant.amount} coins each, {summary['rows_per_sec']} rows/sec"
+        ))
@@ -0,0 +1,61 @@
+from django.core.exceptions import ValidationError
+from django.core.management import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from merch_store import provisioning
+from merch_store.models import ProvisioningJob
+
+
+class Command(BaseCommand):
+    help = 'Создает сотрудников из CSV или JSON (email, password, first_name)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл .csv или .json')
+        parser.add_argument('--format', dest='file_format', choices=provisioning.FORMATS,
+                            help='Формат файла (по умолчанию — по расширению)')
+        parser.add_argument('--workers', type=int,
+                            help='Процессов для хеширования паролей (по умолчанию по числу CPU)')
+        parser.add_argument('--chunk-size', type=int, default=provisioning.DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--resume', metavar='JOB_ID',
+                            help='Продолжить прерванный импорт из того же файла')
+        parser.add_argument('--stale-after', type=int, default=provisioning.STALE_SECONDS,
+                            help='С --resume: считать прерванным импорт без новых пачек дольше N секунд')
+
+    def _progress(self, report):
+        self.stdout.write(
+            f"processed={report['processed']} created={report['created']} "
+            f"skipped={report['skipped']} rows_per_sec={report['rows_per_sec']:.0f}"
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] <= 0:
+            raise CommandError('Размер пачки должен быть положительным.')
+        try:
+            file_format = options['file_format'] or provisioning.format_of(options['path'])
+            with open(options['path'], encoding='utf-8-sig') as source:
+                rows = provisioning.parse(source.read(), file_format)
+        except OSError as error:
+            raise CommandError(error)
+        except provisioning.ProvisioningError as error:
+            raise CommandError(error)
+
+        if options['resume']:
+            try:
+                job = ProvisioningJob.objects.using(DEFAULT_DB_ALIAS).get(pk=options['resume'])
+            except (ProvisioningJob.DoesNotExist, ValidationError):
+                raise CommandError(f"Импорт {options['resume']} не найден.")
+        else:
+            job = provisioning.create_job(rows)
+        try:
+            job = provisioning.run(job, rows, workers=options['workers'], chunk_size=options['chunk_size'],
+                                   progress=self._progress, resume=bool(options['resume']),
+                                   stale_seconds=options['stale_after'])
+        except (provisioning.ProvisioningError, provisioning.ProvisioningBusy) as error:
+            raise CommandError(error)
+        for error in job.errors:
+            self.stderr.write(f"row {error['row']}: {error['error']}")
+        summary = provisioning.summary(job)
+        self.stdout.write(self.style.SUCCESS(
+            f'Import {job.pk} completed: created {job.created}, skipped {job.skipped}, '
+            f"invalid {job.invalid}, {summary['rows_per_sec']} rows/sec"
+        ))
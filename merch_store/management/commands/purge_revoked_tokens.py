@@ -0,0 +1,10 @@
+from django.core.management import BaseCommand
+
+from merch_store import revocation
+
+
+class Command(BaseCommand):
+    help = 'Удаляет записи об отзыве токенов, срок действия которых истек'
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Удалено записей: {revocation.purge_expired()}")
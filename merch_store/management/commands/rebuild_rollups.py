@@ -0,0 +1,14 @@
+from django.core.management import BaseCommand
+
+from merch_store import rollups, sharding
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает рейтинги и статистику продаж из Transaction и инвентаря'
+
+    def handle(self, *args, **options):
+        for alias in sharding.shard_aliases():
+            counts = rollups.rebuild(using=alias)
+            for name, count in counts.items():
+                self.stdout.write(f'{alias} {name}: {count}' if sharding.is_sharded() else f'{name}: {count}')
+        self.stdout.write(self.style.SUCCESS('Rollups rebuilt successfully'))
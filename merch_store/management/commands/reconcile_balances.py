@@ -0,0 +1,78 @@
+import json
+import os
+import time
+
+from django.core.management import BaseCommand, CommandError
+
+from merch_store import reconciliation
+
+
+class Command(BaseCommand):
+    help = 'Сверяет балансы пользователей с историей переводов и покупок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--repair', action='store_true',
+                            help='Исправлять найденные расхождения')
+        parser.add_argument('--checkpoint', help='Файл для сохранения прогресса')
+        parser.add_argument('--resume', action='store_true',
+                            help='Продолжить с сохраненной контрольной точки')
+        parser.add_argument('--database', default='default',
+                            help='Алиас БД (шарда) для проверки')
+
+    def _load_checkpoint(self, path):
+        try:
+            with open(path, encoding='utf-8') as checkpoint:
+                return json.load(checkpoint)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            raise CommandError(f'Поврежден файл контрольной точки: {path}')
+
+    def _save_checkpoint(self, path, state):
+        # Запись через временный файл, чтобы прерванная запись не испортила точку
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as checkpoint:
+            json.dump(state, checkpoint)
+        os.replace(temporary, path)
+
+    def handle(self, *args, **options):
+        checkpoint_path = options['checkpoint']
+        if options['resume'] and not checkpoint_path:
+            raise CommandError('Для --resume нужно указать --checkpoint.')
+
+        state = {'last_user_id': 0, 'checked': 0, 'mismatched': 0, 'repaired': 0}
+        if options['resume']:
+            state.update(self._load_checkpoint(checkpoint_path))
+
+        started = time.monotonic()
+        while True:
+            last_id, checked, discrepancies = reconciliation.check_chunk(
+                state['last_user_id'], options['chunk_size'], using=options['database']
+            )
+            if last_id is None:
+                break
+
+            for discrepancy in discrepancies:
+                action = ''
+                if options['repair']:
+                    repaired = reconciliation.repair(discrepancy, using=options['database'])
+                    state['repaired'] += repaired
+                    action = ' repaired' if repaired else ' skipped (changed concurrently)'
+                self.stdout.write(
+                    f'user={discrepancy.user_id} email={discrepancy.email} '
+                    f'actual={discrepancy.actual} expected={discrepancy.expected} '
+                    f'diff={discrepancy.difference:+d}{action}'
+                )
+
+            state['last_user_id'] = last_id
+            state['checked'] += checked
+            state['mismatched'] += len(discrepancies)
+            if checkpoint_path:
+                self._save_checkpoint(checkpoint_path, state)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f"Checked {state['checked']} users, mismatched {state['mismatched']}, "
+            f"repaired {state['repaired']} in {elapsed:.1f}s"
+        )
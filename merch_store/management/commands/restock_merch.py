@@ -0,0 +1,25 @@
+from django.core.management import BaseCommand, CommandError
+
+from merch_store import stock
+from merch_store.models import Merch
+
+
+class Command(BaseCommand):
+    help = 'Добавляет остаток товару ограниченного тиража'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help='Название товара')
+        parser.add_argument('quantity', type=int)
+        parser.add_argument('--buckets', type=int, default=stock.DEFAULT_BUCKETS,
+                            help='На сколько частей разбить остаток')
+
+    def handle(self, *args, **options):
+        if options['quantity'] <= 0 or options['buckets'] <= 0:
+            raise CommandError('Количество и число частей должны быть положительными.')
+        try:
+            merch = Merch.objects.get(name=options['name'])
+        except Merch.DoesNotExist:
+            raise CommandError(f"Товар '{options['name']}' не найден.")
+
+        stock.add_stock(merch, options['quantity'], buckets=options['buckets'])
+        self.stdout.write(f'{merch.name}: remaining {stock.remaining_stock(merch)}')
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management import BaseCommand
+
+from merch_store import grants
+
+
+class Command(BaseCommand):
+    help = 'Продолжает с контрольной точки начисления, брошенные завершившимся процессом'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale-after', type=int, default=grants.STALE_SECONDS,
+                            help='Считать брошенными начисления без новых пачек дольше N секунд')
+        parser.add_argument('--chunk-size', type=int, default=grants.DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--follow', action='store_true',
+                            help='Не завершаться, а периодически искать брошенные начисления')
+        parser.add_argument('--interval', type=float, default=30.0,
+                            help='Пауза между проверками в режиме --follow, секунды')
+
+    def handle(self, *args, **options):
+        while True:
+            for grant in grants.stale(options['stale_after']):
+                try:
+                    grant = grants.run(grant, chunk_size=options['chunk_size'], stale_seconds=options['stale_after'])
+                except grants.GrantBusy:
+                    # Начисление успел взять другой процесс
+                    continue
+                except Exception as error:
+                    self.stderr.write(f'Grant {grant.pk} failed: {error!r}')
+                    continue
+                self.stdout.write(f'Grant {grant.pk} resumed and completed: {grant.granted} users')
+            if not options['follow']:
+                break
+            time.sleep(options['interval'])
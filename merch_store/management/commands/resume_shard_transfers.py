@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from merch_store import sharding, transfers
+
+
+class Command(BaseCommand):
+    help = 'Завершает переводы между шардами, прерванные после списания у отправителя'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=60,
+                            help='Обрабатывать переводы старше N секунд')
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - timedelta(seconds=options['older_than'])
+        for alias in sharding.shard_aliases():
+            stats = transfers.resume_pending(older_than, using=alias)
+            self.stdout.write(
+                f"{alias}: completed {stats['completed']}, refunded {stats['refunded']}, "
+                f"failed {stats['failed']}"
+            )
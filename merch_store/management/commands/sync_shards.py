@@ -0,0 +1,14 @@
+from django.core.management import BaseCommand
+
+from merch_store import sharding
+
+
+class Command(BaseCommand):
+    help = 'Заполняет справочник пользователей и копирует каталог товаров на все шарды'
+
+    def handle(self, *args, **options):
+        for alias in sharding.shard_aliases():
+            added = sharding.sync_directory(using=alias)
+            self.stdout.write(f'{alias}: {added} users added to directory')
+        for alias, copied in sharding.sync_catalog().items():
+            self.stdout.write(f'{alias}: {copied} merch items synced')
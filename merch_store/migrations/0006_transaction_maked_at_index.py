@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-19 09:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0005_transaction'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transaction',
+            name='maked_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Дата транзакции'),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 4.2 on 2026-10-19 09:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0006_transaction_maked_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MerchSales',
+            fields=[
+                ('merch', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='sales', serialize=False, to='merch_store.merch')),
+                ('sold', models.PositiveBigIntegerField(default=0, verbose_name='Продано штук')),
+                ('revenue', models.PositiveBigIntegerField(default=0, verbose_name='Выручка')),
+            ],
+            options={
+                'verbose_name': 'Продажи товара',
+                'verbose_name_plural': 'Продажи товаров',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserMonthlyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(verbose_name='Месяц')),
+                ('received', models.PositiveBigIntegerField(default=0, verbose_name='Получено монет')),
+                ('sent', models.PositiveBigIntegerField(default=0, verbose_name='Отправлено монет')),
+            ],
+            options={
+                'verbose_name': 'Статистика пользователя за месяц',
+                'verbose_name_plural': 'Статистика пользователей по месяцам',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserSpending',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='spending', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('spent', models.PositiveBigIntegerField(default=0, verbose_name='Потрачено монет')),
+            ],
+            options={
+                'verbose_name': 'Траты пользователя',
+                'verbose_name_plural': 'Траты пользователей',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='userspending',
+            index=models.Index(fields=['-spent'], name='user_spending_top_spent'),
+        ),
+        migrations.AddField(
+            model_name='usermonthlystats',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_stats', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='merchsales',
+            index=models.Index(fields=['-sold'], name='merch_sales_top_sold'),
+        ),
+        migrations.AddIndex(
+            model_name='usermonthlystats',
+            index=models.Index(fields=['month', '-received'], name='monthly_stats_top_received'),
+        ),
+        migrations.AddConstraint(
+            model_name='usermonthlystats',
+            constraint=models.UniqueConstraint(fields=('user', 'month'), name='unique_user_month_stats'),
+        ),
+    ]
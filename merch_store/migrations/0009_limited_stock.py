@@ -0,0 +1,36 @@
+# Generated by Django 4.2 on 2026-10-19 10:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0008_outboxevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='merch',
+            name='is_limited',
+            field=models.BooleanField(default=False, verbose_name='Ограниченный тираж'),
+        ),
+        migrations.CreateModel(
+            name='MerchStockBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.PositiveSmallIntegerField(verbose_name='Номер части')),
+                ('remaining', models.PositiveIntegerField(default=0, verbose_name='Остаток')),
+                ('merch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_buckets', to='merch_store.merch')),
+            ],
+            options={
+                'verbose_name': 'Остаток товара',
+                'verbose_name_plural': 'Остатки товаров',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='merchstockbucket',
+            constraint=models.UniqueConstraint(fields=('merch', 'slot'), name='unique_merch_stock_slot'),
+        ),
+    ]
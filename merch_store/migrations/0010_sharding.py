@@ -0,0 +1,88 @@
+# Generated by Django 4.2 on 2026-10-19 10:08
+
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, migrations, models
+import uuid
+
+
+def backfill_directory(apps, schema_editor):
+    """Заносит существующих пользователей основной БД в справочник с теми же id."""
+    if schema_editor.connection.alias != DEFAULT_DB_ALIAS:
+        return
+    User = apps.get_model('merch_store', 'User')
+    UserDirectory = apps.get_model('merch_store', 'UserDirectory')
+    users = User.objects.using(DEFAULT_DB_ALIAS).order_by('id').values_list('id', 'email')
+    batch = []
+    for user_id, email in users.iterator(chunk_size=5000):
+        batch.append(UserDirectory(id=user_id, email=email, shard=DEFAULT_DB_ALIAS))
+        if len(batch) == 5000:
+            UserDirectory.objects.using(DEFAULT_DB_ALIAS).bulk_create(batch)
+            batch = []
+    UserDirectory.objects.using(DEFAULT_DB_ALIAS).bulk_create(batch)
+    # Следующие id справочника должны быть больше уже выданных
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        for statement in connection.ops.sequence_reset_sql(no_style(), [UserDirectory]):
+            cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0009_limited_stock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardTransfer',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('sender_id', models.BigIntegerField(verbose_name='Отправитель')),
+                ('recipient_id', models.BigIntegerField(verbose_name='Получатель')),
+                ('recipient_shard', models.CharField(max_length=50, verbose_name='Шард получателя')),
+                ('amount', models.PositiveIntegerField(verbose_name='Количество монет')),
+                ('transaction_id', models.BigIntegerField(null=True, verbose_name='Транзакция отправителя')),
+                ('state', models.CharField(choices=[('debited', 'Списано у отправителя'), ('completed', 'Зачислено получателю'), ('refunded', 'Возвращено отправителю')], default='debited', max_length=10, verbose_name='Состояние')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата изменения')),
+            ],
+            options={
+                'verbose_name': 'Перевод между шардами',
+                'verbose_name_plural': 'Переводы между шардами',
+            },
+        ),
+        migrations.CreateModel(
+            name='ShardTransferCredit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transfer_id', models.UUIDField(unique=True, verbose_name='Перевод')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата зачисления')),
+            ],
+            options={
+                'verbose_name': 'Зачисление перевода',
+                'verbose_name_plural': 'Зачисления переводов',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserDirectory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254, unique=True, verbose_name='Email')),
+                ('shard', models.CharField(max_length=50, verbose_name='Шард')),
+            ],
+            options={
+                'verbose_name': 'Запись справочника пользователей',
+                'verbose_name_plural': 'Справочник пользователей',
+            },
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='is_shadow',
+            field=models.BooleanField(default=False, verbose_name='Теневая копия'),
+        ),
+        migrations.AddIndex(
+            model_name='shardtransfer',
+            index=models.Index(fields=['state', 'created_at'], name='shard_transfer_state'),
+        ),
+        migrations.RunPython(backfill_directory, migrations.RunPython.noop),
+    ]
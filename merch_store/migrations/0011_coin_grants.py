@@ -0,0 +1,54 @@
+# Generated by Django 4.2 on 2026-10-19 10:17
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0010_sharding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoinGrant',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('reason', models.CharField(max_length=200, verbose_name='Основание')),
+                ('amount', models.PositiveIntegerField(verbose_name='Монет на пользователя')),
+                ('filters', models.JSONField(blank=True, default=dict, verbose_name='Фильтр получателей')),
+                ('state', models.CharField(choices=[('running', 'Выполняется'), ('completed', 'Завершено'), ('failed', 'Прервано с ошибкой')], default='running', max_length=10, verbose_name='Состояние')),
+                ('checkpoint', models.JSONField(blank=True, default=dict, verbose_name='Контрольная точка')),
+                ('granted', models.PositiveIntegerField(default=0, verbose_name='Начислено пользователям')),
+                ('created_by', models.EmailField(blank=True, max_length=254, verbose_name='Инициатор')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата завершения')),
+                ('last_error', models.TextField(blank=True, verbose_name='Последняя ошибка')),
+            ],
+            options={
+                'verbose_name': 'Массовое начисление',
+                'verbose_name_plural': 'Массовые начисления',
+            },
+        ),
+        migrations.CreateModel(
+            name='CoinGrantCredit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('grant_id', models.UUIDField(verbose_name='Начисление')),
+                ('amount', models.PositiveIntegerField(verbose_name='Количество монет')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата начисления')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coin_grants', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Начисление пользователю',
+                'verbose_name_plural': 'Начисления пользователям',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='coingrantcredit',
+            constraint=models.UniqueConstraint(fields=('grant_id', 'user'), name='unique_coin_grant_user'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2026-10-19 10:21
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0011_coin_grants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProvisioningJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('state', models.CharField(choices=[('running', 'Выполняется'), ('completed', 'Завершено'), ('failed', 'Прервано с ошибкой')], default='running', max_length=10, verbose_name='Состояние')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='Строк в файле')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='Обработано строк')),
+                ('created', models.PositiveIntegerField(default=0, verbose_name='Создано пользователей')),
+                ('skipped', models.PositiveIntegerField(default=0, verbose_name='Уже существовали')),
+                ('invalid', models.PositiveIntegerField(default=0, verbose_name='Ошибочных строк')),
+                ('errors', models.JSONField(blank=True, default=list, verbose_name='Ошибки')),
+                ('created_by', models.EmailField(blank=True, max_length=254, verbose_name='Инициатор')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата завершения')),
+                ('last_error', models.TextField(blank=True, verbose_name='Последняя ошибка')),
+            ],
+            options={
+                'verbose_name': 'Импорт сотрудников',
+                'verbose_name_plural': 'Импорты сотрудников',
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2 on 2026-10-19 10:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0012_provisioning_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevokedToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True, verbose_name='Ключ')),
+                ('user_id', models.BigIntegerField(blank=True, null=True, verbose_name='Пользователь')),
+                ('revoked_at', models.DateTimeField(verbose_name='Дата отзыва')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='Действует до')),
+            ],
+            options={
+                'verbose_name': 'Отозванный токен',
+                'verbose_name_plural': 'Отозванные токены',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='revokedtoken',
+            index=models.Index(fields=['revoked_at'], name='revoked_token_revoked_at_idx'),
+        ),
+    ]
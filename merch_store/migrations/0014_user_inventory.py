@@ -0,0 +1,49 @@
+# Generated by Django 4.2 on 2026-10-19 10:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_user_inventory(apps, schema_editor):
+    """Заполняет компактные карты из строк Inventory (на каждом шарде своими пользователями)."""
+    alias = schema_editor.connection.alias
+    Inventory = apps.get_model('merch_store', 'Inventory')
+    UserInventory = apps.get_model('merch_store', 'UserInventory')
+    rows = (Inventory.objects.using(alias).order_by('user_id')
+            .values_list('user_id', 'merch_id', 'quantity'))
+    batch, current, items = [], None, {}
+    for user_id, merch_id, quantity in rows.iterator(chunk_size=5000):
+        if user_id != current:
+            if current is not None:
+                batch.append(UserInventory(user_id=current, items=items))
+            current, items = user_id, {}
+        items[str(merch_id)] = items.get(str(merch_id), 0) + quantity
+        if len(batch) == 5000:
+            UserInventory.objects.using(alias).bulk_create(batch)
+            batch = []
+    if current is not None:
+        batch.append(UserInventory(user_id=current, items=items))
+    UserInventory.objects.using(alias).bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0013_revoked_tokens'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserInventory',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='compact_inventory', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('items', models.JSONField(default=dict, verbose_name='Товары')),
+            ],
+            options={
+                'verbose_name': 'Инвентарь пользователя',
+                'verbose_name_plural': 'Инвентари пользователей',
+            },
+        ),
+        migrations.RunPython(backfill_user_inventory, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2 on 2026-10-19 14:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_sales(apps, schema_editor):
+    """Переносит итоги продаж в нулевую часть счетчика."""
+    alias = schema_editor.connection.alias
+    LegacyMerchSales = apps.get_model('merch_store', 'LegacyMerchSales')
+    MerchSales = apps.get_model('merch_store', 'MerchSales')
+    MerchSales.objects.using(alias).bulk_create(
+        MerchSales(merch_id=merch_id, slot=0, sold=sold, revenue=revenue)
+        for merch_id, sold, revenue in LegacyMerchSales.objects.using(alias).values_list('merch_id', 'sold', 'revenue')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0014_user_inventory'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='merchsales',
+            name='merch_sales_top_sold',
+        ),
+        migrations.AlterField(
+            model_name='merchsales',
+            name='merch',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='merch_store.merch'),
+        ),
+        migrations.RenameModel(
+            old_name='MerchSales',
+            new_name='LegacyMerchSales',
+        ),
+        migrations.CreateModel(
+            name='MerchSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.PositiveSmallIntegerField(default=0, verbose_name='Номер части')),
+                ('sold', models.PositiveBigIntegerField(default=0, verbose_name='Продано штук')),
+                ('revenue', models.PositiveBigIntegerField(default=0, verbose_name='Выручка')),
+                ('merch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sales', to='merch_store.merch')),
+            ],
+            options={
+                'verbose_name': 'Продажи товара',
+                'verbose_name_plural': 'Продажи товаров',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='merchsales',
+            constraint=models.UniqueConstraint(fields=('merch', 'slot'), name='unique_merch_sales_slot'),
+        ),
+        migrations.RunPython(copy_sales, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='LegacyMerchSales',
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2 on 2026-10-19 11:01
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+
+
+def fill_costs(apps, schema_editor):
+    """
+    Заполняет уплаченные суммы по текущим ценам: цены прошлых покупок
+    нигде не сохранились. Новые покупки записывают фактическую цену.
+    """
+    alias = schema_editor.connection.alias
+    Merch = apps.get_model('merch_store', 'Merch')
+    Inventory = apps.get_model('merch_store', 'Inventory')
+    UserInventory = apps.get_model('merch_store', 'UserInventory')
+    price = Merch.objects.using(alias).filter(pk=OuterRef('merch_id')).values('price')[:1]
+    Inventory.objects.using(alias).update(spent=F('quantity') * Subquery(price))
+    prices = {str(pk): price for pk, price in Merch.objects.using(alias).values_list('pk', 'price')}
+    batch = []
+    for compact in UserInventory.objects.using(alias).iterator(chunk_size=5000):
+        compact.costs = {key: prices.get(key, 0) * quantity for key, quantity in compact.items.items()}
+        batch.append(compact)
+        if len(batch) == 5000:
+            UserInventory.objects.using(alias).bulk_update(batch, ['costs'])
+            batch = []
+    UserInventory.objects.using(alias).bulk_update(batch, ['costs'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0015_merch_sales_slots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inventory',
+            name='spent',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='Потрачено монет'),
+        ),
+        migrations.AddField(
+            model_name='userinventory',
+            name='costs',
+            field=models.JSONField(default=dict, verbose_name='Уплачено за товары'),
+        ),
+        migrations.RunPython(fill_costs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-19 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0017_outbox_retry_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coingrant',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Последняя пачка'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2 on 2026-10-19 11:37
+
+from django.db import migrations, models, router
+from django.db.models import Count
+import django.db.models.functions.text
+
+
+def check_case_duplicates(apps, schema_editor):
+    """
+    Аккаунты, различающиеся только регистром email, нельзя объединить автоматически
+    (у каждого свой баланс и история), поэтому миграция останавливается со списком.
+    """
+    alias = schema_editor.connection.alias
+    for model_name in ('User', 'UserDirectory'):
+        model = apps.get_model('merch_store', model_name)
+        if not router.allow_migrate_model(alias, model):
+            continue
+        duplicates = list(
+            model.objects.using(alias)
+            .values(email_lower=django.db.models.functions.text.Lower('email'))
+            .annotate(count=Count('pk')).filter(count__gt=1)
+            .values_list('email_lower', flat=True)[:20]
+        )
+        if duplicates:
+            raise RuntimeError(
+                f'{model_name} ({alias}): email отличаются только регистром у {", ".join(duplicates)}. '
+                f'Объедините или переименуйте эти аккаунты и повторите миграцию.'
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0018_coingrant_heartbeat'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_case_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='user',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('email'), name='unique_user_email_ci'),
+        ),
+        migrations.AddConstraint(
+            model_name='userdirectory',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('email'), name='unique_directory_email_ci'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-19 11:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merch_store', '0019_email_case_insensitive_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provisioningjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Последняя пачка'),
+        ),
+    ]
@@ -1,5 +1,8 @@
+import uuid
+
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models.functions import Lower
 
 # Create your models here.
 
@@ -9,6 +12,8 @@ class User(AbstractUser):
     email = models.EmailField(unique=True, verbose_name="Email")
     first_name = models.CharField(max_length=50, verbose_name="Имя")
     coins = models.IntegerField(default=1000, verbose_name='Монеты')
+    # Копия пользователя с другого шарда для связей в истории переводов
+    is_shadow = models.BooleanField(default=False, verbose_name='Теневая копия')
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
@@ -19,11 +24,17 @@ class User(AbstractUser):
     class Meta:
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        constraints = [
+            # Email хранится как введен, но аккаунты, различающиеся только регистром, запрещены;
+            # этот индекс используют поиски пользователя по email (sharding.email_is)
+            models.UniqueConstraint(Lower('email'), name='unique_user_email_ci'),
+        ]
 
 
 class Merch(models.Model):
     name = models.CharField(max_length=15, verbose_name='Name')
     price = models.IntegerField(verbose_name='Price')
+    is_limited = models.BooleanField(default=False, verbose_name='Ограниченный тираж')
 
     def __str__(self):
         return f'{self.name}: {self.price}'
@@ -33,16 +44,61 @@ class Merch(models.Model):
         verbose_name_plural = 'Мерчи'
 
 
+class MerchStockBucket(models.Model):
+    """
+    Часть остатка товара ограниченного тиража.
+
+    Остаток разбит на несколько строк, чтобы одновременные покупки одного
+    товара блокировали разные строки, а не одну общую.
+    """
+    merch = models.ForeignKey(Merch, on_delete=models.CASCADE, related_name="stock_buckets")
+    slot = models.PositiveSmallIntegerField(verbose_name='Номер части')
+    remaining = models.PositiveIntegerField(default=0, verbose_name='Остаток')
+
+    def __str__(self):
+        return f"{self.merch_id}[{self.slot}]: {self.remaining}"
+
+    class Meta:
+        verbose_name = 'Остаток товара'
+        verbose_name_plural = 'Остатки товаров'
+        constraints = [
+            models.UniqueConstraint(fields=['merch', 'slot'], name='unique_merch_stock_slot'),
+        ]
+
+
 class Inventory(models.Model):
     """Инвентарь пользователя"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="inventory")
     merch = models.ForeignKey(Merch, on_delete=models.CASCADE, related_name="inventory")
     quantity = models.PositiveIntegerField(default=1)  # Количество предметов
+    # Уплачено за все купленные единицы по ценам на момент покупки
+    spent = models.PositiveBigIntegerField(default=0, verbose_name="Потрачено монет")
 
     def __str__(self):
         return f"{self.user.username} — {self.merch.name} x{self.quantity}"
 
 
+class UserInventory(models.Model):
+    """
+    Компактный инвентарь пользователя: одна строка с картой {id товара: количество}
+    и картой уплаченных по ценам покупки сумм {id товара: монет}.
+
+    Используется вместо строк Inventory при INVENTORY_STORAGE = 'compact'
+    (см. merch_store/inventory.py). В PostgreSQL карта хранится в jsonb.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True,
+                                related_name="compact_inventory")
+    items = models.JSONField(default=dict, verbose_name="Товары")
+    costs = models.JSONField(default=dict, verbose_name="Уплачено за товары")
+
+    def __str__(self):
+        return f"{self.user_id}: {self.items}"
+
+    class Meta:
+        verbose_name = 'Инвентарь пользователя'
+        verbose_name_plural = 'Инвентари пользователей'
+
+
 class Transaction(models.Model):
     """Запись о транзакции монет между пользователями"""
     sender = models.ForeignKey(
@@ -58,7 +114,7 @@ class Transaction(models.Model):
         verbose_name="Получатель"
     )
     amount = models.PositiveIntegerField(verbose_name="Количество монет")
-    maked_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата транзакции")
+    maked_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="Дата транзакции")
 
     def __str__(self):
         return f"{self.sender.email} -> {self.recipient.email}: {self.amount}"
@@ -66,3 +122,285 @@ class Transaction(models.Model):
     class Meta:
         verbose_name = 'Транзакция'
         verbose_name_plural = 'Транзакции'
+
+
+class UserMonthlyStats(models.Model):
+    """Агрегаты переводов пользователя за месяц (обновляются инкрементально)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="monthly_stats")
+    month = models.DateField(verbose_name="Месяц")  # Первое число месяца
+    received = models.PositiveBigIntegerField(default=0, verbose_name="Получено монет")
+    sent = models.PositiveBigIntegerField(default=0, verbose_name="Отправлено монет")
+
+    def __str__(self):
+        return f"{self.user_id} {self.month:%Y-%m}: +{self.received} -{self.sent}"
+
+    class Meta:
+        verbose_name = 'Статистика пользователя за месяц'
+        verbose_name_plural = 'Статистика пользователей по месяцам'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'month'], name='unique_user_month_stats'),
+        ]
+        indexes = [
+            models.Index(fields=['month', '-received'], name='monthly_stats_top_received'),
+        ]
+
+
+class UserSpending(models.Model):
+    """Сумма монет, потраченных пользователем на мерч"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="spending")
+    spent = models.PositiveBigIntegerField(default=0, verbose_name="Потрачено монет")
+
+    def __str__(self):
+        return f"{self.user_id}: {self.spent}"
+
+    class Meta:
+        verbose_name = 'Траты пользователя'
+        verbose_name_plural = 'Траты пользователей'
+        indexes = [
+            models.Index(fields=['-spent'], name='user_spending_top_spent'),
+        ]
+
+
+class MerchSales(models.Model):
+    """
+    Часть счетчика продаж товара за все время.
+
+    Счетчик разбит на несколько строк (как остатки в MerchStockBucket):
+    покупатель увеличивает строку своей части, поэтому одновременные покупки
+    одного товара не выстраиваются в очередь за одной строкой.
+    Итог по товару — сумма его частей.
+    """
+    merch = models.ForeignKey(Merch, on_delete=models.CASCADE, related_name="sales")
+    slot = models.PositiveSmallIntegerField(default=0, verbose_name='Номер части')
+    sold = models.PositiveBigIntegerField(default=0, verbose_name="Продано штук")
+    revenue = models.PositiveBigIntegerField(default=0, verbose_name="Выручка")
+
+    def __str__(self):
+        return f"{self.merch_id}[{self.slot}]: {self.sold}"
+
+    class Meta:
+        verbose_name = 'Продажи товара'
+        verbose_name_plural = 'Продажи товаров'
+        constraints = [
+            models.UniqueConstraint(fields=['merch', 'slot'], name='unique_merch_sales_slot'),
+        ]
+
+
+class OutboxEvent(models.Model):
+    """
+    Событие для внешних систем (transactional outbox).
+
+    Пишется в той же транзакции, что и бизнес-изменение, и доставляется
+    позже командой dispatch_outbox.
+    """
+    topic = models.CharField(max_length=50, verbose_name="Тип события")
+    payload = models.JSONField(verbose_name="Данные события")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    dispatched_at = models.DateTimeField(null=True, blank=True, verbose_name="Дата доставки")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Неудачных попыток")
+    last_error = models.TextField(blank=True, verbose_name="Последняя ошибка")
+    next_attempt_at = models.DateTimeField(null=True, blank=True, verbose_name="Следующая попытка не раньше")
+    # Событие исчерпало попытки доставки и больше не отправляется автоматически
+    failed_at = models.DateTimeField(null=True, blank=True, verbose_name="Дата отказа от доставки")
+
+    def __str__(self):
+        return f"#{self.pk} {self.topic}"
+
+    class Meta:
+        verbose_name = 'Событие outbox'
+        verbose_name_plural = 'События outbox'
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(dispatched_at__isnull=True, failed_at__isnull=True),
+                         name='outbox_pending'),
+        ]
+
+
+class UserDirectory(models.Model):
+    """
+    Глобальный справочник пользователей: email -> шард.
+
+    Хранится в основной БД. Его id выдается пользователю как глобально
+    уникальный id на всех шардах.
+    """
+    email = models.EmailField(unique=True, verbose_name="Email")
+    shard = models.CharField(max_length=50, verbose_name="Шард")
+
+    def __str__(self):
+        return f"{self.email} -> {self.shard}"
+
+    class Meta:
+        verbose_name = 'Запись справочника пользователей'
+        verbose_name_plural = 'Справочник пользователей'
+        constraints = [
+            models.UniqueConstraint(Lower('email'), name='unique_directory_email_ci'),
+        ]
+
+
+class ShardTransfer(models.Model):
+    """
+    Журнал перевода между шардами (сага). Хранится на шарде отправителя.
+
+    Списание у отправителя и запись журнала выполняются в одной локальной
+    транзакции, зачисление получателю — отдельно и идемпотентно.
+    """
+    DEBITED = 'debited'
+    COMPLETED = 'completed'
+    REFUNDED = 'refunded'
+    STATES = (
+        (DEBITED, 'Списано у отправителя'),
+        (COMPLETED, 'Зачислено получателю'),
+        (REFUNDED, 'Возвращено отправителю'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    sender_id = models.BigIntegerField(verbose_name="Отправитель")
+    recipient_id = models.BigIntegerField(verbose_name="Получатель")
+    recipient_shard = models.CharField(max_length=50, verbose_name="Шард получателя")
+    amount = models.PositiveIntegerField(verbose_name="Количество монет")
+    # Запись Transaction на шарде отправителя (удаляется при возврате)
+    transaction_id = models.BigIntegerField(null=True, verbose_name="Транзакция отправителя")
+    state = models.CharField(max_length=10, choices=STATES, default=DEBITED, verbose_name="Состояние")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата изменения")
+
+    def __str__(self):
+        return f"{self.id} {self.sender_id} -> {self.recipient_id}: {self.amount} ({self.state})"
+
+    class Meta:
+        verbose_name = 'Перевод между шардами'
+        verbose_name_plural = 'Переводы между шардами'
+        indexes = [
+            models.Index(fields=['state', 'created_at'], name='shard_transfer_state'),
+        ]
+
+
+class ShardTransferCredit(models.Model):
+    """Отметка о зачислении перевода на шарде получателя (ключ идемпотентности)"""
+    transfer_id = models.UUIDField(unique=True, verbose_name="Перевод")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата зачисления")
+
+    def __str__(self):
+        return str(self.transfer_id)
+
+    class Meta:
+        verbose_name = 'Зачисление перевода'
+        verbose_name_plural = 'Зачисления переводов'
+
+
+class CoinGrant(models.Model):
+    """
+    Массовое начисление монет (например, квартальная премия).
+
+    Хранится в основной БД. checkpoint содержит id последнего обработанного
+    пользователя на каждом шарде, поэтому прерванное начисление можно продолжить;
+    heartbeat_at — время последней пачки, по нему находятся брошенные начисления.
+    """
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    STATES = (
+        (RUNNING, 'Выполняется'),
+        (COMPLETED, 'Завершено'),
+        (FAILED, 'Прервано с ошибкой'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    reason = models.CharField(max_length=200, verbose_name="Основание")
+    amount = models.PositiveIntegerField(verbose_name="Монет на пользователя")
+    filters = models.JSONField(default=dict, blank=True, verbose_name="Фильтр получателей")
+    state = models.CharField(max_length=10, choices=STATES, default=RUNNING, verbose_name="Состояние")
+    checkpoint = models.JSONField(default=dict, blank=True, verbose_name="Контрольная точка")
+    granted = models.PositiveIntegerField(default=0, verbose_name="Начислено пользователям")
+    created_by = models.EmailField(blank=True, verbose_name="Инициатор")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="Дата завершения")
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name="Последняя пачка")
+    last_error = models.TextField(blank=True, verbose_name="Последняя ошибка")
+
+    def __str__(self):
+        return f"{self.reason}: {self.amount} ({self.state})"
+
+    class Meta:
+        verbose_name = 'Массовое начисление'
+        verbose_name_plural = 'Массовые начисления'
+
+
+class CoinGrantCredit(models.Model):
+    """Начисление монет пользователю в рамках CoinGrant (хранится на шарде пользователя)"""
+    grant_id = models.UUIDField(verbose_name="Начисление")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="coin_grants")
+    amount = models.PositiveIntegerField(verbose_name="Количество монет")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата начисления")
+
+    def __str__(self):
+        return f"{self.grant_id} -> {self.user_id}: {self.amount}"
+
+    class Meta:
+        verbose_name = 'Начисление пользователю'
+        verbose_name_plural = 'Начисления пользователям'
+        constraints = [
+            models.UniqueConstraint(fields=['grant_id', 'user'], name='unique_coin_grant_user'),
+        ]
+
+
+class ProvisioningJob(models.Model):
+    """
+    Импорт сотрудников из CSV/JSON.
+
+    Пароли из файла не сохраняются: в задаче хранятся только счетчики
+    и ошибки разбора строк. heartbeat_at — время последней пачки, по нему
+    находятся импорты, прерванные завершением процесса.
+    """
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    STATES = (
+        (RUNNING, 'Выполняется'),
+        (COMPLETED, 'Завершено'),
+        (FAILED, 'Прервано с ошибкой'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    state = models.CharField(max_length=10, choices=STATES, default=RUNNING, verbose_name="Состояние")
+    total = models.PositiveIntegerField(default=0, verbose_name="Строк в файле")
+    processed = models.PositiveIntegerField(default=0, verbose_name="Обработано строк")
+    created = models.PositiveIntegerField(default=0, verbose_name="Создано пользователей")
+    skipped = models.PositiveIntegerField(default=0, verbose_name="Уже существовали")
+    invalid = models.PositiveIntegerField(default=0, verbose_name="Ошибочных строк")
+    errors = models.JSONField(default=list, blank=True, verbose_name="Ошибки")
+    created_by = models.EmailField(blank=True, verbose_name="Инициатор")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="Дата завершения")
+    last_error = models.TextField(blank=True, verbose_name="Последняя ошибка")
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name="Последняя пачка")
+
+    def __str__(self):
+        return f"{self.id}: {self.created}/{self.total} ({self.state})"
+
+    class Meta:
+        verbose_name = 'Импорт сотрудников'
+        verbose_name_plural = 'Импорты сотрудников'
+
+
+class RevokedToken(models.Model):
+    """
+    Отзыв JWT (хранится в основной БД).
+
+    Ключ jti:<jti> отзывает один токен, ключ user:<id> — все токены пользователя,
+    выданные раньше revoked_at (хранится с точностью до секунды). Запись не нужна после expires_at: к этому
+    времени истекают все токены, которых она касается.
+    """
+    key = models.CharField(max_length=255, unique=True, verbose_name="Ключ")
+    user_id = models.BigIntegerField(null=True, blank=True, verbose_name="Пользователь")
+    revoked_at = models.DateTimeField(verbose_name="Дата отзыва")
+    expires_at = models.DateTimeField(db_index=True, verbose_name="Действует до")
+
+    def __str__(self):
+        return f"{self.key} (до {self.expires_at})"
+
+    class Meta:
+        verbose_name = 'Отозванный токен'
+        verbose_name_plural = 'Отозванные токены'
+        indexes = [
+            models.Index(fields=['revoked_at'], name='revoked_token_revoked_at_idx'),
+        ]
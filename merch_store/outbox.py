@@ -0,0 +1,157 @@
+"""
+Transactional outbox для событий переводов и покупок.
+
+publish() добавляет одну строку OutboxEvent в текущую транзакцию запроса.
+dispatch_batch() забирает пачку недоставленных событий по порядку id
+(SELECT ... FOR UPDATE SKIP LOCKED), отдает их всем приемникам из
+settings.OUTBOX_SINKS и помечает доставленными. Доставка "хотя бы один раз":
+при сбое после отправки событие будет отправлено повторно.
+
+Если пачка не доставлена, события отправляются по одному: событие, которое
+не принимает приемник, не задерживает остальные. Оно откладывается с
+экспоненциальной паузой (next_attempt_at), а после OUTBOX_RETRY['MAX_ATTEMPTS']
+неудачных попыток помечается отказом (failed_at) и больше не отправляется,
+пока его не вернет в очередь команда dispatch_outbox --retry-failed.
+Порядок доставки отложенных событий относительно следующих не сохраняется.
+
+При шардировании событие пишется в outbox шарда, на котором выполнена
+операция, и доставляется отдельно для каждого шарда.
+"""
+import json
+import logging
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from merch_store.models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+TRANSFER_TOPIC = 'coins.transferred'
+PURCHASE_TOPIC = 'merch.purchased'
+
+
+def publish(topic, payload):
+    """Записывает событие в outbox. Вызывается внутри транзакции бизнес-операции."""
+    return OutboxEvent.objects.create(topic=topic, payload=payload)
+
+
+def serialize(event):
+    return {
+        'id': event.pk,
+        'topic': event.topic,
+        'payload': event.payload,
+        'created_at': event.created_at.isoformat(),
+    }
+
+
+class FileSink:
+    """Дописывает события в файл в формате NDJSON."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, events):
+        with open(self.path, 'a', encoding='utf-8') as output:
+            for event in events:
+                output.write(json.dumps(serialize(event), ensure_ascii=False) + '\n')
+            output.flush()
+            os.fsync(output.fileno())
+
+
+class CallbackSink:
+    """Вызывает функцию (путь импорта или callable) для каждого события."""
+
+    def __init__(self, callback):
+        self.callback = import_string(callback) if isinstance(callback, str) else callback
+
+    def send(self, events):
+        for event in events:
+            self.callback(serialize(event))
+
+
+def get_sinks():
+    return [
+        import_string(sink['BACKEND'])(**sink.get('OPTIONS', {}))
+        for sink in settings.OUTBOX_SINKS
+    ]
+
+
+def pending(using=DEFAULT_DB_ALIAS, now=None):
+    """События, которые пора отправить."""
+    now = now or timezone.now()
+    return OutboxEvent.objects.using(using).filter(
+        Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now),
+        dispatched_at__isnull=True, failed_at__isnull=True,
+    )
+
+
+def _send(sinks, events):
+    for sink in sinks:
+        sink.send(events)
+
+
+def _record_failure(event, error, now, using):
+    """Откладывает событие после неудачной попытки или отказывается от него."""
+    options = settings.OUTBOX_RETRY
+    attempts = event.attempts + 1
+    changes = {'attempts': attempts, 'last_error': repr(error)}
+    if attempts >= options['MAX_ATTEMPTS']:
+        changes['failed_at'] = now
+        logger.error('Outbox event %s failed %s times, giving up: %r', event.pk, attempts, error)
+    else:
+        delay = min(options['MAX_DELAY'], options['BASE_DELAY'] * 2 ** (attempts - 1))
+        changes['next_attempt_at'] = now + timedelta(seconds=delay)
+    OutboxEvent.objects.using(using).filter(pk=event.pk).update(**changes)
+
+
+def dispatch_batch(sinks, batch_size=100, using=DEFAULT_DB_ALIAS):
+    """
+    Доставляет одну пачку событий. Возвращает число доставленных событий.
+
+    Если приемник падает на пачке, события отправляются по одному;
+    недоставленные откладываются (см. описание модуля).
+    """
+    now = timezone.now()
+    with transaction.atomic(using=using):
+        events = list(pending(using, now)
+                      .select_for_update(skip_locked=True)
+                      .order_by('id')[:batch_size])
+        if not events:
+            return 0
+        try:
+            _send(sinks, events)
+            delivered = [event.pk for event in events]
+        except Exception:
+            logger.exception('Outbox delivery failed for events %s..%s, sending one by one',
+                             events[0].pk, events[-1].pk)
+            delivered = []
+            for event in events:
+                try:
+                    _send(sinks, [event])
+                except Exception as error:
+                    _record_failure(event, error, now, using)
+                else:
+                    delivered.append(event.pk)
+        OutboxEvent.objects.using(using).filter(pk__in=delivered).update(dispatched_at=now)
+        return len(delivered)
+
+
+def retry_failed(using=DEFAULT_DB_ALIAS):
+    """Возвращает в очередь события, от доставки которых outbox отказался."""
+    return OutboxEvent.objects.using(using).filter(failed_at__isnull=False).update(
+        failed_at=None, next_attempt_at=None, attempts=0
+    )
+
+
+def purge_dispatched(older_than, using=DEFAULT_DB_ALIAS):
+    """Удаляет доставленные события старше указанного момента."""
+    deleted, _ = OutboxEvent.objects.using(using).filter(
+        dispatched_at__isnull=False, dispatched_at__lt=older_than
+    ).delete()
+    return deleted
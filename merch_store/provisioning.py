@@ -0,0 +1,274 @@
+"""
+Массовое создание сотрудников из CSV или JSON.
+
+Основная нагрузка при создании пользователя — хеширование пароля (PBKDF2).
+Здесь оно выполняется в пуле отдельных процессов, а пользователи
+вставляются пачками через bulk_create(ignore_conflicts=True): уже
+существующие email пропускаются, повторный импорт того же файла безопасен.
+Email сохраняется в том виде, в каком указан в файле, а существующие и
+повторяющиеся email ищутся без учета регистра — так же, как при входе.
+
+Формат CSV: заголовок с колонкой email и необязательными password и first_name.
+Формат JSON: список объектов с теми же полями. Пользователь без пароля
+получает непригодный для входа пароль.
+
+Выполняющийся импорт отмечает heartbeat_at после каждой пачки. Пароли не
+сохраняются, поэтому импорт, прерванный завершением процесса (например,
+перезапуском воркера API), продолжить без файла нельзя: такой импорт
+помечается прерванным, и его продолжает команда provision_users <файл> --resume <id>.
+"""
+import csv
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils import timezone
+
+from merch_store import hashing, sharding
+from merch_store.jobs import run_in_background
+from merch_store.models import ProvisioningJob, User, UserDirectory
+
+DEFAULT_CHUNK_SIZE = 1000
+# Через сколько секунд без новых пачек импорт считается прерванным
+STALE_SECONDS = 300
+HASH_CHUNK_SIZE = 32
+MAX_STORED_ERRORS = 100
+FORMATS = ('csv', 'json')
+
+
+class ProvisioningError(ValueError):
+    """Файл импорта не удалось разобрать"""
+
+
+class ProvisioningBusy(Exception):
+    """Импорт еще выполняется или уже завершен"""
+
+
+def parse(content, file_format):
+    """Разбирает содержимое файла (str) в список словарей со строками файла."""
+    if file_format == 'csv':
+        reader = csv.DictReader(io.StringIO(content))
+        if not reader.fieldnames or 'email' not in reader.fieldnames:
+            raise ProvisioningError("В CSV нет колонки 'email'.")
+        return list(reader)
+    if file_format == 'json':
+        try:
+            rows = json.loads(content)
+        except ValueError:
+            raise ProvisioningError('Файл не является корректным JSON.')
+        return validate_rows(rows)
+    raise ProvisioningError(f"Формат должен быть одним из: {', '.join(FORMATS)}.")
+
+
+def validate_rows(rows):
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ProvisioningError('Ожидается список объектов с полем email.')
+    return rows
+
+
+def format_of(filename):
+    extension = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    if extension not in FORMATS:
+        raise ProvisioningError(f"Не удалось определить формат файла '{filename}'.")
+    return extension
+
+
+def _clean(rows):
+    """Возвращает (корректные записи без повторов, ошибки по номерам строк)."""
+    records, errors, seen = [], [], set()
+    max_name = User._meta.get_field('first_name').max_length
+    for number, row in enumerate(rows, start=1):
+        email = str(row.get('email') or '').strip()
+        try:
+            validate_email(email)
+        except ValidationError:
+            errors.append({'row': number, 'error': f"Некорректный email: '{email}'."})
+            continue
+        if email.lower() in seen:
+            errors.append({'row': number, 'error': f"Повтор email '{email}' в файле."})
+            continue
+        first_name = str(row.get('first_name') or '').strip()
+        if len(first_name) > max_name:
+            errors.append({'row': number, 'error': f'Имя длиннее {max_name} символов.'})
+            continue
+        password = row.get('password') or None
+        if password is not None and not isinstance(password, str):
+            errors.append({'row': number, 'error': 'Пароль должен быть строкой.'})
+            continue
+        seen.add(email.lower())
+        records.append({'email': email, 'password': password, 'first_name': first_name})
+    return records, errors
+
+
+def hasher_pool(workers):
+    """
+    Пул процессов для хеширования или None, если хешировать в текущем процессе.
+
+    Используется spawn, а не fork: процесс веб-сервера многопоточный.
+    """
+    if workers is None:
+        workers = settings.PROVISIONING_WORKERS or os.cpu_count() or 1
+    if workers <= 1:
+        return None
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=hashing.init_worker,
+        initargs=(os.environ.get('DJANGO_SETTINGS_MODULE', 'config.settings'),),
+    )
+
+
+def _existing_emails(emails):
+    """Уже занятые email из emails в нижнем регистре (сравнение без учета регистра)."""
+    model = UserDirectory if sharding.is_sharded() else User
+    return set(model.objects.using(DEFAULT_DB_ALIAS)
+               .annotate(email_lower=Lower('email'))
+               .filter(email_lower__in=[email.lower() for email in emails])
+               .values_list('email_lower', flat=True))
+
+
+def _insert(users):
+    """Вставляет пользователей; при шардировании выдает id из справочника и раскладывает по шардам."""
+    if not sharding.is_sharded():
+        User.objects.using(DEFAULT_DB_ALIAS).bulk_create(users, batch_size=len(users), ignore_conflicts=True)
+        return
+    directory = UserDirectory.objects.using(DEFAULT_DB_ALIAS)
+    directory.bulk_create([UserDirectory(email=user.email, shard=sharding.shard_for_email(user.email))
+                           for user in users], ignore_conflicts=True)
+    entries = {entry.email: entry for entry in directory.filter(email__in=[user.email for user in users])}
+    by_shard = {}
+    for user in users:
+        entry = entries[user.email]
+        user.pk = entry.pk
+        by_shard.setdefault(entry.shard, []).append(user)
+    for alias, shard_users in by_shard.items():
+        User.objects.using(alias).bulk_create(shard_users, batch_size=len(shard_users), ignore_conflicts=True)
+
+
+def create_job(rows, created_by=''):
+    return ProvisioningJob.objects.using(DEFAULT_DB_ALIAS).create(
+        total=len(rows), created_by=created_by, heartbeat_at=timezone.now(),
+    )
+
+
+def _stale(now, stale_seconds=STALE_SECONDS):
+    """Условие на выполняющиеся импорты без новых пачек дольше stale_seconds."""
+    return Q(state=ProvisioningJob.RUNNING, heartbeat_at__lt=now - timedelta(seconds=stale_seconds))
+
+
+def fail_stale(job=None, stale_seconds=STALE_SECONDS):
+    """Помечает прерванными импорты без новых пачек дольше stale_seconds (или только job)."""
+    stale = ProvisioningJob.objects.using(DEFAULT_DB_ALIAS).filter(_stale(timezone.now(), stale_seconds))
+    if job is not None:
+        stale = stale.filter(pk=job.pk)
+    return stale.update(
+        state=ProvisioningJob.FAILED, finished_at=timezone.now(),
+        last_error='Импорт прерван: процесс, который его выполнял, завершился. '
+                   'Продолжите его командой provision_users <файл> --resume <id>.',
+    )
+
+
+def _claim(job, stale_seconds):
+    """Забирает прерванный импорт для продолжения; бросает ProvisioningBusy, если он идет или завершен."""
+    now = timezone.now()
+    claimed = (ProvisioningJob.objects.using(DEFAULT_DB_ALIAS)
+               .filter(_stale(now, stale_seconds) | Q(state=ProvisioningJob.FAILED), pk=job.pk)
+               .update(state=ProvisioningJob.RUNNING, heartbeat_at=now, finished_at=None, last_error=''))
+    if not claimed:
+        raise ProvisioningBusy(f'Импорт {job.pk} еще выполняется или уже завершен.')
+    job.refresh_from_db(using=DEFAULT_DB_ALIAS)
+
+
+def run(job, rows, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None, resume=False,
+        stale_seconds=STALE_SECONDS):
+    """
+    Создает пользователей из rows и обновляет счетчики задачи после каждой пачки.
+
+    progress (если передана) получает словарь с прогрессом и скоростью.
+    С resume продолжает прерванный импорт job из того же файла: строки, пачки
+    которых уже обработаны, пропускаются, счетчики продолжаются.
+    """
+    jobs_of = ProvisioningJob.objects.using(DEFAULT_DB_ALIAS)
+    if resume:
+        if len(rows) != job.total:
+            raise ProvisioningError(f'В файле {len(rows)} строк, а в импорте {job.total}: это другой файл.')
+        _claim(job, stale_seconds)
+    records, errors = _clean(rows)
+    # Записи из уже обработанных пачек (у нового импорта счетчики нулевые)
+    done = job.created + job.skipped
+    jobs_of.filter(pk=job.pk).update(invalid=len(errors), errors=errors[:MAX_STORED_ERRORS],
+                                     processed=len(errors) + done)
+    started = time.monotonic()
+    processed, created, skipped = 0, job.created, job.skipped
+    pool = hasher_pool(workers)
+    try:
+        records = islice(records, done, None)
+        while chunk := list(islice(records, chunk_size)):
+            existing = _existing_emails([record['email'] for record in chunk])
+            new = [record for record in chunk if record['email'].lower() not in existing]
+            passwords = [record['password'] for record in new]
+            hashed = (list(pool.map(hashing.hash_password, passwords, chunksize=HASH_CHUNK_SIZE)) if pool
+                      else [hashing.hash_password(password) for password in passwords])
+            if new:
+                _insert([User(email=record['email'], first_name=record['first_name'], password=password)
+                         for record, password in zip(new, hashed)])
+
+            processed += len(chunk)
+            created += len(new)
+            skipped += len(chunk) - len(new)
+            jobs_of.filter(pk=job.pk).update(processed=len(errors) + done + processed, created=created,
+                                             skipped=skipped, heartbeat_at=timezone.now())
+            if progress:
+                elapsed = time.monotonic() - started
+                progress({
+                    'processed': processed,
+                    'created': created,
+                    'skipped': skipped,
+                    'rows_per_sec': processed / elapsed if elapsed else 0.0,
+                })
+    except Exception as error:
+        jobs_of.filter(pk=job.pk).update(state=ProvisioningJob.FAILED, last_error=repr(error),
+                                         finished_at=timezone.now())
+        raise
+    finally:
+        if pool:
+            pool.shutdown()
+
+    jobs_of.filter(pk=job.pk).update(state=ProvisioningJob.COMPLETED, finished_at=timezone.now())
+    job.refresh_from_db(using=DEFAULT_DB_ALIAS)
+    return job
+
+
+def summary(job):
+    """Состояние импорта для API: счетчики и средняя скорость."""
+    elapsed = ((job.finished_at or timezone.now()) - job.created_at).total_seconds()
+    return {
+        "id": str(job.pk),
+        "state": job.state,
+        "total": job.total,
+        "processed": job.processed,
+        "created": job.created,
+        "skipped": job.skipped,
+        "invalid": job.invalid,
+        "errors": job.errors,
+        "rows_per_sec": round(job.processed / elapsed, 1) if elapsed > 0 else None,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+        "last_error": job.last_error,
+    }
+
+
+def launch(job, rows, workers=None):
+    """Запускает импорт в фоне: пароли хешируются в пуле процессов, а не в процессе веб-сервера."""
+    return run_in_background(f'provisioning-{job.pk}', run, job, rows, workers)
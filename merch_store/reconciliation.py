@@ -0,0 +1,92 @@
+"""
+Сверка балансов пользователей с историей операций.
+
+Ожидаемый баланс = начальные монеты + массовые начисления + полученные
+переводы - отправленные переводы - стоимость купленного мерча по ценам
+на момент покупки (см. inventory.spent_by), поэтому изменение цены товара
+не создает расхождений.
+"""
+from dataclasses import dataclass
+
+from django.db import connections, transaction
+from django.db.models import Sum
+
+from merch_store import inventory
+from merch_store.models import CoinGrantCredit, Transaction, User
+
+INITIAL_COINS = User._meta.get_field('coins').get_default()
+
+
+@dataclass
+class Discrepancy:
+    user_id: int
+    email: str
+    actual: int
+    expected: int
+
+    @property
+    def difference(self):
+        return self.actual - self.expected
+
+
+def _totals(queryset, key, total):
+    return dict(queryset.values_list(key).annotate(total=total).order_by())
+
+
+def expected_balances(user_ids, using='default'):
+    """Считает ожидаемые балансы для пачки пользователей несколькими запросами на всю пачку."""
+    received = _totals(Transaction.objects.using(using).filter(recipient_id__in=user_ids),
+                       'recipient_id', Sum('amount'))
+    sent = _totals(Transaction.objects.using(using).filter(sender_id__in=user_ids),
+                   'sender_id', Sum('amount'))
+    spent = inventory.spent_by(user_ids, using=using)
+    granted = _totals(CoinGrantCredit.objects.using(using).filter(user_id__in=user_ids),
+                      'user_id', Sum('amount'))
+    return {
+        user_id: (INITIAL_COINS + granted.get(user_id, 0) + received.get(user_id, 0)
+                  - sent.get(user_id, 0) - spent.get(user_id, 0))
+        for user_id in user_ids
+    }
+
+
+def _snapshot(using):
+    """Согласованный снимок в рамках короткой транзакции, без блокировок строк."""
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+
+def check_chunk(after_id, chunk_size, using='default'):
+    """
+    Проверяет следующую пачку пользователей с id больше after_id.
+
+    Возвращает (id последнего пользователя или None, число проверенных, расхождения).
+    """
+    with transaction.atomic(using=using):
+        _snapshot(using)
+        users = list(User.objects.using(using)
+                     .filter(id__gt=after_id, is_shadow=False)
+                     .order_by('id')
+                     .values_list('id', 'email', 'coins')[:chunk_size])
+        if not users:
+            return None, 0, []
+        expected = expected_balances([user_id for user_id, _, _ in users], using=using)
+
+    discrepancies = [
+        Discrepancy(user_id, email, coins, expected[user_id])
+        for user_id, email, coins in users
+        if coins != expected[user_id]
+    ]
+    return users[-1][0], len(users), discrepancies
+
+
+def repair(discrepancy, using='default'):
+    """
+    Исправляет баланс, если он не изменился с момента проверки.
+
+    Возвращает False, если баланс успел измениться (например, новым переводом).
+    """
+    return User.objects.using(using).filter(
+        pk=discrepancy.user_id, coins=discrepancy.actual
+    ).update(coins=discrepancy.expected) == 1
@@ -0,0 +1,134 @@
+"""
+Повтор транзакций при конфликтах блокировок.
+
+Декоратор retry_atomic выполняет функцию в transaction.atomic и при
+взаимоблокировке (40P01), ошибке сериализации (40001) или превышении
+lock_timeout (55P03) откатывает транзакцию и повторяет ее целиком после
+паузы с экспоненциальным ростом и случайным разбросом (full jitter).
+Число попыток и суммарное время повторов ограничены (settings.TRANSACTION_RETRY).
+Если попытки исчерпаны, бросается RetriesExhausted — эндпойнты отвечают
+503 с заголовком Retry-After вместо 500.
+
+Внутри уже открытой транзакции повтор невозможен (ошибка прерывает внешнюю
+транзакцию), поэтому там функция выполняется один раз в точке сохранения.
+
+Счетчики повторов ведутся в памяти процесса (см. counters()).
+"""
+import functools
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_SQLSTATES = {
+    '40001': 'serialization_failures',
+    '40P01': 'deadlocks',
+    '55P03': 'lock_timeouts',
+}
+
+_counters = Counter()
+_counters_lock = threading.Lock()
+
+
+class RetriesExhausted(Exception):
+    """Транзакция не прошла после всех повторов; исходная ошибка в __cause__."""
+
+
+def _count(kind):
+    with _counters_lock:
+        _counters[kind] += 1
+
+
+def counters():
+    """Счетчики процесса: число конфликтов по видам, повторов и отказов."""
+    with _counters_lock:
+        return {kind: _counters[kind]
+                for kind in (*RETRYABLE_SQLSTATES.values(), 'retries', 'gave_up')}
+
+
+def reset_counters():
+    with _counters_lock:
+        _counters.clear()
+
+
+def classify(error):
+    """Вид конфликта для повторяемой ошибки БД или None."""
+    cause = error
+    while cause is not None:
+        # psycopg2 — pgcode, psycopg 3 — sqlstate
+        code = getattr(cause, 'pgcode', None) or getattr(cause, 'sqlstate', None)
+        if code in RETRYABLE_SQLSTATES:
+            return RETRYABLE_SQLSTATES[code]
+        cause = cause.__cause__
+    # SQLite (локальная разработка): занятая БД — аналог ожидания блокировки
+    if 'database is locked' in str(error).lower():
+        return 'lock_timeouts'
+    return None
+
+
+def backoff(attempt, base_delay, max_delay):
+    """Пауза перед повтором номер attempt (с 1): случайная в [0, base * 2^(attempt-1)]."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def _configure(alias, serializable, lock_timeout_ms):
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        # SET TRANSACTION должен быть первым запросом транзакции
+        if serializable:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL SERIALIZABLE')
+        if lock_timeout_ms:
+            cursor.execute('SET LOCAL lock_timeout = %s', [f'{int(lock_timeout_ms)}ms'])
+
+
+def retry_atomic(using=None, serializable=None, lock_timeout_ms=None, max_attempts=None, budget=None):
+    """
+    Декоратор: выполняет функцию в транзакции с повтором при конфликтах.
+
+    using — алиас БД или функция, которая вычисляет его по аргументам вызова
+    (например, шард пользователя). Остальные параметры по умолчанию берутся
+    из settings.TRANSACTION_RETRY.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            options = settings.TRANSACTION_RETRY
+            alias = (using(*args, **kwargs) if callable(using) else using) or DEFAULT_DB_ALIAS
+            use_serializable = options['SERIALIZABLE'] if serializable is None else serializable
+            timeout = options['LOCK_TIMEOUT_MS'] if lock_timeout_ms is None else lock_timeout_ms
+            attempts = max_attempts or options['MAX_ATTEMPTS']
+            deadline = time.monotonic() + (options['BUDGET'] if budget is None else budget)
+
+            if connections[alias].in_atomic_block:
+                with transaction.atomic(using=alias):
+                    return func(*args, **kwargs)
+
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    with transaction.atomic(using=alias):
+                        _configure(alias, use_serializable, timeout)
+                        return func(*args, **kwargs)
+                except DatabaseError as error:
+                    kind = classify(error)
+                    if kind is None:
+                        raise
+                    _count(kind)
+                    delay = backoff(attempt, options['BASE_DELAY'], options['MAX_DELAY'])
+                    if attempt >= attempts or time.monotonic() + delay > deadline:
+                        _count('gave_up')
+                        logger.warning('%s gave up after %s attempts: %s', func.__qualname__, attempt, kind)
+                        raise RetriesExhausted(kind) from error
+                    _count('retries')
+                    time.sleep(delay)
+        return wrapper
+    return decorator
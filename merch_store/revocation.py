@@ -0,0 +1,240 @@
+"""
+Отзыв JWT без запроса к БД на каждый запрос.
+
+Отозванные токены хранятся в таблице RevokedToken основной БД — это общее
+хранилище для всех процессов. Каждый процесс держит в памяти фильтр Блума
+с ключами действующих отзывов и раз в REVOCATION_SYNC_SECONDS дочитывает
+новые записи (один запрос на процесс, а не на запрос пользователя).
+
+Проверка токена — вычисление нескольких хешей в памяти. Фильтр может ошибиться
+только в сторону «возможно отозван»: такое попадание подтверждается запросом
+к БД. И ложные срабатывания, и подтвержденные записи запоминаются до следующей
+пересборки фильтра (подтвержденные — пока запись не перечитана синхронизацией),
+поэтому действующий отзыв пользователя не требует запроса на каждый запрос.
+
+Отзыв всех токенов пользователя действует на токены, выданные не позже момента
+отзыва. iat хранит только секунды, поэтому приложение добавляет в выдаваемые токены
+время выдачи в микросекундах (stamp): вход сразу после отзыва в ту же секунду дает
+действующий токен, а выданные до отзыва в эту же секунду отзываются. Токены без этого
+поля сравниваются по iat и отзываются, если выданы в секунду отзыва или раньше.
+
+Запись перестает действовать вместе с токенами, которых она касается
+(expires_at), и выпадает из фильтра при пересборке; из таблицы ее удаляет
+команда purge_revoked_tokens.
+
+Отзыв, сделанный в другом процессе, начинает действовать здесь не позже
+чем через REVOCATION_SYNC_SECONDS.
+"""
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+
+from merch_store.models import RevokedToken
+
+# Записи, зафиксированные чуть раньше прочитанных (транзакции завершаются
+# не в порядке revoked_at), дочитываются с перекрытием
+SYNC_OVERLAP = timedelta(seconds=5)
+# Время выдачи токена в микросекундах от начала эпохи (см. stamp)
+ISSUED_AT_CLAIM = 'iat_us'
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class BloomFilter:
+    """Фильтр Блума поверх bytearray с двойным хешированием (blake2b)."""
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + index * second) % self.size for index in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+def token_key(jti):
+    return f'jti:{jti}'
+
+
+def user_key(user_id):
+    return f'user:{user_id}'
+
+
+class RevocationList:
+    """Фильтр отзывов процесса и его синхронизация с таблицей RevokedToken."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filter = None
+        self._false_positives = set()
+        self._confirmed = {}
+        self._watermark = None
+        self._next_sync = 0.0
+        self._next_rebuild = 0.0
+
+    def _entries(self, since=None):
+        queryset = RevokedToken.objects.using(DEFAULT_DB_ALIAS).filter(expires_at__gt=timezone.now())
+        if since is not None:
+            queryset = queryset.filter(revoked_at__gte=since - SYNC_OVERLAP)
+        return queryset.values_list('key', 'revoked_at')
+
+    def _rebuild(self):
+        entries = list(self._entries())
+        options = settings.TOKEN_REVOCATION
+        bloom = BloomFilter(max(options['FILTER_CAPACITY'], 2 * len(entries)), options['FILTER_ERROR_RATE'])
+        for key, _ in entries:
+            bloom.add(key)
+        self._filter = bloom
+        self._false_positives = set()
+        self._confirmed = {}
+        self._watermark = max((revoked_at for _, revoked_at in entries), default=timezone.now())
+        # Пересборка удаляет из фильтра истекшие отзывы
+        self._next_rebuild = time.monotonic() + options['REBUILD_SECONDS']
+
+    def _sync(self):
+        for key, revoked_at in self._entries(since=self._watermark):
+            self._filter.add(key)
+            self._false_positives.discard(key)
+            # Запись могла измениться (повторный отзыв): подтверждается заново
+            self._confirmed.pop(key, None)
+            self._watermark = max(self._watermark, revoked_at)
+
+    def refresh(self, force=False):
+        """Дочитывает новые отзывы, если подошло время (или force)."""
+        now = time.monotonic()
+        if not force and self._filter is not None and now < self._next_sync:
+            return
+        # Пока один поток синхронизирует фильтр, остальные проверяют по текущему
+        if not self._lock.acquire(blocking=force or self._filter is None):
+            return
+        try:
+            if force or self._filter is None or now >= self._next_rebuild:
+                self._rebuild()
+            else:
+                self._sync()
+            self._next_sync = now + settings.TOKEN_REVOCATION['SYNC_SECONDS']
+        finally:
+            self._lock.release()
+
+    def remember(self, key):
+        """Добавляет отзыв в фильтр процесса сразу, не дожидаясь синхронизации."""
+        self.refresh()
+        with self._lock:
+            self._filter.add(key)
+            self._false_positives.discard(key)
+            self._confirmed.pop(key, None)
+
+    def might_contain(self, key):
+        self.refresh()
+        return key in self._filter and key not in self._false_positives
+
+    def confirm(self, key):
+        """Запись отзыва из БД для возможного попадания или None (ложное срабатывание)."""
+        entry = RevokedToken.objects.using(DEFAULT_DB_ALIAS).filter(key=key, expires_at__gt=timezone.now()).first()
+        if entry is None:
+            with self._lock:
+                self._false_positives.add(key)
+        return entry
+
+    def revoked_at(self, key):
+        """Время действующего отзыва по ключу или None; подтвержденные записи запоминаются."""
+        if not self.might_contain(key):
+            return None
+        cached = self._confirmed.get(key)
+        if cached is not None:
+            revoked_at, expires_at = cached
+            return revoked_at if expires_at > timezone.now() else None
+        entry = self.confirm(key)
+        if entry is None:
+            return None
+        with self._lock:
+            self._confirmed[key] = (entry.revoked_at, entry.expires_at)
+        return entry.revoked_at
+
+
+revocations = RevocationList()
+
+
+def _expiry(token):
+    return datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc)
+
+
+def _microseconds(moment):
+    return (moment - _EPOCH) // timedelta(microseconds=1)
+
+
+def stamp(token):
+    """
+    Записывает в новый токен время выдачи с точностью до микросекунды.
+    Access-токен, полученный из refresh-токена, копирует это поле.
+    """
+    token[ISSUED_AT_CLAIM] = _microseconds(token.current_time)
+    return token
+
+
+def is_revoked(token):
+    """Отозван ли проверенный токен (AccessToken/RefreshToken/UntypedToken)."""
+    jti = token.get(api_settings.JTI_CLAIM)
+    if jti and revocations.revoked_at(token_key(jti)) is not None:
+        return True
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    if user_id is None:
+        return False
+    revoked_at = revocations.revoked_at(user_key(user_id))
+    if revoked_at is None:
+        return False
+    issued_at = token.get(ISSUED_AT_CLAIM)
+    if issued_at is None:
+        # iat округлен до секунды: отозваны и токены, выданные в секунду отзыва
+        return token.get('iat', 0) <= revoked_at.timestamp()
+    return issued_at <= _microseconds(revoked_at)
+
+
+def revoke(token):
+    """Отзывает один токен до истечения его срока."""
+    key = token_key(token[api_settings.JTI_CLAIM])
+    RevokedToken.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        key=key,
+        defaults={
+            'user_id': token.get(api_settings.USER_ID_CLAIM),
+            'revoked_at': timezone.now(),
+            'expires_at': _expiry(token),
+        },
+    )
+    revocations.remember(key)
+
+
+def revoke_user(user_id):
+    """Отзывает токены пользователя, выданные до текущего момента."""
+    now = timezone.now()
+    lifetime = max(api_settings.ACCESS_TOKEN_LIFETIME, api_settings.REFRESH_TOKEN_LIFETIME)
+    key = user_key(user_id)
+    RevokedToken.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        key=key, defaults={'user_id': user_id, 'revoked_at': now, 'expires_at': now + lifetime},
+    )
+    revocations.remember(key)
+
+
+def purge_expired():
+    """Удаляет записи об отзыве, которые больше ничего не отзывают. Возвращает их число."""
+    deleted, _ = RevokedToken.objects.using(DEFAULT_DB_ALIAS).filter(expires_at__lte=timezone.now()).delete()
+    return deleted
@@ -0,0 +1,192 @@
+"""
+Предрасчитанные рейтинги и статистика продаж.
+
+Агрегаты обновляются инкрементально в той же транзакции, что и перевод
+или покупка, поэтому чтение топ-N — это выборка по индексу без GROUP BY.
+Строки пользователей обновляются под уже взятой блокировкой пользователя,
+а счетчик продаж товара разбит на части (SALES_SLOTS), чтобы покупки одного
+товара не упирались в одну строку. Полный пересчет выполняет команда
+rebuild_rollups.
+"""
+import heapq
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from merch_store import inventory
+from merch_store.models import Merch, MerchSales, Transaction, User, UserMonthlyStats, UserSpending
+from merch_store.sharding import shard_aliases, use_shard
+
+# Пользователей в одной транзакции пересчета
+REBUILD_CHUNK_SIZE = 1000
+SALES_SLOTS = 16
+
+
+def month_of(moment=None):
+    """Первое число месяца для момента времени (по умолчанию — текущего)."""
+    return timezone.localtime(moment).date().replace(day=1)
+
+
+def _increment(model, lookup, **deltas):
+    """Увеличивает счетчики строки агрегата, создавая ее при необходимости."""
+    obj, created = model.objects.get_or_create(**lookup, defaults=deltas)
+    if not created:
+        model.objects.filter(pk=obj.pk).update(**{
+            field: F(field) + delta for field, delta in deltas.items()
+        })
+
+
+def record_transfer(transaction_record, sent=True, received=True, sign=1):
+    """
+    Учитывает перевод монет в помесячной статистике отправителя и получателя.
+
+    При переводе между шардами каждая сторона учитывается на своем шарде
+    (sent=False или received=False); sign=-1 отменяет учтенный перевод.
+    """
+    month = month_of(transaction_record.maked_at)
+    amount = transaction_record.amount * sign
+    if sent:
+        _increment(UserMonthlyStats, {'user_id': transaction_record.sender_id, 'month': month}, sent=amount)
+    if received:
+        _increment(UserMonthlyStats, {'user_id': transaction_record.recipient_id, 'month': month}, received=amount)
+
+
+def sales_slot(user):
+    """Часть счетчика продаж, которую увеличивают покупки пользователя."""
+    return user.pk % SALES_SLOTS
+
+
+def record_purchase(user, merch, quantity=1):
+    """Учитывает покупку в тратах пользователя и продажах товара."""
+    total = merch.price * quantity
+    _increment(UserSpending, {'user_id': user.pk}, spent=total)
+    _increment(MerchSales, {'merch_id': merch.pk, 'slot': sales_slot(user)}, sold=quantity, revenue=total)
+
+
+def _top_per_shard(queryset, limit):
+    """
+    Топ-N по всем шардам: с каждого шарда берется его топ-N, результаты
+    сливаются. Строки пользователя есть только на его шарде, поэтому
+    глобальный топ-N целиком содержится в объединении локальных.
+    """
+    rows = []
+    for alias in shard_aliases():
+        rows.extend(queryset.using(alias)[:limit])
+    return heapq.nlargest(limit, rows, key=lambda row: row[1])
+
+
+def top_receivers(month, limit):
+    rows = _top_per_shard(UserMonthlyStats.objects
+                          .filter(month=month, received__gt=0)
+                          .order_by('-received')
+                          .values_list('user__email', 'received'), limit)
+    return [{"user": email, "amount": amount} for email, amount in rows]
+
+
+def top_spenders(limit):
+    rows = _top_per_shard(UserSpending.objects
+                          .filter(spent__gt=0)
+                          .order_by('-spent')
+                          .values_list('user__email', 'spent'), limit)
+    return [{"user": email, "amount": amount} for email, amount in rows]
+
+
+def top_merch(limit):
+    # Продажи товара разбиты на части, а при шардировании еще и распределены
+    # по всем шардам: суммируем целиком (строк — каталог на число частей)
+    totals = {}
+    for alias in shard_aliases():
+        sales = (MerchSales.objects.using(alias)
+                 .values_list('merch__name')
+                 .annotate(sold=Sum('sold'), revenue=Sum('revenue'))
+                 .order_by())
+        for name, sold, revenue in sales:
+            total = totals.setdefault(name, [0, 0])
+            total[0] += sold
+            total[1] += revenue
+    rows = heapq.nlargest(limit, ((name, sold, revenue) for name, (sold, revenue) in totals.items() if sold),
+                          key=lambda row: row[1])
+    return [{"type": name, "quantity": sold, "revenue": revenue} for name, sold, revenue in rows]
+
+
+def _user_chunks(using, chunk_size):
+    """id пользователей шарда (без теневых копий) пачками по возрастанию."""
+    users = User.objects.using(using).filter(is_shadow=False).order_by('pk').values_list('pk', flat=True)
+    last_id = 0
+    while user_ids := list(users.filter(pk__gt=last_id)[:chunk_size]):
+        yield user_ids
+        last_id = user_ids[-1]
+
+
+def _monthly_stats_of(user_ids, using):
+    """Помесячная статистика пользователей user_ids по их переводам."""
+    stats = {}
+    transactions = Transaction.objects.using(using).annotate(month=TruncMonth('maked_at')).order_by()
+    received = transactions.filter(recipient_id__in=user_ids).values_list('recipient_id', 'month')
+    for user_id, month, total in received.annotate(total=Sum('amount')):
+        stats[user_id, month] = UserMonthlyStats(user_id=user_id, month=month.date(), received=total)
+    sent = transactions.filter(sender_id__in=user_ids).values_list('sender_id', 'month')
+    for user_id, month, total in sent.annotate(total=Sum('amount')):
+        stats.setdefault((user_id, month), UserMonthlyStats(user_id=user_id, month=month.date())).sent = total
+    return list(stats.values())
+
+
+def _rebuild_users(user_ids, using):
+    """
+    Пересчитывает помесячную статистику и траты пачки пользователей.
+
+    Строки пользователей блокируются, как при переводе и покупке, поэтому
+    их агрегаты не меняются между чтением источников и записью результата,
+    а остальные пользователи работают без ожидания.
+    """
+    with transaction.atomic(using=using):
+        list(User.objects.using(using).select_for_update().filter(pk__in=user_ids).values_list('pk', flat=True))
+        stats = _monthly_stats_of(user_ids, using)
+        spending = [UserSpending(user_id=user_id, spent=spent)
+                    for user_id, spent in inventory.spent_by(user_ids, using).items() if spent]
+        UserMonthlyStats.objects.using(using).filter(user_id__in=user_ids).delete()
+        UserMonthlyStats.objects.using(using).bulk_create(stats)
+        UserSpending.objects.using(using).filter(user_id__in=user_ids).delete()
+        UserSpending.objects.using(using).bulk_create(spending)
+    return len(stats), len(spending)
+
+
+def _rebuild_merch_sales(merch, using):
+    """
+    Пересчитывает продажи товара: итог пишется в нулевую часть, остальные обнуляются.
+
+    Части блокируются до подсчета. Покупка, уже увеличившая часть, успевает
+    зафиксироваться и попадает в подсчет; покупка, которая еще не дошла до
+    счетчика, ждет конца пересчета и прибавляет себя к новому итогу.
+    Строки частей не удаляются, чтобы такие покупки не потеряли свое обновление.
+    """
+    sales = MerchSales.objects.using(using).filter(merch_id=merch.pk)
+    with transaction.atomic(using=using):
+        list(sales.select_for_update().order_by('slot').values_list('pk', flat=True))
+        sold, revenue = inventory.sales_of(merch, using)
+        sales.exclude(slot=0).update(sold=0, revenue=0)
+        if sold or sales.filter(slot=0).exists():
+            sales.update_or_create(merch_id=merch.pk, slot=0, defaults={'sold': sold, 'revenue': revenue})
+    return 1 if sold else 0
+
+
+def rebuild(using=DEFAULT_DB_ALIAS, chunk_size=REBUILD_CHUNK_SIZE):
+    """
+    Пересчитывает агрегаты шарда using из Transaction и инвентаря
+    (строк Inventory или карт UserInventory, см. inventory.py).
+
+    Пересчет идет короткими транзакциями — по пачке пользователей и по
+    одному товару — и безопасен при работающих переводах и покупках.
+    Траты и продажи считаются по ценам на момент покупки.
+    """
+    counts = {'monthly_stats': 0, 'spending': 0, 'merch_sales': 0}
+    with use_shard(using):
+        for user_ids in _user_chunks(using, chunk_size):
+            stats, spending = _rebuild_users(user_ids, using)
+            counts['monthly_stats'] += stats
+            counts['spending'] += spending
+        for merch in Merch.objects.using(using).order_by('pk'):
+            counts['merch_sales'] += _rebuild_merch_sales(merch, using)
+    return counts
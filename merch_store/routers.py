@@ -0,0 +1,123 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+# Алиас реплики, выбранный для текущего запроса (или None — читаем с основной БД)
+_read_alias = ContextVar('merch_store_read_alias', default=None)
+
+
+def _pin_key(user_id):
+    return f'merch_store:primary-pin:{user_id}'
+
+
+def pin_to_primary(user):
+    """
+    Закрепляет пользователя за основной БД на REPLICA_PIN_SECONDS секунд.
+
+    Вызывается после записи (перевод монет, покупка), чтобы пользователь
+    не увидел собственный устаревший баланс из отстающей реплики.
+    """
+    if settings.DATABASE_REPLICAS:
+        cache.set(_pin_key(user.pk), True, timeout=settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned_to_primary(user):
+    return bool(user and user.pk and cache.get(_pin_key(user.pk)))
+
+
+def choose_read_alias(user=None):
+    """Возвращает алиас БД для чтения данных пользователя."""
+    replicas = settings.DATABASE_REPLICAS
+    if not replicas or is_pinned_to_primary(user):
+        return DEFAULT_DB_ALIAS
+    return random.choice(replicas)
+
+
+def current_read_alias():
+    """Алиас, выбранный блоком read_replica() (вне блока — основная БД)."""
+    return _read_alias.get() or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def read_replica(user=None):
+    """
+    Направляет все чтения внутри блока на реплику.
+
+    Используется только в эндпойнтах, которые ничего не пишут (например,
+    InfoAPIView). Если пользователь недавно что-то изменил, чтения остаются
+    на основной БД.
+    """
+    token = _read_alias.set(choose_read_alias(user))
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+class ReplicaRouter:
+    """
+    Роутер основная БД / реплики.
+
+    Записи и чтения по умолчанию идут в основную БД. На реплику чтения
+    направляются только внутри блока read_replica().
+    """
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же данные, что и основная БД
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ShardRouter:
+    """
+    Роутер шардов. Ставится в DATABASE_ROUTERS перед ReplicaRouter.
+
+    Справочник пользователей всегда в основной БД. Остальные запросы идут
+    на БД связанного объекта (например, user.inventory — на шард user)
+    или на шард, выбранный блоком sharding.use_shard(). В остальных случаях
+    решение принимает следующий роутер.
+    """
+    directory_model = 'userdirectory'
+
+    def _db_for(self, model, instance=None, **hints):
+        from merch_store.sharding import current_shard, is_sharded
+
+        if model._meta.model_name == self.directory_model:
+            return DEFAULT_DB_ALIAS
+        if not is_sharded():
+            return None
+        if instance is not None:
+            if instance._state.db:
+                return instance._state.db
+            for related in instance._state.fields_cache.values():
+                if related is not None and related._state.db:
+                    return related._state.db
+        return current_shard()
+
+    def db_for_read(self, model, **hints):
+        return self._db_for(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._state.db in settings.DATABASE_SHARDS and obj2._state.db in settings.DATABASE_SHARDS:
+            return obj1._state.db == obj2._state.db
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if model_name == self.directory_model:
+            return db == DEFAULT_DB_ALIAS
+        return None
@@ -1,6 +1,9 @@
 from rest_framework import serializers
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
 from rest_framework_simplejwt.tokens import RefreshToken
 
+from merch_store import revocation
 from merch_store.models import User, Transaction
 
 
@@ -14,7 +17,7 @@ class CreateUserSerializer(serializers.ModelSerializer):
 
     def get_token(self, user):
         """Выдает токен пользователю"""
-        refresh = RefreshToken.for_user(user)
+        refresh = revocation.stamp(RefreshToken.for_user(user))
         return {
             "refresh": str(refresh),
             "access": str(refresh.access_token),
@@ -65,3 +68,12 @@ class UserSerializer(serializers.ModelSerializer):
         all_transactions = list(sent) + list(received)
         sorted_transactions = sorted(all_transactions, key=lambda t: t.created_at, reverse=True)
         return TransactionSerializer(sorted_transactions, many=True).data
+
+
+class RevocableTokenRefreshSerializer(TokenRefreshSerializer):
+    """Обновление access-токена, которое отклоняет отозванный refresh-токен"""
+
+    def validate(self, attrs):
+        if revocation.is_revoked(self.token_class(attrs['refresh'])):
+            raise InvalidToken('Token has been revoked')
+        return super().validate(attrs)
@@ -0,0 +1,220 @@
+"""
+Горизонтальное шардирование пользователей.
+
+Данные пользователя (User, Inventory, Transaction и агрегаты) хранятся на
+одном шарде — алиасе из settings.DATABASE_SHARDS. Новый пользователь
+размещается по хешу email, а фактическое размещение и глобально уникальный
+id хранятся в справочнике UserDirectory в основной БД.
+
+Если задан только шард 'default', шардирование выключено и все функции
+сводятся к работе с основной БД без обращений к справочнику.
+"""
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.models.functions import Lower
+from django.db.models.lookups import Exact
+
+from merch_store.models import Merch, User, UserDirectory
+
+DIRECTORY_CACHE_TIMEOUT = 300
+
+# Шард, с которым работает текущий запрос (или None — основная БД)
+_current_shard = ContextVar('merch_store_shard', default=None)
+
+
+def shard_aliases():
+    return settings.DATABASE_SHARDS
+
+
+def is_sharded():
+    return len(settings.DATABASE_SHARDS) > 1
+
+
+def shard_for_email(email):
+    """Шард для размещения нового пользователя (стабильный хеш email)."""
+    aliases = shard_aliases()
+    return aliases[zlib.crc32(email.strip().lower().encode()) % len(aliases)]
+
+
+def current_shard():
+    return _current_shard.get()
+
+
+@contextmanager
+def use_shard(alias):
+    """Направляет запросы без явного using() внутри блока на указанный шард."""
+    token = _current_shard.set(alias)
+    try:
+        yield alias
+    finally:
+        _current_shard.reset(token)
+
+
+def _cache_key(kind, value):
+    return f'merch_store:shard:{kind}:{value}'
+
+
+def _remember(entry):
+    cache.set_many({
+        _cache_key('email', entry.email.lower()): entry.shard,
+        _cache_key('id', entry.pk): entry.shard,
+    }, timeout=DIRECTORY_CACHE_TIMEOUT)
+    return entry.shard
+
+
+def _directory():
+    return UserDirectory.objects.using(DEFAULT_DB_ALIAS)
+
+
+def email_is(email):
+    """
+    Условие «email совпадает без учета регистра». Сравнивает Lower('email'), поэтому
+    использует уникальные индексы unique_user_email_ci и unique_directory_email_ci
+    (email__iexact в PostgreSQL сравнивает UPPER и индекс не использует).
+    """
+    return Exact(Lower('email'), email.lower())
+
+
+def _locate(kind, value, *conditions, **lookup):
+    if not is_sharded():
+        return DEFAULT_DB_ALIAS
+    shard = cache.get(_cache_key(kind, value))
+    if shard:
+        return shard
+    entry = _directory().filter(*conditions, **lookup).first()
+    if entry is None:
+        # Пользователь мог быть создан в основной БД в обход справочника
+        user = User.objects.using(DEFAULT_DB_ALIAS).filter(*conditions, is_shadow=False, **lookup).first()
+        if user is None:
+            return None
+        entry, _ = _directory().get_or_create(
+            email=user.email, defaults={'id': user.pk, 'shard': DEFAULT_DB_ALIAS}
+        )
+    return _remember(entry)
+
+
+def locate(email):
+    """Шард пользователя по email (без учета регистра) или None, если пользователя нет."""
+    return _locate('email', email.lower(), email_is(email))
+
+
+def locate_id(user_id):
+    """Шард пользователя по глобальному id или None, если пользователя нет."""
+    return _locate('id', user_id, id=user_id)
+
+
+def get_user(email):
+    """Загружает пользователя с его шарда. Бросает User.DoesNotExist."""
+    shard = locate(email)
+    if shard is None:
+        raise User.DoesNotExist
+    return User.objects.using(shard).get(email_is(email), is_shadow=False)
+
+
+def get_user_by_id(user_id):
+    shard = locate_id(user_id)
+    if shard is None:
+        raise User.DoesNotExist
+    return User.objects.using(shard).get(pk=user_id, is_shadow=False)
+
+
+def register(email, shard):
+    """
+    Регистрирует пользователя в справочнике и возвращает запись с его глобальным id.
+
+    Повторная регистрация возвращает существующую запись (например, если
+    предыдущая попытка создать пользователя на шарде не завершилась).
+    """
+    try:
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            entry = _directory().create(email=email, shard=shard)
+    except IntegrityError:
+        entry = _directory().get(email_is(email))
+    _remember(entry)
+    return entry
+
+
+def allocate_user_id(user, using):
+    """
+    Выдает новому пользователю глобальный id из справочника.
+
+    Вызывается перед сохранением нового пользователя (см. signals.py),
+    поэтому любой способ создания пользователя на шарде получает id без коллизий.
+    """
+    entry = register(user.email, using)
+    if entry.shard != using:
+        raise IntegrityError(f'Пользователь {user.email} уже размещен на шарде {entry.shard}.')
+    user.pk = entry.pk
+
+
+def ensure_shadow(user, alias):
+    """
+    Создает на шарде alias теневую копию пользователя с другого шарда.
+
+    Теневая копия нужна, чтобы запись Transaction на этом шарде ссылалась
+    на существующую строку User. Баланс теневой копии всегда равен нулю.
+    """
+    if user._state.db == alias:
+        return user
+    shadow, _ = User.objects.using(alias).get_or_create(
+        pk=user.pk,
+        defaults={'email': user.email, 'is_shadow': True, 'is_active': False,
+                  'coins': 0, 'password': '!'},
+    )
+    return shadow
+
+
+def sync_directory(using=DEFAULT_DB_ALIAS):
+    """
+    Заносит в справочник пользователей шарда, которых в нем нет,
+    и сдвигает последовательность id справочника за максимальный id.
+
+    Нужно выполнить перед включением шардирования, если пользователи
+    создавались после миграции 0010.
+    """
+    added, last_id = 0, 0
+    users = User.objects.using(using).filter(is_shadow=False).order_by('id')
+    while chunk := list(users.filter(id__gt=last_id).values_list('id', 'email')[:5000]):
+        last_id = chunk[-1][0]
+        known = set(_directory().filter(id__in=[user_id for user_id, _ in chunk]).values_list('id', flat=True))
+        missing = [UserDirectory(id=user_id, email=email, shard=using)
+                   for user_id, email in chunk if user_id not in known]
+        _directory().bulk_create(missing)
+        added += len(missing)
+    connection = connections[DEFAULT_DB_ALIAS]
+    with connection.cursor() as cursor:
+        for statement in connection.ops.sequence_reset_sql(no_style(), [UserDirectory]):
+            cursor.execute(statement)
+    return added
+
+
+def sync_catalog():
+    """
+    Копирует каталог товаров из основной БД на остальные шарды с теми же id.
+
+    Инвентарь на шарде ссылается на локальную строку Merch, а остатки
+    хранятся в основной БД по id товара, поэтому id должны совпадать.
+    """
+    catalog = list(Merch.objects.using(DEFAULT_DB_ALIAS).order_by('id'))
+    synced = {}
+    for alias in shard_aliases():
+        if alias == DEFAULT_DB_ALIAS:
+            continue
+        with transaction.atomic(using=alias):
+            for merch in catalog:
+                Merch.objects.using(alias).update_or_create(
+                    pk=merch.pk,
+                    defaults={'name': merch.name, 'price': merch.price, 'is_limited': merch.is_limited},
+                )
+            connection = connections[alias]
+            with connection.cursor() as cursor:
+                for statement in connection.ops.sequence_reset_sql(no_style(), [Merch]):
+                    cursor.execute(statement)
+        synced[alias] = len(catalog)
+    return synced
@@ -1,13 +1,16 @@
-from django.db.models.signals import post_migrate
+from django.db.models.signals import post_migrate, pre_save
 from django.dispatch import receiver
-from merch_store.models import Merch
+from merch_store.models import Merch, User
+from merch_store import sharding
 
 @receiver(post_migrate)
 def create_initial_merch_data(sender, **kwargs):
     # Replace 'myapp' with your actual app name
     if sender.name == 'merch_store':
+        # Каталог заполняется на каждом шарде, для которого выполнены миграции
+        using = kwargs.get('using', 'default')
         # Check if the data already exists to avoid duplicates
-        if not Merch.objects.exists():
+        if not Merch.objects.using(using).exists():
             initial_data = [
                 {'name': 't-shirt', 'price': 80},
                 {'name': 'cup', 'price': 20},
@@ -21,4 +24,11 @@ def create_initial_merch_data(sender, **kwargs):
                 {'name': 'pink-hoody', 'price': 500},
             ]
             for item in initial_data:
-                Merch.objects.create(**item)
\ No newline at end of file
+                Merch.objects.using(using).create(**item)
+
+
+@receiver(pre_save, sender=User)
+def allocate_global_user_id(sender, instance, using, **kwargs):
+    """При шардировании новый пользователь получает id из справочника в основной БД."""
+    if sharding.is_sharded() and instance.pk is None and not instance.is_shadow:
+        sharding.allocate_user_id(instance, using)
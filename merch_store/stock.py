@@ -0,0 +1,72 @@
+"""
+Остатки товаров ограниченного тиража.
+
+Остаток товара разбит на несколько частей (MerchStockBucket). Покупка
+списывает единицу условным UPDATE ... WHERE remaining > 0 в случайно
+выбранной непустой части, поэтому одновременные покупатели в основном
+блокируют разные строки, а продать больше остатка невозможно.
+
+При шардировании остатки хранятся только в основной БД: это единый
+источник правды для всех шардов. Покупка на другом шарде списывает единицу
+отдельной транзакцией и при неудаче возвращает ее через release_unit().
+"""
+import random
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F, Sum
+
+from merch_store.models import Merch, MerchStockBucket
+from merch_store.sharding import shard_aliases
+
+DEFAULT_BUCKETS = 16
+
+
+def _buckets():
+    return MerchStockBucket.objects.using(DEFAULT_DB_ALIAS)
+
+
+@transaction.atomic(using=DEFAULT_DB_ALIAS)
+def add_stock(merch, quantity, buckets=DEFAULT_BUCKETS):
+    """Добавляет товару остаток, равномерно распределяя его по частям."""
+    share, extra = divmod(quantity, buckets)
+    for slot in range(buckets):
+        amount = share + (1 if slot < extra else 0)
+        bucket, created = _buckets().get_or_create(
+            merch_id=merch.pk, slot=slot, defaults={'remaining': amount}
+        )
+        if not created and amount:
+            _buckets().filter(pk=bucket.pk).update(remaining=F('remaining') + amount)
+    if not merch.is_limited:
+        # Каталог продублирован на всех шардах
+        for alias in shard_aliases():
+            Merch.objects.using(alias).filter(pk=merch.pk).update(is_limited=True)
+        merch.is_limited = True
+
+
+def remaining_stock(merch):
+    return _buckets().filter(merch_id=merch.pk).aggregate(total=Sum('remaining'))['total'] or 0
+
+
+def reserve_unit(merch):
+    """
+    Списывает одну единицу товара в текущей транзакции.
+
+    Возвращает False, если товар закончился. При откате транзакции
+    списание отменяется вместе с ней.
+    """
+    slots = list(_buckets().filter(merch_id=merch.pk, remaining__gt=0).values_list('slot', flat=True))
+    random.shuffle(slots)
+    for slot in slots:
+        if _buckets().filter(merch_id=merch.pk, slot=slot, remaining__gt=0).update(
+                remaining=F('remaining') - 1):
+            return True
+    return False
+
+
+def release_unit(merch):
+    """Возвращает в остаток единицу, списанную reserve_unit() в уже зафиксированной транзакции."""
+    slots = list(_buckets().filter(merch_id=merch.pk).values_list('slot', flat=True))
+    if not slots:
+        return False
+    return _buckets().filter(merch_id=merch.pk, slot=random.choice(slots)).update(
+        remaining=F('remaining') + 1) == 1
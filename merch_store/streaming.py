@@ -0,0 +1,207 @@
+"""
+Потоковая доставка изменений баланса и инвентаря клиенту.
+
+Два транспорта поверх одного брокера (events.py):
+
+  * Server-Sent Events: GET /api/events — асинхронное представление Django.
+    Первое событие ready содержит текущий баланс, затем приходят дельты
+    transfer, purchase, refund и resync (клиент должен перечитать /api/info).
+    Соединение закрывается сервером через EVENTS_STREAM_SECONDS, EventSource
+    переподключается сам: Django 4.2 не сообщает потоковому ответу об уходе
+    клиента, и ограничение времени не дает копиться брошенным подпискам.
+  * WebSocket: /api/events/ws — обработчик ASGI (см. config/asgi.py),
+    те же события в виде JSON-сообщений. Через EVENTS_STREAM_SECONDS сервер
+    закрывает соединение с кодом 4408, и клиент подключается заново с новым
+    билетом: так отзыв токенов и блокировка пользователя применяются и к
+    открытым соединениям.
+
+Оба транспорта работают только под ASGI-сервером (gunicorn с воркерами uvicorn,
+см. config/gunicorn.conf.py), не под WSGI.
+
+Клиент передает access-токен в заголовке Authorization. Браузерные EventSource
+и WebSocket не умеют задавать заголовки, а токен в URL попадает в логи
+прокси и сервера, поэтому для них клиент сначала получает билет потока
+(POST /api/events/ticket) и передает его в параметре ticket. Билет подписан,
+действует EVENTS_TICKET_SECONDS секунд, подходит только для открытия потока
+событий и принимается один раз.
+"""
+import asyncio
+import json
+import secrets
+import time
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+from merch_store import sharding
+from merch_store.authentication import ShardedJWTAuthentication
+from merch_store.events import get_broker
+from merch_store.models import User
+
+WEBSOCKET_PATH = '/api/events/ws'
+RECONNECT_MS = 3000
+# Коды закрытия WebSocket из диапазона приложения (4000-4999)
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_NOT_FOUND = 4404
+CLOSE_EXPIRED = 4408
+
+
+def _authenticate(raw_token):
+    """Пользователь по access-токену или None."""
+    if not raw_token:
+        return None
+    authentication = ShardedJWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return None
+
+
+TICKET_SALT = 'merch_store.streaming.ticket'
+
+
+def issue_ticket(user):
+    """Одноразовый билет для открытия потока событий пользователя."""
+    return signing.dumps({'user': user.pk, 'nonce': secrets.token_urlsafe(16)}, salt=TICKET_SALT)
+
+
+def _redeem_ticket(ticket):
+    """Пользователь по билету или None, если билет недействителен, истек или уже использован."""
+    if not ticket:
+        return None
+    lifetime = settings.EVENTS_TICKET_SECONDS
+    try:
+        claims = signing.loads(ticket, salt=TICKET_SALT, max_age=lifetime)
+    except signing.BadSignature:
+        return None
+    # Билет принимается один раз (во всех процессах — при общем кэше)
+    if not cache.add(f"merch_store:stream_ticket:{claims['nonce']}", True, timeout=lifetime):
+        return None
+    try:
+        user = sharding.get_user_by_id(claims['user'])
+    except User.DoesNotExist:
+        return None
+    return user if user.is_active else None
+
+
+authenticate = sync_to_async(_authenticate)
+redeem_ticket = sync_to_async(_redeem_ticket)
+
+
+def _bearer(header):
+    parts = (header or '').split()
+    if len(parts) == 2 and parts[0] in settings.SIMPLE_JWT.get('AUTH_HEADER_TYPES', ('Bearer',)):
+        return parts[1]
+    return None
+
+
+def format_event(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+async def sse_stream(user, subscription, heartbeat=None, lifetime=None):
+    """Поток SSE: событие ready, дельты и комментарии-пульс при простое."""
+    heartbeat = heartbeat or settings.EVENTS_HEARTBEAT_SECONDS
+    deadline = time.monotonic() + (lifetime or settings.EVENTS_STREAM_SECONDS)
+    try:
+        yield f"retry: {RECONNECT_MS}\n"
+        yield format_event({'type': 'ready', 'balance': user.coins})
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                event = await asyncio.wait_for(subscription.get(), min(heartbeat, remaining))
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield format_event(event)
+    finally:
+        subscription.close()
+
+
+async def event_stream_view(request):
+    """
+    Эндпойнт потока событий пользователя (Server-Sent Events).
+
+    URL: /api/events
+    Метод: GET
+    Заголовки: Authorization: Bearer <access-токен> или параметр ?ticket=<билет из /api/events/ticket>
+
+    Ответ 200: text/event-stream, события ready, transfer, purchase, refund, resync.
+    Пример события:
+        event: purchase
+        data: {"type": "purchase", "balance": 920, "inventory": {"type": "t-shirt", "quantity": 2}}
+    Ответ 401: токен или билет не передан или недействителен.
+    Ответ 501: сервер запущен без ASGI.
+    """
+    if request.method != 'GET':
+        return JsonResponse({"errors": "Метод не поддерживается."}, status=405)
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({"errors": "Поток событий доступен только через ASGI-сервер."}, status=501)
+
+    token = _bearer(request.headers.get('Authorization'))
+    user = await authenticate(token) if token else await redeem_ticket(request.GET.get('ticket'))
+    if user is None:
+        return JsonResponse({"errors": "Требуется действительный access-токен или билет потока."}, status=401)
+
+    response = StreamingHttpResponse(
+        sse_stream(user, get_broker().subscribe(user.pk)),
+        content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    # nginx не должен буферизовать поток
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def _scope_user(scope):
+    headers = dict(scope.get('headers') or [])
+    token = _bearer(headers.get(b'authorization', b'').decode('latin-1'))
+    if token:
+        return await authenticate(token)
+    return await redeem_ticket((parse_qs(scope.get('query_string', b'').decode()).get('ticket') or [None])[0])
+
+
+async def websocket_application(scope, receive, send):
+    """Обработчик ASGI для WebSocket /api/events/ws."""
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    if scope['path'].rstrip('/') != WEBSOCKET_PATH:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+    user = await _scope_user(scope)
+    if user is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+
+    subscription = get_broker().subscribe(user.pk)
+    await send({'type': 'websocket.accept'})
+
+    async def forward():
+        await send({'type': 'websocket.send', 'text': json.dumps({'type': 'ready', 'balance': user.coins})})
+        while True:
+            event = await subscription.get()
+            await send({'type': 'websocket.send', 'text': json.dumps(event)})
+
+    async def wait_disconnect():
+        # Сообщения клиента не нужны: ждем только закрытия соединения
+        while (await receive())['type'] != 'websocket.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(forward()), asyncio.ensure_future(wait_disconnect())]
+    try:
+        # Пользователь проверен только при подключении, поэтому время соединения ограничено
+        done, _ = await asyncio.wait(tasks, timeout=settings.EVENTS_STREAM_SECONDS,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            await send({'type': 'websocket.close', 'code': CLOSE_EXPIRED})
+    finally:
+        subscription.close()
+        for task in tasks:
+            task.cancel()
@@ -1,14 +1,54 @@
+import asyncio
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, IntegrityError, OperationalError, connection, connections, transaction
+from django.db.models import Sum
+from django.test import AsyncClient, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.test import APIRequestFactory, APITestCase, APITransactionTestCase, force_authenticate
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
 
-from merch_store.models import Merch, Inventory, Transaction
+from config.warmup import STARTUP_METRICS, preload, warm_up
+from merch_store import events, exports, grants, inventory, outbox, provisioning, reconciliation, retry, revocation, \
+    rollups, sharding, stock, streaming, transfers
+from merch_store.admin import EstimatedCountPaginator
+from merch_store.models import Merch, Inventory, Transaction, MerchSales, MerchStockBucket, OutboxEvent, \
+    CoinGrant, CoinGrantCredit, ProvisioningJob, RevokedToken, ShardTransfer, UserDirectory, UserInventory, \
+    UserMonthlyStats, UserSpending
+from merch_store.routers import ReplicaRouter, pin_to_primary, read_replica
+from merch_store.streaming import sse_stream, websocket_application
+from merch_store.views import BuyItemAPIView, LeaderboardAPIView, SendCoinAPIView
 
 User = get_user_model()
 
 
 class AuthAPITests(APITestCase):
+    # С шардированием код обращается ко всем шардам
+    databases = {"default", *settings.DATABASE_SHARDS}
+
     def setUp(self):
         self.url = reverse("merch_store:auth")
         self.user_data = {
@@ -26,7 +66,7 @@ class AuthAPITests(APITestCase):
         response = self.client.post(self.url, self.user_data, format="json")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn("token", response.data)
-        self.assertTrue(User.objects.filter(email=self.user_data["username"]).exists())
+        self.assertEqual(sharding.get_user(self.user_data["username"]).email, self.user_data["username"])
 
     def test_auth_wrong_password(self):
         # Create a user first and try to login with wrong password
@@ -199,3 +239,1468 @@ class BuyItemAPITests(APITestCase):
         inventory = Inventory.objects.filter(user=self.user, merch=self.merch_item).first()
         self.assertIsNotNone(inventory)
         self.assertEqual(inventory.quantity, 2)
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class ReplicaRouterTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = ReplicaRouter()
+        self.user = User.objects.create(email="reader@example.com")
+        self.recipient = User.objects.create(email="friend@example.com")
+        self.client.force_authenticate(user=self.user)
+
+    def test_reads_outside_block_use_primary(self):
+        self.assertEqual(self.router.db_for_read(Transaction), "default")
+
+    def test_reads_inside_block_use_replica(self):
+        with read_replica(self.user):
+            self.assertEqual(self.router.db_for_read(Transaction), "replica")
+            self.assertEqual(self.router.db_for_write(Transaction), "default")
+        self.assertEqual(self.router.db_for_read(Transaction), "default")
+
+    def test_replicas_are_not_migrated(self):
+        self.assertFalse(self.router.allow_migrate("replica", "merch_store"))
+        self.assertTrue(self.router.allow_migrate("default", "merch_store"))
+
+    def test_user_pinned_to_primary_after_send_coin(self):
+        response = self.client.post(reverse("merch_store:send_coin"),
+                                    {"toUser": self.recipient.email, "amount": 10}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with read_replica(self.user):
+            self.assertEqual(self.router.db_for_read(Transaction), "default")
+        # Other users still read from the replica
+        with read_replica(self.recipient):
+            self.assertEqual(self.router.db_for_read(Transaction), "replica")
+
+
+# Зеркало основной БД, которое добавляет config.settings_test
+TEST_REPLICA_ALIAS = getattr(settings, "TEST_REPLICA_ALIAS", "replica_test")
+
+
+@unittest.skipUnless(TEST_REPLICA_ALIAS in settings.DATABASES,
+                     "test replica alias is only added by config.settings_test")
+@unittest.skipIf(sharding.is_sharded(), "replicas mirror only the default database")
+@override_settings(DATABASE_REPLICAS=[TEST_REPLICA_ALIAS])
+class ReplicaAliasTests(APITransactionTestCase):
+    """Чтения с настоящего второго алиаса (зеркало основной тестовой БД)."""
+    databases = {"default", TEST_REPLICA_ALIAS}
+
+    def setUp(self):
+        cache.clear()
+        self.replica = connections[TEST_REPLICA_ALIAS]
+        self.user = User.objects.create(email="reader@example.com", coins=900)
+        self.sender = User.objects.create(email="sender@example.com")
+        Transaction.objects.create(sender=self.sender, recipient=self.user, amount=100)
+        self.client.force_authenticate(user=self.user)
+
+    def test_info_reads_balance_and_history_from_replica(self):
+        with CaptureQueriesContext(connection) as primary, CaptureQueriesContext(self.replica) as replica:
+            response = self.client.get(reverse("merch_store:user_info"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["coins"], 900)
+        self.assertEqual(response.data["coinHistory"]["received"][0]["amount"], 100)
+        replica_sql = " ".join(query["sql"] for query in replica.captured_queries)
+        self.assertIn('"coins"', replica_sql)
+        self.assertIn(Transaction._meta.db_table, replica_sql)
+        self.assertNotIn(Transaction._meta.db_table, " ".join(query["sql"] for query in primary.captured_queries))
+
+    def test_pinned_user_reads_primary(self):
+        pin_to_primary(self.user)
+        with CaptureQueriesContext(self.replica) as replica:
+            response = self.client.get(reverse("merch_store:user_info"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(replica.captured_queries), 0)
+
+
+class TransactionExportAPITests(APITestCase):
+    # С шардированием выгрузка читает все шарды
+    databases = {"default", *settings.DATABASE_SHARDS}
+
+    def setUp(self):
+        self.staff = User.objects.create(email="finance@example.com", is_staff=True)
+        self.alice = User.objects.create(email="alice@example.com")
+        self.bob = User.objects.create(email="bob@example.com")
+        Transaction.objects.create(sender=self.alice, recipient=self.bob, amount=10)
+        Transaction.objects.create(sender=self.bob, recipient=self.staff, amount=20)
+        self.url = reverse("merch_store:transaction_export")
+        self.client.force_authenticate(user=self.staff)
+
+    def _lines(self, response):
+        return b"".join(response.streaming_content).decode().splitlines()
+
+    def test_export_requires_staff(self):
+        self.client.force_authenticate(user=self.alice)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_export_ndjson(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = [json.loads(line) for line in self._lines(response)]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]["sender"], self.alice.email)
+        self.assertEqual(rows[0]["recipient"], self.bob.email)
+        self.assertEqual(rows[0]["amount"], 10)
+
+    def test_export_csv_filtered_by_user(self):
+        response = self.client.get(self.url, {"output": "csv", "user": self.alice.email})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = self._lines(response)
+        self.assertEqual(lines[0], "sender,recipient,amount,maked_at")
+        self.assertEqual(len(lines), 2)
+
+    def test_export_pages_by_id_without_server_side_cursors(self):
+        Transaction.objects.create(sender=self.staff, recipient=self.alice, amount=30)
+        queryset = exports.export_queryset()
+        with mock.patch.dict(connections[queryset.db].settings_dict, {"DISABLE_SERVER_SIDE_CURSORS": True}), \
+                CaptureQueriesContext(connection) as queries:
+            rows = list(exports.iter_rows(queryset, chunk_size=2))
+        self.assertEqual([row[2] for row in rows], [10, 20, 30])
+        self.assertEqual(len(queries), 2)
+
+    def test_export_date_range(self):
+        response = self.client.get(self.url, {"until": "2000-01-01"})
+        self.assertEqual(self._lines(response), [])
+
+    def test_export_invalid_params(self):
+        response = self.client.get(self.url, {"output": "xml"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(self.url, {"since": "yesterday"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_export_is_async_under_asgi(self):
+        token = await sync_to_async(lambda: str(AccessToken.for_user(self.staff)))()
+        # По строке в порции: видно, что ответ отдается порциями, а не собирается целиком
+        with mock.patch("merch_store.views.aiter_chunks",
+                        side_effect=lambda lines: exports.aiter_chunks(lines, chunk_size=1)):
+            response = await AsyncClient().get(self.url, headers={"Authorization": f"Bearer {token}"})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.is_async)
+            chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual([json.loads(chunk)["amount"] for chunk in chunks], [10, 20])
+
+    def test_export_command(self):
+        out = StringIO()
+        call_command("export_transactions", "--format", "csv", "--user", self.staff.email, stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+
+class TransactionAdminTests(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create(email="root@example.com", is_staff=True, is_superuser=True)
+        self.client.force_login(self.admin)
+        self.url = reverse("admin:merch_store_transaction_changelist")
+
+    def _create_transactions(self, count):
+        start = Transaction.objects.count()
+        for index in range(start, start + count):
+            sender = User.objects.create(email=f"s{index}@example.com")
+            recipient = User.objects.create(email=f"r{index}@example.com")
+            Transaction.objects.create(sender=sender, recipient=recipient, amount=1)
+
+    def _changelist_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        self._create_transactions(2)
+        few = self._changelist_queries()
+        self._create_transactions(10)
+        self.assertEqual(self._changelist_queries(), few)
+
+    def test_changelist_search_and_date_filter(self):
+        self._create_transactions(3)
+        response = self.client.get(self.url, {"q": "s1@example.com"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.context["cl"].result_count, 1)
+        response = self.client.get(self.url, {"q": "r1@example.com"})
+        self.assertEqual(response.context["cl"].result_count, 1)
+        response = self.client.get(self.url, {"q": "nobody@example.com"})
+        self.assertEqual(response.context["cl"].result_count, 0)
+        since = timezone.now() - timedelta(days=1)
+        response = self.client.get(self.url, {"maked_at__gte": str(since)})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.context["cl"].result_count, 3)
+
+    def test_search_filters_by_user_id(self):
+        self._create_transactions(1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url, {"q": "s0@example.com"})
+        transaction_table = f'FROM "{Transaction._meta.db_table}"'
+        filters = [query["sql"].split("WHERE", 1)[1] for query in queries.captured_queries
+                   if transaction_table in query["sql"] and "WHERE" in query["sql"]]
+        self.assertTrue(filters)
+        for where in filters:
+            self.assertNotIn('"email"', where)
+
+    def test_paginator_counts_exactly_without_statistics(self):
+        self._create_transactions(3)
+        paginator = EstimatedCountPaginator(Transaction.objects.order_by("id"), 100)
+        self.assertEqual(paginator.count, 3)
+
+
+class LeaderboardAPITests(APITestCase):
+    # С шардированием код обращается ко всем шардам
+    databases = {"default", *settings.DATABASE_SHARDS}
+
+    def setUp(self):
+        self.alice = User.objects.create(email="alice@example.com")
+        self.bob = User.objects.create(email="bob@example.com")
+        self.carol = User.objects.create(email="carol@example.com")
+        self.sticker = Merch.objects.create(name="sticker", price=5)
+        self.client.force_authenticate(user=self.alice)
+
+    def _send(self, sender, recipient, amount):
+        self.client.force_authenticate(user=sender)
+        self.client.post(reverse("merch_store:send_coin"),
+                         {"toUser": recipient.email, "amount": amount}, format="json")
+
+    def _buy(self, user, times=1):
+        self.client.force_authenticate(user=user)
+        for _ in range(times):
+            self.client.get(reverse("merch_store:buy_item", kwargs={"item_name": self.sticker.name}))
+
+    def test_top_receivers_updated_incrementally(self):
+        self._send(self.alice, self.bob, 100)
+        self._send(self.carol, self.bob, 50)
+        self._send(self.bob, self.carol, 70)
+        response = self.client.get(reverse("merch_store:top_receivers"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"], [
+            {"user": self.bob.email, "amount": 150},
+            {"user": self.carol.email, "amount": 70},
+        ])
+
+    def test_top_spenders_and_merch(self):
+        self._buy(self.alice, times=3)
+        self._buy(self.bob)
+        response = self.client.get(reverse("merch_store:top_spenders"), {"limit": 1})
+        self.assertEqual(response.data["results"], [{"user": self.alice.email, "amount": 15}])
+        response = self.client.get(reverse("merch_store:top_merch"))
+        self.assertEqual(response.data["results"][0],
+                         {"type": "sticker", "quantity": 4, "revenue": 20})
+
+    def test_base_view_is_abstract(self):
+        with self.assertRaises(TypeError):
+            LeaderboardAPIView()
+
+    def test_invalid_params(self):
+        response = self.client.get(reverse("merch_store:top_spenders"), {"limit": 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse("merch_store:top_receivers"), {"month": "october"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def _rollups(self):
+        return (
+            sorted(UserMonthlyStats.objects.values_list("user_id", "month", "received", "sent")),
+            sorted(UserSpending.objects.values_list("user_id", "spent")),
+            sorted(MerchSales.objects.values_list("merch_id").annotate(sold=Sum("sold"), revenue=Sum("revenue"))
+                   .filter(sold__gt=0).order_by()),
+        )
+
+    def test_rebuild_matches_incremental(self):
+        self._send(self.alice, self.bob, 100)
+        self._send(self.bob, self.alice, 30)
+        self._buy(self.carol, times=2)
+        incremental = self._rollups()
+        call_command("rebuild_rollups", stdout=StringIO())
+        self.assertEqual(self._rollups(), incremental)
+        # Пересчет по одному пользователю в транзакции дает тот же результат
+        rollups.rebuild(chunk_size=1)
+        self.assertEqual(self._rollups(), incremental)
+
+    def test_purchases_spread_over_sales_slots(self):
+        self._buy(self.alice)
+        self._buy(self.bob)
+        slots = set(MerchSales.objects.filter(merch=self.sticker).values_list("slot", flat=True))
+        self.assertEqual(slots, {rollups.sales_slot(self.alice), rollups.sales_slot(self.bob)})
+        self.assertEqual(rollups.top_merch(10), [{"type": "sticker", "quantity": 2, "revenue": 10}])
+
+    def test_rebuild_keeps_slot_rows(self):
+        self._buy(self.alice)
+        self._buy(self.bob)
+        rows = set(MerchSales.objects.values_list("pk", flat=True))
+        rollups.rebuild()
+        # Строки частей не удаляются: ожидающие их покупки не теряют обновление
+        self.assertLessEqual(rows, set(MerchSales.objects.values_list("pk", flat=True)))
+        self.assertEqual(rollups.top_merch(10), [{"type": "sticker", "quantity": 2, "revenue": 10}])
+
+
+class WarmUpTests(APITestCase):
+    databases = "__all__"
+
+    def test_preload_and_warm_up_record_metrics(self):
+        preload()
+        warm_up()
+        self.assertIn("preload_ms", STARTUP_METRICS)
+        self.assertIn("warm_up_ms", STARTUP_METRICS)
+        self.assertIsNotNone(connection.connection)
+
+    def test_warm_up_opens_connections_in_every_pool_thread(self):
+        threads = 3
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            warm_up(executor, threads)
+            barrier = threading.Barrier(threads)
+
+            def connected():
+                barrier.wait(timeout=5)
+                opened = connection.connection is not None
+                connections.close_all()
+                return opened
+
+            results = [future.result() for future in [executor.submit(connected) for _ in range(threads)]]
+        self.assertEqual(results, [True] * threads)
+
+
+class ReconcileBalancesTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create(email="alice@example.com")
+        self.bob = User.objects.create(email="bob@example.com")
+        self.pen = Merch.objects.create(name="gel-pen", price=10)
+        self.client.force_authenticate(user=self.alice)
+        self.client.post(reverse("merch_store:send_coin"),
+                         {"toUser": self.bob.email, "amount": 100}, format="json")
+        self.client.get(reverse("merch_store:buy_item", kwargs={"item_name": self.pen.name}))
+
+    def _reconcile(self, *args):
+        out = StringIO()
+        call_command("reconcile_balances", "--chunk-size", "1", *args, stdout=out)
+        return out.getvalue()
+
+    def test_consistent_balances(self):
+        output = self._reconcile()
+        self.assertIn("Checked 2 users, mismatched 0", output)
+
+    def test_reports_and_repairs_discrepancy(self):
+        User.objects.filter(pk=self.bob.pk).update(coins=5000)
+        output = self._reconcile()
+        self.assertIn(f"user={self.bob.pk} email=bob@example.com actual=5000 expected=1100", output)
+        self.bob.refresh_from_db()
+        self.assertEqual(self.bob.coins, 5000)
+
+        output = self._reconcile("--repair")
+        self.assertIn("repaired 1", output)
+        self.bob.refresh_from_db()
+        self.assertEqual(self.bob.coins, 1100)
+
+    def test_price_change_is_not_a_discrepancy(self):
+        Merch.objects.filter(pk=self.pen.pk).update(price=500)
+        output = self._reconcile("--repair")
+        self.assertIn("Checked 2 users, mismatched 0", output)
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.coins, 1000 - 100 - 10)
+
+    def test_resume_from_checkpoint(self):
+        User.objects.filter(pk=self.alice.pk).update(coins=1)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "checkpoint.json")
+            with open(path, "w") as checkpoint:
+                json.dump({"last_user_id": self.alice.pk, "checked": 1, "mismatched": 0, "repaired": 0}, checkpoint)
+            output = self._reconcile("--checkpoint", path, "--resume")
+            with open(path) as checkpoint:
+                state = json.load(checkpoint)
+        # Alice was already processed before the checkpoint and is skipped
+        self.assertIn("Checked 2 users, mismatched 0", output)
+        self.assertEqual(state["last_user_id"], self.bob.pk)
+
+
+class OutboxTests(APITestCase):
+    # С шардированием код обращается ко всем шардам
+    databases = {"default", *settings.DATABASE_SHARDS}
+
+    def setUp(self):
+        self.alice = User.objects.create(email="alice@example.com")
+        self.bob = User.objects.create(email="bob@example.com")
+        self.mug = Merch.objects.create(name="mug", price=20)
+        self.client.force_authenticate(user=self.alice)
+        self.delivered = []
+
+    def _dispatch(self, callback, *args, batch_size=1):
+        sinks = [{"BACKEND": "merch_store.outbox.CallbackSink", "OPTIONS": {"callback": callback}}]
+        with override_settings(OUTBOX_SINKS=sinks):
+            call_command("dispatch_outbox", "--batch-size", str(batch_size), *args, stdout=StringIO())
+
+    def _send(self, *amounts):
+        for amount in amounts:
+            self.client.post(reverse("merch_store:send_coin"),
+                             {"toUser": self.bob.email, "amount": amount}, format="json")
+
+    def test_events_written_with_business_change(self):
+        self.client.post(reverse("merch_store:send_coin"),
+                         {"toUser": self.bob.email, "amount": 30}, format="json")
+        self.client.get(reverse("merch_store:buy_item", kwargs={"item_name": self.mug.name}))
+        events = list(OutboxEvent.objects.order_by("id").values_list("topic", flat=True))
+        self.assertEqual(events, ["coins.transferred", "merch.purchased"])
+
+    def test_failed_request_writes_no_event(self):
+        self.client.post(reverse("merch_store:send_coin"),
+                         {"toUser": self.bob.email, "amount": 5000}, format="json")
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_dispatch_delivers_in_order(self):
+        for amount in (1, 2, 3):
+            self.client.post(reverse("merch_store:send_coin"),
+                             {"toUser": self.bob.email, "amount": amount}, format="json")
+        self._dispatch(self.delivered.append)
+        self.assertEqual([event["payload"]["amount"] for event in self.delivered], [1, 2, 3])
+        self.assertFalse(OutboxEvent.objects.filter(dispatched_at__isnull=True).exists())
+
+    def test_failed_delivery_is_retried(self):
+        self.client.post(reverse("merch_store:send_coin"),
+                         {"toUser": self.bob.email, "amount": 1}, format="json")
+
+        def failing(event):
+            raise ConnectionError("sink is down")
+
+        self._dispatch(failing)
+        event = OutboxEvent.objects.get()
+        self.assertIsNone(event.dispatched_at)
+        self.assertEqual(event.attempts, 1)
+        self.assertGreater(event.next_attempt_at, event.created_at)
+
+        # До следующей попытки событие не отправляется
+        self._dispatch(self.delivered.append)
+        self.assertEqual(self.delivered, [])
+        OutboxEvent.objects.update(next_attempt_at=timezone.now())
+        self._dispatch(self.delivered.append)
+        self.assertEqual(len(self.delivered), 1)
+
+    def test_poison_event_does_not_block_queue(self):
+        self._send(1, 2, 3)
+
+        def rejects_two(event):
+            if event["payload"]["amount"] == 2:
+                raise ValueError("malformed event")
+            self.delivered.append(event)
+
+        self._dispatch(rejects_two, batch_size=10)
+        # Доставка "хотя бы один раз": событие 1 ушло и в пачке, и по одному
+        self.assertEqual(sorted({event["payload"]["amount"] for event in self.delivered}), [1, 3])
+        poison = OutboxEvent.objects.get(dispatched_at__isnull=True)
+        self.assertEqual((poison.attempts, poison.failed_at), (1, None))
+
+    @override_settings(OUTBOX_RETRY={"MAX_ATTEMPTS": 2, "BASE_DELAY": 0, "MAX_DELAY": 0})
+    def test_event_fails_after_max_attempts(self):
+        self._send(1)
+
+        def failing(event):
+            raise ConnectionError("sink is down")
+
+        self._dispatch(failing)
+        self._dispatch(failing)
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.attempts, 2)
+        self.assertIsNotNone(event.failed_at)
+        self.assertFalse(outbox.pending().exists())
+
+        self._dispatch(self.delivered.append, "--retry-failed")
+        self.assertEqual(len(self.delivered), 1)
+
+
+class LimitedStockTests(APITestCase):
+    # С шардированием код обращается ко всем шардам
+    databases = {"default", *settings.DATABASE_SHARDS}
+
+    def setUp(self):
+        self.drop = Merch.objects.create(name="pink-drop", price=10)
+        self.url = reverse("merch_store:buy_item", kwargs={"item_name": self.drop.name})
+
+    def _buyer(self, index):
+        user = User.objects.create(email=f"buyer{index}@example.com")
+        self.client.force_authenticate(user=user)
+        return user
+
+    def test_add_stock_splits_into_buckets(self):
+        stock.add_stock(self.drop, 10, buckets=4)
+        self.drop.refresh_from_db()
+        self.assertTrue(self.drop.is_limited)
+        remaining = sorted(MerchStockBucket.objects.filter(merch=self.drop).values_list("remaining", flat=True))
+        self.assertEqual(remaining, [2, 2, 3, 3])
+        stock.add_stock(self.drop, 4, buckets=4)
+        self.assertEqual(stock.remaining_stock(self.drop), 14)
+
+    def test_cannot_oversell(self):
+        stock.add_stock(self.drop, 3, buckets=2)
+        statuses = []
+        for index in range(5):
+            self._buyer(index)
+            statuses.append(self.client.get(self.url).status_code)
+        self.assertEqual(statuses.count(status.HTTP_200_OK), 3)
+        self.assertEqual(statuses.count(status.HTTP_409_CONFLICT), 2)
+        self.assertEqual(stock.remaining_stock(self.drop), 0)
+        self.assertEqual(Inventory.objects.filter(merch=self.drop).count(), 3)
+
+    def test_failed_purchase_keeps_stock(self):
+        stock.add_stock(self.drop, 1, buckets=1)
+        user = self._buyer(0)
+        User.objects.filter(pk=user.pk).update(coins=0)
+        user.refresh_from_db()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(stock.remaining_stock(self.drop), 1)
+
+    def test_restock_command(self):
+        out = StringIO()
+        call_command("restock_merch", self.drop.name, "7", "--buckets", "3", stdout=out)
+        self.assertIn("remaining 7", out.getvalue())
+
+
+class CoinGrantTests(APITestCase):
+    # С шардированием код обращается ко всем шардам
+    databases = {"default", *settings.DATABASE_SHARDS}
+
+    def setUp(self):
+        self.users = [User.objects.create(email=f"employee{index}@corp.example") for index in range(5)]
+        self.contractor = User.objects.create(email="contractor@other.example")
+        self.former = User.objects.create(email="former@corp.example", is_active=False)
+
+    def _coins(self, user):
+        user.refresh_from_db()
+        return user.coins
+
+    def test_command_grants_active_users_in_chunks(self):
+        out = StringIO()
+        call_command("grant_coins", "--amount", "100", "--reason", "Q3 bonus", "--chunk-size", "2", stdout=out)
+        self.assertIn("rows_per_sec=", out.getvalue())
+        self.assertEqual([self._coins(user) for user in self.users + [self.contractor]], [1100] * 6)
+        self.assertEqual(self._coins(self.former), 1000)
+        grant = CoinGrant.objects.get()
+        self.assertEqual((grant.state, grant.granted), (CoinGrant.COMPLETED, 6))
+        _, _, discrepancies = reconciliation.check_chunk(0, 100)
+        self.assertEqual(discrepancies, [])
+
+    def test_filter_by_email_domain(self):
+        call_command("grant_coins", "--amount", "50", "--reason", "corp only",
+                     "--email-domain", "corp.example", stdout=StringIO())
+        self.assertEqual(self._coins(self.users[0]), 1050)
+        self.assertEqual(self._coins(self.contractor), 1000)
+
+    def test_resume_does_not_credit_twice(self):
+        grant = grants.create_grant(10, "airdrop")
+        last_id, credited = grants.grant_chunk(grant, 0, chunk_size=2)
+        self.assertEqual(credited, 2)
+        # Контрольная точка не сохранилась: пачка будет просмотрена повторно
+        CoinGrant.objects.filter(pk=grant.pk).update(state=CoinGrant.FAILED)
+        call_command("grant_coins", "--resume", str(grant.pk), stdout=StringIO())
+        self.assertEqual(CoinGrantCredit.objects.filter(grant_id=grant.pk).count(), 6)
+        self.assertEqual(self._coins(self.users[0]), 1010)
+
+    def test_abandoned_running_grant_is_resumed_from_checkpoint(self):
+        grant = grants.create_grant(10, "airdrop")
+        last_id, _ = grants.grant_chunk(grant, 0, chunk_size=2)
+        # Процесс API упал после первой пачки: состояние осталось RUNNING
+        CoinGrant.objects.filter(pk=grant.pk).update(
+            checkpoint={"default": last_id}, granted=2,
+            heartbeat_at=timezone.now() - timedelta(seconds=grants.STALE_SECONDS + 1),
+        )
+        # Только что созданное начисление еще запускает процесс API: отметка ставится при создании
+        fresh = grants.create_grant(5, "still running")
+
+        out = StringIO()
+        call_command("resume_grants", stdout=out)
+        self.assertIn(f"Grant {grant.pk} resumed", out.getvalue())
+        grant.refresh_from_db()
+        self.assertEqual((grant.state, grant.granted), (CoinGrant.COMPLETED, 6))
+        self.assertEqual(self._coins(self.users[0]), 1010)
+        # Начисление с недавней пачкой выполняет другой процесс: его не трогаем
+        self.assertFalse(CoinGrantCredit.objects.filter(grant_id=fresh.pk).exists())
+        with self.assertRaises(CommandError):
+            call_command("grant_coins", "--resume", str(fresh.pk), stdout=StringIO())
+
+    def test_api_starts_grant_and_reports_progress(self):
+        staff = User.objects.create(email="hr@corp.example", is_staff=True)
+        self.client.force_authenticate(user=staff)
+        with mock.patch.object(grants, "launch", side_effect=lambda grant: grants.run(grant, new=True)):
+            response = self.client.post(reverse("merch_store:coin_grants"), {
+                "amount": 25, "reason": "Q3 bonus", "filters": {"emails": [self.users[1].email]},
+            }, format="json")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        detail = self.client.get(reverse("merch_store:coin_grant_detail",
+                                         kwargs={"grant_id": response.data["id"]})).data
+        self.assertEqual((detail["state"], detail["granted"]), (CoinGrant.COMPLETED, 1))
+        self.assertEqual(self._coins(self.users[1]), 1025)
+
+    def test_api_validation_and_permissions(self):
+        self.client.force_authenticate(user=self.users[0])
+        url = reverse("merch_store:coin_grants")
+        self.assertEqual(self.client.post(url, {"amount": 1, "reason": "x"}, format="json").status_code,
+                         status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(user=User.objects.create(email="hr@corp.example", is_staff=True))
+        for payload in ({"amount": -5, "reason": "x"}, {"amount": 5},
+                        {"amount": 5, "reason": "x", "filters": {"team": "qa"}}):
+            self.assertEqual(self.client.post(url, payload, format="json").status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+
+class FakePgError(Exception):
+    def __init__(self, pgcode):
+        super().__init__(pgcode)
+        self.pgcode = pgcode
+
+
+def pg_error(pgcode):
+    try:
+        raise FakePgError(pgcode)
+    except FakePgError as cause:
+        error = OperationalError(f"SQLSTATE {pgcode}")
+        error.__cause__ = cause
+        return error
+
+
+@override_settings(TRANSACTION_RETRY={"MAX_ATTEMPTS": 4, "BUDGET": 1.0, "BASE_DELAY": 0, "MAX_DELAY": 0,
+                                      "LOCK_TIMEOUT_MS": 100, "SERIALIZABLE": True})
+class RetryAtomicTests(APITransactionTestCase):
+    def setUp(self):
+        retry.reset_counters()
+
+    def _flaky(self, errors):
+        calls = []
+
+        @retry.retry_atomic()
+        def operation():
+            calls.append(1)
+            Merch.objects.create(name=f"retry-{len(calls)}", price=1)
+            if errors:
+                raise errors.pop(0)
+            return len(calls)
+        return operation, calls
+
+    def test_retries_until_success_and_rolls_back_failed_attempts(self):
+        operation, _ = self._flaky([pg_error("40001"), pg_error("40P01")])
+        self.assertEqual(operation(), 3)
+        self.assertEqual(list(Merch.objects.filter(name__startswith="retry-").values_list("name", flat=True)),
+                         ["retry-3"])
+        counters = retry.counters()
+        self.assertEqual((counters["serialization_failures"], counters["deadlocks"], counters["retries"]),
+                         (1, 1, 2))
+
+    def test_gives_up_after_max_attempts(self):
+        operation, calls = self._flaky([pg_error("55P03") for _ in range(10)])
+        with self.assertRaises(retry.RetriesExhausted):
+            operation()
+        self.assertEqual(len(calls), 4)
+        self.assertEqual((retry.counters()["lock_timeouts"], retry.counters()["gave_up"]), (4, 1))
+
+    def test_other_errors_are_not_retried(self):
+        operation, calls = self._flaky([IntegrityError("duplicate")])
+        with self.assertRaises(IntegrityError):
+            operation()
+        self.assertEqual(len(calls), 1)
+
+    def test_inside_outer_transaction_runs_once(self):
+        operation, calls = self._flaky([pg_error("40001")])
+        with self.assertRaises(OperationalError), transaction.atomic():
+            operation()
+        self.assertEqual(len(calls), 1)
+
+    def test_grant_chunk_is_retried_on_deadlock(self):
+        user = User.objects.create(email="alice@example.com")
+        grant = grants.create_grant(10, "airdrop", filters={"emails": [user.email]})
+        with mock.patch.object(grants, "recipients", side_effect=[pg_error("40P01"), grants.recipients(grant.filters)]):
+            self.assertEqual(grants.grant_chunk(grant, 0), (user.pk, 1))
+        user.refresh_from_db()
+        self.assertEqual(user.coins, 1010)
+        self.assertEqual(retry.counters()["deadlocks"], 1)
+
+    def test_views_answer_503_when_retries_are_exhausted(self):
+        alice = User.objects.create(email="alice@example.com")
+        bob = User.objects.create(email="bob@example.com")
+        self.client.force_authenticate(user=alice)
+        with mock.patch("merch_store.views.transfer", side_effect=retry.RetriesExhausted("deadlocks")):
+            response = self.client.post(reverse("merch_store:send_coin"),
+                                        {"toUser": bob.email, "amount": 10}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response["Retry-After"], "1")
+
+    def test_counters_endpoint_is_staff_only(self):
+        self.client.force_authenticate(user=User.objects.create(email="alice@example.com"))
+        self.assertEqual(self.client.get(reverse("merch_store:retry_stats")).status_code,
+                         status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(user=User.objects.create(email="ops@example.com", is_staff=True))
+        self.assertEqual(self.client.get(reverse("merch_store:retry_stats")).data["gave_up"], 0)
+
+
+class ProvisioningTests(APITestCase):
+    # С шардированием код обращается ко всем шардам
+    databases = {"default", *settings.DATABASE_SHARDS}
+
+    csv_content = (
+        "email,password,first_name\n"
+        "new1@corp.example,pass-one,Anna\n"
+        "New2@corp.example,pass-two,\n"
+        "existing@corp.example,whatever,Old\n"
+        "new1@corp.example,again,Dup\n"
+        "not-an-email,x,\n"
+        "nopassword@corp.example,,\n"
+    )
+
+    def setUp(self):
+        User.objects.create(email="existing@corp.example")
+
+    def _write(self, suffix, content):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, "w", encoding="utf-8") as output:
+            output.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_command_imports_csv_and_is_idempotent(self):
+        path = self._write(".csv", self.csv_content)
+        out, err = StringIO(), StringIO()
+        call_command("provision_users", path, "--workers", "1", "--chunk-size", "2", stdout=out, stderr=err)
+        self.assertIn("rows_per_sec=", out.getvalue())
+        self.assertIn("row 5:", err.getvalue())
+        job = ProvisioningJob.objects.get()
+        self.assertEqual((job.state, job.created, job.skipped, job.invalid), (ProvisioningJob.COMPLETED, 3, 1, 2))
+        self.assertTrue(sharding.get_user("new1@corp.example").check_password("pass-one"))
+        self.assertEqual(sharding.get_user("new1@corp.example").coins, 1000)
+        self.assertFalse(sharding.get_user("nopassword@corp.example").has_usable_password())
+
+        call_command("provision_users", path, "--workers", "1", stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(ProvisioningJob.objects.order_by("-created_at").first().created, 0)
+        self.assertEqual(sum(User.objects.using(alias).filter(email__endswith="@corp.example", is_shadow=False).count()
+                             for alias in sharding.shard_aliases()), 4)
+
+    def test_emails_are_kept_as_given_and_matched_case_insensitively(self):
+        path = self._write(".json", json.dumps([
+            {"email": "Existing@Corp.example", "password": "other"},
+            {"email": "Anna.Smith@corp.example", "password": "pass-one"},
+            {"email": "anna.smith@CORP.example", "password": "again"},
+        ]))
+        call_command("provision_users", path, "--workers", "1", stdout=StringIO(), stderr=StringIO())
+        job = ProvisioningJob.objects.get()
+        self.assertEqual((job.created, job.skipped, job.invalid), (1, 1, 1))
+        user = sharding.get_user("anna.smith@corp.example")
+        self.assertEqual(user.email, "Anna.Smith@corp.example")
+
+        # Вход с email в другом регистре попадает в созданный аккаунт, а не создает новый
+        response = self.client.post(reverse("merch_store:auth"),
+                                    {"username": "ANNA.SMITH@corp.example", "password": "pass-one"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(AccessToken(response.data["token"]["access"])["user_id"], user.pk)
+        self.assertEqual(sum(User.objects.using(alias).filter(email__iexact="anna.smith@corp.example").count()
+                             for alias in sharding.shard_aliases()), 1)
+
+    def test_accounts_differing_only_by_case_are_rejected(self):
+        shard = sharding.shard_for_email("case@corp.example")
+        User.objects.db_manager(shard).create(email="case@corp.example")
+        with self.assertRaises(IntegrityError), transaction.atomic(using=shard):
+            User.objects.db_manager(shard).create(email="Case@Corp.example")
+        with CaptureQueriesContext(connections[shard]) as queries:
+            self.assertEqual(sharding.get_user("CASE@corp.example").email, "case@corp.example")
+        self.assertIn("LOWER", queries.captured_queries[-1]["sql"].upper())
+
+    def test_non_string_password_is_rejected(self):
+        path = self._write(".json", json.dumps([
+            {"email": "number@corp.example", "password": 12345},
+            {"email": "string@corp.example", "password": "12345"},
+        ]))
+        err = StringIO()
+        call_command("provision_users", path, "--workers", "1", stdout=StringIO(), stderr=err)
+        job = ProvisioningJob.objects.get()
+        self.assertEqual((job.state, job.created, job.invalid), (ProvisioningJob.COMPLETED, 1, 1))
+        self.assertIn("row 1: Пароль должен быть строкой.", err.getvalue())
+
+    def test_interrupted_import_is_reported_and_resumed(self):
+        class WorkerKilled(BaseException):
+            pass
+
+        def kill(report):
+            raise WorkerKilled
+
+        path = self._write(".csv", self.csv_content)
+        rows = provisioning.parse(self.csv_content, "csv")
+        job = provisioning.create_job(rows)
+        with self.assertRaises(WorkerKilled):
+            provisioning.run(job, rows, workers=1, chunk_size=2, progress=kill)
+        resume = ("provision_users", path, "--workers", "1", "--chunk-size", "2", "--resume", str(job.pk))
+        # Пока отметка свежая, импорт считается выполняющимся
+        with self.assertRaises(CommandError):
+            call_command(*resume, stdout=StringIO())
+
+        ProvisioningJob.objects.filter(pk=job.pk).update(
+            heartbeat_at=timezone.now() - timedelta(seconds=provisioning.STALE_SECONDS + 1))
+        self.client.force_authenticate(user=User.objects.create(email="hr@corp.example", is_staff=True))
+        detail = self.client.get(reverse("merch_store:user_import_detail", kwargs={"job_id": job.pk})).data
+        self.assertEqual((detail["state"], detail["created"]), (ProvisioningJob.FAILED, 2))
+        self.assertIn("--resume", detail["last_error"])
+
+        call_command(*resume, stdout=StringIO(), stderr=StringIO())
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.processed, job.created, job.skipped, job.invalid),
+                         (ProvisioningJob.COMPLETED, 6, 3, 1, 2))
+        self.assertFalse(sharding.get_user("nopassword@corp.example").has_usable_password())
+
+    def test_passwords_are_hashed_in_process_pool(self):
+        rows = [{"email": f"pool{index}@corp.example", "password": f"secret-{index}"} for index in range(6)]
+        path = self._write(".json", json.dumps(rows))
+        call_command("provision_users", path, "--workers", "2", stdout=StringIO())
+        self.assertTrue(sharding.get_user("pool5@corp.example").check_password("secret-5"))
+
+    def test_api_import(self):
+        self.client.force_authenticate(user=User.objects.create(email="hr@corp.example", is_staff=True))
+        upload = SimpleUploadedFile("office.csv", self.csv_content.encode(), content_type="text/csv")
+        with mock.patch.object(provisioning, "launch",
+                               side_effect=lambda job, rows: provisioning.run(job, rows, workers=1)):
+            response = self.client.post(reverse("merch_store:user_import"), {"file": upload}, format="multipart")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        detail = self.client.get(reverse("merch_store:user_import_detail",
+                                         kwargs={"job_id": response.data["id"]})).data
+        self.assertEqual((detail["state"], detail["created"], detail["invalid"]), (ProvisioningJob.COMPLETED, 3, 2))
+
+        response = self.client.post(reverse("merch_store:user_import"), {"email": "x@corp.example"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_api_is_staff_only(self):
+        self.client.force_authenticate(user=User.objects.get(email="existing@corp.example"))
+        response = self.client.post(reverse("merch_store:user_import"), [], format="json")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class EventStreamTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create(email="alice@example.com")
+        self.bob = User.objects.create(email="bob@example.com")
+        self.mug = Merch.objects.create(name="mug", price=20)
+        self.client.force_authenticate(user=self.alice)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def _subscribe(self, user, broker=None):
+        async def subscribe():
+            return (broker or events.get_broker()).subscribe(user.pk)
+        subscription = self.loop.run_until_complete(subscribe())
+        self.addCleanup(subscription.close)
+        return subscription
+
+    def _received(self, subscription):
+        self.loop.run_until_complete(asyncio.sleep(0))
+        received = []
+        while not subscription.queue.empty():
+            received.append(subscription.queue.get_nowait())
+        return received
+
+    def test_transfer_and_purchase_push_deltas(self):
+        alice, bob = self._subscribe(self.alice), self._subscribe(self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("merch_store:send_coin"), {"toUser": self.bob.email, "amount": 30}, format="json")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse("merch_store:buy_item", kwargs={"item_name": self.mug.name}))
+
+        sent, bought = self._received(alice)
+        self.assertEqual((sent["type"], sent["balance"]), ("transfer", 970))
+        self.assertEqual((sent["transaction"]["toUser"], sent["transaction"]["amount"]), (self.bob.email, 30))
+        self.assertEqual(bought, {"type": "purchase", "balance": 950, "inventory": {"type": "mug", "quantity": 1}})
+        [received] = self._received(bob)
+        self.assertEqual((received["balance"], received["transaction"]["fromUser"]), (1030, self.alice.email))
+
+    def test_failed_operation_publishes_nothing(self):
+        alice = self._subscribe(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("merch_store:send_coin"), {"toUser": self.bob.email, "amount": 5000},
+                             format="json")
+        self.assertEqual(self._received(alice), [])
+
+    def test_slow_consumer_gets_resync(self):
+        broker = events.Broker(events.LocalBackend(), queue_size=2)
+        subscription = self._subscribe(self.alice, broker)
+        for balance in (1, 2, 3):
+            broker.publish(self.alice.pk, {"type": "transfer", "balance": balance})
+        self.assertEqual(self._received(subscription), [{"type": events.RESYNC}])
+        subscription.close()
+        self.assertEqual(broker.subscribers(self.alice.pk), 0)
+
+    async def test_sse_stream(self):
+        client = AsyncClient()
+        self.assertEqual((await client.get(reverse("merch_store:events"))).status_code, 401)
+
+        token = str(AccessToken.for_user(self.alice))
+        response = await client.get(reverse("merch_store:events"), headers={"Authorization": f"Bearer {token}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        stream = response.streaming_content
+        try:
+            self.assertTrue((await anext(stream)).startswith(b"retry:"))
+            self.assertIn(b'"balance": 1000', await anext(stream))
+            events.get_broker().publish(self.alice.pk, {"type": "transfer", "balance": 990})
+            self.assertEqual(await anext(stream),
+                             b'event: transfer\ndata: {"type": "transfer", "balance": 990}\n\n')
+        finally:
+            await stream.aclose()
+
+        # Поток закрывается по истечении времени жизни и снимает подписку
+        subscription = events.get_broker().subscribe(self.bob.pk)
+        chunks = [chunk async for chunk in sse_stream(self.bob, subscription, heartbeat=0.01, lifetime=0.05)]
+        self.assertIn(": keepalive\n\n", chunks)
+        self.assertEqual(events.get_broker().subscribers(self.bob.pk), 0)
+
+    async def test_sse_stream_with_ticket(self):
+        token = str(AccessToken.for_user(self.alice))
+        client = AsyncClient()
+        self.assertEqual((await client.get(reverse("merch_store:events"), {"token": token})).status_code, 401)
+
+        response = await client.post(reverse("merch_store:event_ticket"),
+                                     headers={"Authorization": f"Bearer {token}"})
+        self.assertEqual(response.status_code, 200)
+        ticket = response.json()["ticket"]
+        self.assertEqual(response.json()["expires_in"], settings.EVENTS_TICKET_SECONDS)
+
+        response = await client.get(reverse("merch_store:events"), {"ticket": ticket})
+        self.assertEqual(response.status_code, 200)
+        await response.streaming_content.aclose()
+        # Билет одноразовый
+        self.assertEqual((await client.get(reverse("merch_store:events"), {"ticket": ticket})).status_code, 401)
+
+    def test_ticket_is_short_lived_and_single_purpose(self):
+        ticket = streaming.issue_ticket(self.alice)
+        # Срок действия меньше возраста билета: билет истек
+        with override_settings(EVENTS_TICKET_SECONDS=-1):
+            self.assertIsNone(streaming._redeem_ticket(ticket))
+        # Билет не является JWT и не принимается остальным API
+        self.client.force_authenticate(user=None)
+        response = self.client.get(reverse("merch_store:user_info"), HTTP_AUTHORIZATION=f"Bearer {ticket}")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(streaming._redeem_ticket(ticket), self.alice)
+        self.assertIsNone(streaming._redeem_ticket(ticket))
+
+    def test_broadcast_reaches_all_subscriptions(self):
+        broker = events.Broker(events.LocalBackend())
+        alice, bob = self._subscribe(self.alice, broker), self._subscribe(self.bob, broker)
+        broker.dispatch(None, {"type": events.RESYNC})
+        self.assertEqual((self._received(alice), self._received(bob)), ([{"type": events.RESYNC}],) * 2)
+
+    def test_postgres_backend_delivers_notifications(self):
+        backend = events.PostgresBackend()
+        delivered = []
+        backend.dispatch = lambda user_id, event: delivered.append((user_id, event))
+        backend.receive(json.dumps({"user_id": self.alice.pk, "event": {"type": "transfer", "balance": 5}}))
+        backend.receive("not json")
+        self.assertEqual(delivered, [(self.alice.pk, {"type": "transfer", "balance": 5})])
+
+    def test_sse_requires_asgi(self):
+        response = self.client.get(reverse("merch_store:events"))
+        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+    async def test_websocket(self):
+        async def connect(query_string):
+            incoming, sent = asyncio.Queue(), []
+            await incoming.put({"type": "websocket.connect"})
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {"type": "websocket", "path": "/api/events/ws", "query_string": query_string}
+            return incoming, sent, asyncio.ensure_future(websocket_application(scope, incoming.get, send))
+
+        # Access-токен в URL не принимается: только билет потока
+        _, sent, handler = await connect(f"token={AccessToken.for_user(self.alice)}".encode())
+        await handler
+        self.assertEqual(sent, [{"type": "websocket.close", "code": 4401}])
+
+        ticket = streaming.issue_ticket(self.alice)
+        incoming, sent, handler = await connect(f"ticket={ticket}".encode())
+        while len(sent) < 2:
+            await asyncio.sleep(0.01)
+        events.get_broker().publish(self.alice.pk, {"type": "purchase", "balance": 980})
+        while len(sent) < 3:
+            await asyncio.sleep(0.01)
+        await incoming.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(handler, 1)
+        self.assertEqual(sent[0], {"type": "websocket.accept"})
+        self.assertEqual([json.loads(message["text"])["type"] for message in sent[1:]], ["ready", "purchase"])
+        self.assertEqual(events.get_broker().subscribers(self.alice.pk), 0)
+
+        # Соединение живет не дольше EVENTS_STREAM_SECONDS: пользователь проверяется при переподключении
+        with override_settings(EVENTS_STREAM_SECONDS=0.05):
+            _, sent, handler = await connect(f"ticket={streaming.issue_ticket(self.alice)}".encode())
+            await asyncio.wait_for(handler, 1)
+        self.assertEqual(sent[-1], {"type": "websocket.close", "code": streaming.CLOSE_EXPIRED})
+        self.assertEqual(events.get_broker().subscribers(self.alice.pk), 0)
+
+
+class TokenRevocationTests(APITestCase):
+    def setUp(self):
+        patcher = mock.patch.object(revocation, "revocations", revocation.RevocationList())
+        self.revocations = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create(email="leaver@example.com")
+        self.user.set_password("password123")
+        self.user.save()
+        self.tokens = self.client.post(reverse("merch_store:auth"),
+                                       {"username": self.user.email, "password": "password123"},
+                                       format="json").data["token"]
+
+    def _info(self, access):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+        return self.client.get(reverse("merch_store:user_info"))
+
+    def _refresh(self):
+        return self.client.post(reverse("merch_store:refresh"), {"refresh": self.tokens["refresh"]}, format="json")
+
+    def test_logout_revokes_access_and_refresh(self):
+        self.assertEqual(self._info(self.tokens["access"]).status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse("merch_store:logout"), {"refresh": self.tokens["refresh"]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self._info(self.tokens["access"]).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self._refresh().status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def _issued_earlier(self, token):
+        # Токен без времени выдачи в микросекундах, выданный в предыдущую секунду
+        token.set_iat(at_time=timezone.now() - timedelta(seconds=1))
+        return str(token)
+
+    def test_logout_everywhere(self):
+        other = self._issued_earlier(AccessToken.for_user(self.user))
+        self.tokens["refresh"] = self._issued_earlier(RefreshToken.for_user(self.user))
+        self._info(self.tokens["access"])
+        self.client.post(reverse("merch_store:logout"), {"all": True}, format="json")
+        self.assertEqual(self._info(other).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self._refresh().status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self._info(self.tokens["access"]).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_user_revocation_covers_tokens_issued_in_the_same_second(self):
+        revoked_at = timezone.now().replace(microsecond=500000)
+        with mock.patch.object(revocation.timezone, "now", return_value=revoked_at):
+            revocation.revoke_user(self.user.pk)
+
+        def issued(at_time):
+            token = RefreshToken.for_user(self.user)
+            token.current_time = at_time
+            token.set_iat(at_time=at_time)
+            return revocation.stamp(token)
+
+        second = revoked_at.replace(microsecond=0)
+        self.assertTrue(revocation.is_revoked(issued(second)))
+        self.assertTrue(revocation.is_revoked(issued(revoked_at)))
+        self.assertTrue(revocation.is_revoked(issued(revoked_at).access_token))
+        self.assertFalse(revocation.is_revoked(issued(revoked_at + timedelta(microseconds=1))))
+        # Без времени в микросекундах токен из секунды отзыва считается выданным до отзыва
+        legacy = RefreshToken.for_user(self.user)
+        legacy.set_iat(at_time=revoked_at + timedelta(microseconds=1))
+        self.assertTrue(revocation.is_revoked(legacy))
+
+    def test_login_right_after_logout_everywhere(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.tokens['access']}")
+        self.client.post(reverse("merch_store:logout"), {"all": True}, format="json")
+        # Повторный вход, в том числе в ту же секунду, выдает действующие токены
+        self.client.credentials()
+        tokens = self.client.post(reverse("merch_store:auth"),
+                                  {"username": self.user.email, "password": "password123"},
+                                  format="json").data["token"]
+        self.assertEqual(self._info(tokens["access"]).status_code, status.HTTP_200_OK)
+        self.assertEqual(self._info(self.tokens["access"]).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.tokens = tokens
+        self.assertEqual(self._refresh().status_code, status.HTTP_200_OK)
+
+    def test_confirmed_user_revocation_is_cached(self):
+        now = timezone.now().replace(microsecond=0)
+        entry = RevokedToken.objects.create(key=revocation.user_key(self.user.pk), user_id=self.user.pk,
+                                            revoked_at=now - timedelta(days=1), expires_at=now + timedelta(days=1))
+        self.revocations.refresh(force=True)
+        token = AccessToken(self._issued_earlier(AccessToken.for_user(self.user)))
+        self.assertFalse(revocation.is_revoked(token))
+        with self.assertNumQueries(0):
+            self.assertFalse(revocation.is_revoked(token))
+
+        # Повторный отзыв, записанный другим процессом, перечитывается при синхронизации
+        RevokedToken.objects.filter(pk=entry.pk).update(revoked_at=now)
+        self.revocations._next_sync = 0
+        self.assertTrue(revocation.is_revoked(token))
+        with self.assertNumQueries(0):
+            self.assertTrue(revocation.is_revoked(token))
+
+    def test_staff_revoke(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(reverse("merch_store:revoke"), {"user": self.user.email}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=User.objects.create(email="security@example.com", is_staff=True))
+        response = self.client.post(reverse("merch_store:revoke"), {"token": self.tokens["refresh"]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(RevokedToken.objects.get().user_id, self.user.pk)
+        response = self.client.post(reverse("merch_store:revoke"), {"user": "ghost@example.com"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.client.force_authenticate(user=None)
+        self.assertEqual(self._refresh().status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self._info(self.tokens["access"]).status_code, status.HTTP_200_OK)
+
+    def test_check_without_queries_and_sync_from_shared_store(self):
+        token = AccessToken(self.tokens["access"])
+        self.revocations.refresh(force=True)
+        with self.assertNumQueries(0):
+            self.assertFalse(revocation.is_revoked(token))
+
+        # Отзыв, записанный другим процессом, появляется после синхронизации
+        RevokedToken.objects.create(key=revocation.token_key(token["jti"]), revoked_at=timezone.now(),
+                                    expires_at=timezone.now() + timedelta(minutes=15))
+        self.revocations._next_sync = 0
+        self.assertTrue(revocation.is_revoked(token))
+
+    def test_false_positive_is_confirmed_once(self):
+        token = AccessToken(self.tokens["access"])
+        self.revocations.refresh(force=True)
+        self.revocations._filter.add(revocation.token_key(token["jti"]))
+        with self.assertNumQueries(1):
+            self.assertFalse(revocation.is_revoked(token))
+        with self.assertNumQueries(0):
+            self.assertFalse(revocation.is_revoked(token))
+
+    def test_bloom_filter_error_rate(self):
+        bloom = revocation.BloomFilter(1000, 0.01)
+        for index in range(1000):
+            bloom.add(f"jti:{index}")
+        self.assertTrue(all(f"jti:{index}" in bloom for index in range(1000)))
+        false_positives = sum(f"other:{index}" in bloom for index in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_expired_entries_are_purged(self):
+        RevokedToken.objects.create(key="jti:old", revoked_at=timezone.now() - timedelta(days=2),
+                                    expires_at=timezone.now() - timedelta(days=1))
+        revocation.revoke(AccessToken(self.tokens["access"]))
+        out = StringIO()
+        call_command("purge_revoked_tokens", stdout=out)
+        self.assertIn("1", out.getvalue())
+        self.assertEqual(RevokedToken.objects.count(), 1)
+
+
+class InventoryStorageTests(APITestCase):
+    # С шардированием код обращается ко всем шардам
+    databases = {"default", *settings.DATABASE_SHARDS}
+
+    def setUp(self):
+        self.user = User.objects.create(email="collector@example.com")
+        self.mug = Merch.objects.create(name="enamel-mug", price=30)
+        self.cap = Merch.objects.create(name="cap", price=40)
+        self.client.force_authenticate(user=self.user)
+
+    def _buy(self, *items):
+        for item in items:
+            response = self.client.get(reverse("merch_store:buy_item", kwargs={"item_name": item.name}))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def _map(self):
+        return UserInventory.objects.get(user=self.user).items
+
+    def test_purchase_price_is_recorded(self):
+        for mode in inventory.MODES:
+            with self.subTest(mode=mode), override_settings(INVENTORY_STORAGE=mode):
+                self._buy(self.mug)
+                Merch.objects.filter(pk=self.mug.pk).update(price=self.mug.price + 10)
+                self.mug.refresh_from_db()
+        # Цены покупок: 30 (rows), 40 (dual), 50 (compact)
+        self.assertEqual(Inventory.objects.get(user=self.user, merch=self.mug).spent, 30 + 40)
+        self.assertEqual(UserInventory.objects.get(user=self.user).costs, {str(self.mug.pk): 40 + 50})
+        with override_settings(INVENTORY_STORAGE=inventory.COMPACT):
+            self.assertEqual(inventory.spent_by([self.user.pk]), {self.user.pk: 90})
+            self.assertEqual(inventory.sales_of(self.mug), (2, 90))
+
+    @override_settings(INVENTORY_STORAGE=inventory.COMPACT)
+    def test_compact_storage(self):
+        self._buy(self.cap, self.mug, self.mug)
+        self.assertEqual(self._map(), {str(self.mug.pk): 2, str(self.cap.pk): 1})
+        self.assertFalse(Inventory.objects.exists())
+        self.assertEqual(self.client.get(reverse("merch_store:user_info")).data["inventory"],
+                         [{"type": "enamel-mug", "quantity": 2}, {"type": "cap", "quantity": 1}])
+
+        self.assertEqual(reconciliation.check_chunk(0, 10)[2], [])
+        call_command("rebuild_rollups", stdout=StringIO())
+        self.assertEqual(UserSpending.objects.get(user=self.user).spent, 100)
+        self.assertEqual(MerchSales.objects.filter(merch=self.mug).aggregate(sold=Sum("sold"))["sold"], 2)
+        with self.assertRaises(CommandError):
+            call_command("backfill_inventory", stdout=StringIO())
+
+    @override_settings(INVENTORY_STORAGE=inventory.ROWS)
+    def test_dual_writes_and_backfill(self):
+        self._buy(self.mug)
+        self.assertFalse(UserInventory.objects.exists())
+        with override_settings(INVENTORY_STORAGE=inventory.DUAL):
+            self._buy(self.mug, self.cap)
+            self.assertEqual(self._map(), {str(self.mug.pk): 1, str(self.cap.pk): 1})
+            call_command("backfill_inventory", stdout=StringIO())
+        self.assertEqual(self._map(), {str(self.mug.pk): 2, str(self.cap.pk): 1})
+        self.assertEqual(Inventory.objects.get(user=self.user, merch=self.mug).quantity, 2)
+
+        Inventory.objects.all().delete()
+        call_command("backfill_inventory", stdout=StringIO())
+        self.assertFalse(UserInventory.objects.exists())
+
+    def test_migration_backfill(self):
+        Inventory.objects.create(user=self.user, merch=self.mug, quantity=3)
+        Inventory.objects.create(user=User.objects.create(email="other@example.com"), merch=self.cap)
+        migration = importlib.import_module("merch_store.migrations.0014_user_inventory")
+        migration.backfill_user_inventory(apps, mock.Mock(connection=connection))
+        self.assertEqual(self._map(), {str(self.mug.pk): 3})
+        self.assertEqual(UserInventory.objects.count(), 2)
+
+
+@unittest.skipUnless(os.getenv("STRESS_TEST"), "set STRESS_TEST=1 to run the concurrency stress suite")
+class MoneyStressTests(TransactionTestCase):
+    """
+    Concurrent random transfers and purchases against a real transactional database.
+
+    Runs on PostgreSQL, or on SQLite in WAL mode when the test database is a file
+    (DATABASES['default']['TEST']['NAME']). Tunable with STRESS_USERS,
+    STRESS_THREADS and STRESS_OPS.
+    """
+    users_count = int(os.getenv("STRESS_USERS", 50))
+    threads = int(os.getenv("STRESS_THREADS", 8))
+    operations = int(os.getenv("STRESS_OPS", 2000))
+    max_retries = 10
+
+    def setUp(self):
+        if connection.vendor == "sqlite":
+            if connection.is_in_memory_db():
+                self.skipTest("SQLite stress runs need a file-based test database")
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode=WAL")
+        self.users = User.objects.bulk_create(
+            User(email=f"stress{index}@example.com") for index in range(self.users_count)
+        )
+        self.users = list(User.objects.filter(email__startswith="stress").order_by("id"))
+        self.merch = [Merch.objects.create(name=f"stress-{price}", price=price) for price in (7, 30, 120)]
+        self.initial_total = self._total_coins() + self._total_spent()
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+
+    def _total_coins(self):
+        return User.objects.aggregate(total=Sum("coins"))["total"] or 0
+
+    def _total_spent(self):
+        # Инвентарь хранится строками или компактными картами (INVENTORY_STORAGE)
+        return sum(inventory.spent_by(list(User.objects.values_list("pk", flat=True))).values())
+
+    @staticmethod
+    def _classify(error):
+        code = getattr(getattr(error, "__cause__", None), "pgcode", None)
+        message = str(error).lower()
+        if code == "40P01" or "deadlock" in message:
+            return "deadlocks"
+        if code == "40001":
+            return "serialization_failures"
+        if code == "55P03" or "locked" in message:
+            return "lock_timeouts"
+        return None
+
+    def _request(self, rng):
+        factory = APIRequestFactory()
+        user = rng.choice(self.users)
+        if rng.random() < 0.7:
+            request = factory.post("/api/sendCoin", {"toUser": rng.choice(self.users).email,
+                                                     "amount": rng.randint(1, 300)}, format="json")
+            force_authenticate(request, user=user)
+            return SendCoinAPIView.as_view()(request)
+        merch = rng.choice(self.merch)
+        request = factory.get(f"/api/buy/{merch.name}")
+        force_authenticate(request, user=user)
+        return BuyItemAPIView.as_view()(request, item_name=merch.name)
+
+    def _worker(self, seed, operations):
+        rng = random.Random(seed)
+        local = Counter()
+        try:
+            for _ in range(operations):
+                for attempt in range(self.max_retries + 1):
+                    try:
+                        response = self._request(rng)
+                    except DatabaseError as error:
+                        kind = self._classify(error)
+                        if kind is None:
+                            local["errors"] += 1
+                            break
+                        if attempt == self.max_retries:
+                            local["gave_up"] += 1
+                            break
+                        local[kind] += 1
+                        local["retries"] += 1
+                        time.sleep(rng.uniform(0, 0.005 * 2 ** min(attempt, 6)))
+                    else:
+                        outcome = {200: "ok", 503: "busy"}.get(response.status_code, "rejected")
+                        local[outcome] += 1
+                        break
+        finally:
+            connections.close_all()
+            with self.stats_lock:
+                self.stats.update(local)
+
+    def test_concurrent_transfers_and_purchases(self):
+        per_thread = self.operations // self.threads
+        workers = [threading.Thread(target=self._worker, args=(seed, per_thread))
+                   for seed in range(self.threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        sys.stderr.write(
+            f"\nstress vendor={connection.vendor} threads={self.threads} ops={per_thread * self.threads} "
+            f"ops_per_sec={per_thread * self.threads / elapsed:.0f} "
+            + " ".join(f"{key}={value}" for key, value in sorted(self.stats.items()))
+            + " server_" + " server_".join(f"{key}={value}" for key, value in retry.counters().items()) + "\n"
+        )
+
+        # Only deadlocks, serialization failures and lock timeouts are acceptable
+        self.assertEqual(self.stats["errors"], 0)
+        # Coins only move between users or are exchanged for merch
+        self.assertEqual(self._total_coins() + self._total_spent(), self.initial_total)
+        self.assertFalse(User.objects.filter(coins__lt=0).exists())
+        _, _, discrepancies = reconciliation.check_chunk(0, self.users_count)
+        self.assertEqual(discrepancies, [])
+
+
+@unittest.skipUnless(sharding.is_sharded(), "set DATABASE_SHARD_HOSTS to run the sharding tests")
+class ShardingTests(APITransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        cache.clear()
+        # Каталог на шардах должен совпадать с основной БД по id
+        for alias in sharding.shard_aliases()[1:]:
+            Merch.objects.using(alias).all().delete()
+        sharding.sync_catalog()
+
+    def _auth(self, email):
+        response = self.client.post(reverse("merch_store:auth"),
+                                    {"username": email, "password": "secret"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['token']['access']}")
+        return sharding.get_user(email)
+
+    def _emails_on_different_shards(self):
+        by_shard = {}
+        for index in range(100):
+            email = f"user{index}@example.com"
+            by_shard.setdefault(sharding.shard_for_email(email), email)
+            if len(by_shard) == 2:
+                return list(by_shard.values())
+        self.fail("no emails on different shards")
+
+    def test_users_are_placed_by_email_with_global_ids(self):
+        users = [self._auth(f"user{index}@example.com") for index in range(12)]
+        self.assertEqual(len({user.pk for user in users}), len(users))
+        for user in users:
+            self.assertEqual(user._state.db, sharding.shard_for_email(user.email))
+            self.assertEqual(UserDirectory.objects.get(email=user.email).pk, user.pk)
+        self.assertGreater(len({user._state.db for user in users}), 1)
+
+    def test_cross_shard_transfer(self):
+        sender_email, recipient_email = self._emails_on_different_shards()
+        recipient = self._auth(recipient_email)
+        sender = self._auth(sender_email)
+        response = self.client.post(reverse("merch_store:send_coin"),
+                                    {"toUser": recipient_email, "amount": 150}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        sender.refresh_from_db()
+        recipient.refresh_from_db()
+        self.assertEqual((sender.coins, recipient.coins), (850, 1150))
+        self.assertEqual(ShardTransfer.objects.using(sender._state.db).get().state, ShardTransfer.COMPLETED)
+        for alias in (sender._state.db, recipient._state.db):
+            self.assertEqual(Transaction.objects.using(alias).count(), 1)
+            _, _, discrepancies = reconciliation.check_chunk(0, 100, using=alias)
+            self.assertEqual(discrepancies, [])
+
+        self._auth(recipient_email)
+        info = self.client.get(reverse("merch_store:user_info")).data
+        self.assertEqual(info["coins"], 1150)
+        self.assertEqual(info["coinHistory"]["received"], [{"fromUser": sender_email, "amount": 150}])
+        top = self.client.get(reverse("merch_store:top_receivers")).data["results"]
+        self.assertEqual(top, [{"user": recipient_email, "amount": 150}])
+
+    def test_export_reads_all_shards_once_per_transfer(self):
+        sender_email, recipient_email = self._emails_on_different_shards()
+        self._auth(recipient_email)
+        self._auth(sender_email)
+        self.client.post(reverse("merch_store:send_coin"), {"toUser": recipient_email, "amount": 150}, format="json")
+        self._auth(recipient_email)
+        self.client.post(reverse("merch_store:send_coin"), {"toUser": sender_email, "amount": 40}, format="json")
+        staff = User.objects.using(sharding.shard_for_email(recipient_email)).get(email=recipient_email)
+        User.objects.using(staff._state.db).filter(pk=staff.pk).update(is_staff=True)
+
+        response = self.client.get(reverse("merch_store:transaction_export"))
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(sorted((row["sender"], row["amount"]) for row in rows),
+                         sorted([(recipient_email, 40), (sender_email, 150)]))
+
+    def test_resume_completes_interrupted_transfer(self):
+        sender_email, recipient_email = self._emails_on_different_shards()
+        recipient = self._auth(recipient_email)
+        sender = self._auth(sender_email)
+        shard_transfer, _, _ = transfers._debit(sender, recipient, 40)
+
+        call_command("resume_shard_transfers", "--older-than", "-1", stdout=StringIO())
+        call_command("resume_shard_transfers", "--older-than", "-1", stdout=StringIO())
+        recipient.refresh_from_db()
+        self.assertEqual(recipient.coins, 1040)
+        shard_transfer.refresh_from_db()
+        self.assertEqual(shard_transfer.state, ShardTransfer.COMPLETED)
+
+    def test_refund_when_recipient_is_missing(self):
+        sender_email, recipient_email = self._emails_on_different_shards()
+        recipient = self._auth(recipient_email)
+        sender = self._auth(sender_email)
+        shard_transfer, _, _ = transfers._debit(sender, recipient, 40)
+        recipient.delete()
+
+        stats = transfers.resume_pending(timezone.now() + timedelta(seconds=1), using=sender._state.db)
+        self.assertEqual(stats["refunded"], 1)
+        sender.refresh_from_db()
+        self.assertEqual(sender.coins, 1000)
+        self.assertFalse(Transaction.objects.using(sender._state.db).exists())
+        _, _, discrepancies = reconciliation.check_chunk(0, 100, using=sender._state.db)
+        self.assertEqual(discrepancies, [])
+
+    def test_retried_purchase_on_shard_reserves_stock_once(self):
+        drop = Merch.objects.using("default").create(name="blue-drop", price=10)
+        sharding.sync_catalog()
+        stock.add_stock(drop, 5, buckets=2)
+        email = next(email for email in (f"buyer{index}@example.com" for index in range(100))
+                     if sharding.shard_for_email(email) != "default")
+        self._auth(email)
+        url = reverse("merch_store:buy_item", kwargs={"item_name": drop.name})
+        add_item, errors = inventory.add_item, [pg_error("40P01"), pg_error("40001")]
+
+        def flaky_add_item(*args, **kwargs):
+            if errors:
+                raise errors.pop(0)
+            return add_item(*args, **kwargs)
+
+        with mock.patch("merch_store.views.inventory.add_item", side_effect=flaky_add_item):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        self.assertEqual(stock.remaining_stock(drop), 4)
+
+        # Покупка, которая так и не состоялась, возвращает единицу в остаток
+        with mock.patch("merch_store.views.inventory.add_item", side_effect=pg_error("40P01")):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(stock.remaining_stock(drop), 4)
+
+    @override_settings(INVENTORY_STORAGE=inventory.COMPACT)
+    def test_compact_inventory_is_read_from_user_shard(self):
+        cup = Merch.objects.using("default").create(name="shard-cup", price=10)
+        sharding.sync_catalog()
+        email = next(email for email in (f"holder{index}@example.com" for index in range(100))
+                     if sharding.shard_for_email(email) != "default")
+        user = self._auth(email)
+        url = reverse("merch_store:buy_item", kwargs={"item_name": cup.name})
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(reverse("merch_store:user_info")).data["inventory"],
+                         [{"type": "shard-cup", "quantity": 1}])
+        self.assertEqual(inventory.holders(cup, using=user._state.db), 1)
+        self.assertEqual(inventory.holders(cup), 0)
+
+    def test_limited_stock_is_shared_between_shards(self):
+        drop = Merch.objects.using("default").create(name="pink-drop", price=10)
+        sharding.sync_catalog()
+        stock.add_stock(drop, 1, buckets=1)
+        first, second = self._emails_on_different_shards()
+        self._auth(first)
+        url = reverse("merch_store:buy_item", kwargs={"item_name": drop.name})
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        self._auth(second)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_409_CONFLICT)
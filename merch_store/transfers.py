@@ -0,0 +1,216 @@
+"""
+Переводы монет между пользователями.
+
+Если отправитель и получатель на одном шарде (или шардирование выключено),
+перевод выполняется одной локальной транзакцией. Перевод между шардами
+выполняется как сага:
+
+  1. На шарде отправителя: списание, запись Transaction и журнала
+     ShardTransfer в состоянии DEBITED — одна локальная транзакция.
+  2. На шарде получателя: отметка ShardTransferCredit (уникальна для
+     перевода), зачисление и копия Transaction — одна локальная транзакция.
+     Повторное выполнение шага ничего не делает.
+  3. Журнал переводится в COMPLETED.
+
+Если процесс упал между шагами, команда resume_shard_transfers завершает
+зависшие переводы или возвращает монеты, если получателя на шарде нет.
+"""
+import logging
+
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.utils import timezone
+
+from merch_store import events, outbox, rollups, sharding
+from merch_store.retry import retry_atomic
+from merch_store.models import ShardTransfer, ShardTransferCredit, Transaction, User
+
+logger = logging.getLogger(__name__)
+
+
+class InsufficientFunds(Exception):
+    """У отправителя не хватает монет (проверено под блокировкой строки)."""
+
+
+def transfer(sender, recipient, amount):
+    """
+    Переводит amount монет. Возвращает (запись Transaction, отправитель, получатель)
+    с актуальными балансами. Бросает InsufficientFunds.
+    """
+    if sender._state.db == recipient._state.db:
+        return _local_transfer(sender, recipient, amount)
+    return _cross_shard_transfer(sender, recipient, amount)
+
+
+def _publish_transfer(record, sender, recipient):
+    outbox.publish(outbox.TRANSFER_TOPIC, {
+        "transaction_id": record.id,
+        "sender": sender.email,
+        "recipient": recipient.email,
+        "amount": record.amount,
+        "maked_at": record.maked_at.isoformat(),
+    })
+
+
+def _notify_transfer(user, record, alias, **counterpart):
+    """Дельта для открытых соединений участника перевода (см. events.py)."""
+    events.notify(user, 'transfer', using=alias, transaction={
+        "id": record.id,
+        **counterpart,
+        "amount": record.amount,
+        "maked_at": record.maked_at.isoformat(),
+    })
+
+
+def _shard_of(user, *args, **kwargs):
+    return user._state.db or DEFAULT_DB_ALIAS
+
+
+@retry_atomic(using=_shard_of)
+def _local_transfer(sender, recipient, amount):
+    alias = _shard_of(sender)
+    with sharding.use_shard(alias):
+        # Блокируем строки обоих пользователей в порядке id: баланс перечитывается
+        # под блокировкой, а встречные переводы не взаимоблокируются
+        locked = {
+            user.pk: user
+            for user in User.objects.using(alias).select_for_update().filter(
+                pk__in=[sender.pk, recipient.pk]
+            ).order_by('pk')
+        }
+        sender, recipient = locked[sender.pk], locked[recipient.pk]
+        if sender.coins < amount:
+            raise InsufficientFunds
+
+        sender.coins -= amount
+        recipient.coins += amount
+        sender.save(update_fields=['coins'])
+        recipient.save(update_fields=['coins'])
+
+        record = Transaction.objects.using(alias).create(sender=sender, recipient=recipient, amount=amount)
+        rollups.record_transfer(record)
+        _publish_transfer(record, sender, recipient)
+        _notify_transfer(sender, record, alias, toUser=recipient.email)
+        _notify_transfer(recipient, record, alias, fromUser=sender.email)
+    return record, sender, recipient
+
+
+def _cross_shard_transfer(sender, recipient, amount):
+    shard_transfer, record, sender = _debit(sender, recipient, amount)
+    try:
+        recipient = _credit(shard_transfer) or recipient
+    except Exception:
+        # Списание уже зафиксировано в журнале: перевод принят, зачисление
+        # завершит (или вернет монеты) команда resume_shard_transfers
+        logger.exception('Cross-shard transfer %s left in state %s', shard_transfer.pk, shard_transfer.state)
+    return record, sender, recipient
+
+
+@retry_atomic(using=_shard_of)
+def _debit(sender, recipient, amount):
+    """Шаг 1 саги: списание на шарде отправителя."""
+    alias = sender._state.db
+    with sharding.use_shard(alias):
+        sender = User.objects.using(alias).select_for_update().get(pk=sender.pk)
+        if sender.coins < amount:
+            raise InsufficientFunds
+        sender.coins -= amount
+        sender.save(update_fields=['coins'])
+
+        shadow = sharding.ensure_shadow(recipient, alias)
+        record = Transaction.objects.using(alias).create(sender=sender, recipient=shadow, amount=amount)
+        rollups.record_transfer(record, received=False)
+        _publish_transfer(record, sender, recipient)
+        _notify_transfer(sender, record, alias, toUser=recipient.email)
+        shard_transfer = ShardTransfer.objects.using(alias).create(
+            sender_id=sender.pk, recipient_id=recipient.pk, recipient_shard=recipient._state.db,
+            amount=amount, transaction_id=record.pk,
+        )
+    return shard_transfer, record, sender
+
+
+def _credit(shard_transfer):
+    """
+    Шаг 2 и 3 саги: зачисление на шарде получателя.
+
+    Возвращает получателя с актуальным балансом, None, если зачисление уже
+    было выполнено раньше, или бросает User.DoesNotExist, если получателя нет.
+    """
+    recipient = _apply_credit(shard_transfer)
+    ShardTransfer.objects.using(shard_transfer._state.db).filter(
+        pk=shard_transfer.pk, state=ShardTransfer.DEBITED
+    ).update(state=ShardTransfer.COMPLETED, updated_at=timezone.now())
+    shard_transfer.state = ShardTransfer.COMPLETED
+    return recipient
+
+
+@retry_atomic(using=lambda shard_transfer: shard_transfer.recipient_shard)
+def _apply_credit(shard_transfer):
+    alias = shard_transfer.recipient_shard
+    with sharding.use_shard(alias):
+        recipient = (User.objects.using(alias).select_for_update()
+                     .get(pk=shard_transfer.recipient_id, is_shadow=False))
+        try:
+            with transaction.atomic(using=alias):
+                ShardTransferCredit.objects.using(alias).create(transfer_id=shard_transfer.pk)
+        except IntegrityError:
+            return None
+        recipient.coins += shard_transfer.amount
+        recipient.save(update_fields=['coins'])
+        sender = User.objects.using(shard_transfer._state.db).get(pk=shard_transfer.sender_id)
+        shadow = sharding.ensure_shadow(sender, alias)
+        record = Transaction.objects.using(alias).create(
+            sender=shadow, recipient=recipient, amount=shard_transfer.amount
+        )
+        rollups.record_transfer(record, sent=False)
+        _notify_transfer(recipient, record, alias, fromUser=sender.email)
+    return recipient
+
+
+@retry_atomic(using=lambda shard_transfer: shard_transfer._state.db)
+def _refund(shard_transfer):
+    """Возвращает монеты отправителю, если зачислить их некому."""
+    alias = shard_transfer._state.db
+    with sharding.use_shard(alias):
+        locked = (ShardTransfer.objects.using(alias).select_for_update()
+                  .filter(pk=shard_transfer.pk, state=ShardTransfer.DEBITED).first())
+        if locked is None:
+            return False
+        sender = User.objects.using(alias).select_for_update().get(pk=locked.sender_id)
+        sender.coins += locked.amount
+        sender.save(update_fields=['coins'])
+        record = Transaction.objects.using(alias).filter(pk=locked.transaction_id).first()
+        if record is not None:
+            rollups.record_transfer(record, received=False, sign=-1)
+            record.delete()
+        locked.state = ShardTransfer.REFUNDED
+        locked.save(update_fields=['state', 'updated_at'])
+        events.notify(sender, 'refund', using=alias, transaction={"id": locked.transaction_id, "amount": locked.amount})
+    return True
+
+
+def resume_pending(older_than, using):
+    """
+    Завершает переводы шарда using, зависшие в состоянии DEBITED дольше older_than.
+
+    Возвращает словарь {'completed': ..., 'refunded': ..., 'failed': ...}.
+    """
+    stats = {'completed': 0, 'refunded': 0, 'failed': 0}
+    pending = (ShardTransfer.objects.using(using)
+               .filter(state=ShardTransfer.DEBITED, created_at__lt=older_than)
+               .order_by('created_at'))
+    for shard_transfer in pending.iterator():
+        try:
+            _credit(shard_transfer)
+            stats['completed'] += 1
+        except User.DoesNotExist:
+            credited = ShardTransferCredit.objects.using(shard_transfer.recipient_shard).filter(
+                transfer_id=shard_transfer.pk
+            ).exists()
+            if not credited and _refund(shard_transfer):
+                stats['refunded'] += 1
+            else:
+                stats['failed'] += 1
+        except Exception:
+            logger.exception('Failed to resume cross-shard transfer %s', shard_transfer.pk)
+            stats['failed'] += 1
+    return stats
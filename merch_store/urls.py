@@ -4,7 +4,11 @@ from rest_framework_simplejwt.views import (
 )
 
 from merch_store.apps import MerchStoreConfig
-from merch_store.views import AuthAPIView, InfoAPIView, SendCoinAPIView, BuyItemAPIView
+from merch_store.streaming import event_stream_view
+from merch_store.views import AuthAPIView, InfoAPIView, SendCoinAPIView, BuyItemAPIView, \
+    TransactionExportAPIView, TopReceiversAPIView, TopSpendersAPIView, TopMerchAPIView, CoinGrantAPIView, \
+    CoinGrantDetailAPIView, RetryStatsAPIView, UserImportAPIView, UserImportDetailAPIView, LogoutAPIView, \
+    TokenRevokeAPIView, EventTicketAPIView
 
 app_name = MerchStoreConfig.name
 
@@ -12,6 +16,19 @@ urlpatterns = [
     path('info', InfoAPIView.as_view(), name='user_info'),
     path('auth', AuthAPIView.as_view(), name='auth'),
     path('auth/refresh', TokenRefreshView.as_view(), name='refresh'),
+    path('auth/logout', LogoutAPIView.as_view(), name='logout'),
+    path('auth/revoke', TokenRevokeAPIView.as_view(), name='revoke'),
     path('sendCoin', SendCoinAPIView.as_view(), name='send_coin'),
     path('buy/<str:item_name>', BuyItemAPIView.as_view(), name='buy_item'),
+    path('stats/top-receivers', TopReceiversAPIView.as_view(), name='top_receivers'),
+    path('stats/top-spenders', TopSpendersAPIView.as_view(), name='top_spenders'),
+    path('stats/top-merch', TopMerchAPIView.as_view(), name='top_merch'),
+    path('stats/retries', RetryStatsAPIView.as_view(), name='retry_stats'),
+    path('events', event_stream_view, name='events'),
+    path('events/ticket', EventTicketAPIView.as_view(), name='event_ticket'),
+    path('transactions/export', TransactionExportAPIView.as_view(), name='transaction_export'),
+    path('grants', CoinGrantAPIView.as_view(), name='coin_grants'),
+    path('grants/<uuid:grant_id>', CoinGrantDetailAPIView.as_view(), name='coin_grant_detail'),
+    path('users/import', UserImportAPIView.as_view(), name='user_import'),
+    path('users/import/<uuid:job_id>', UserImportDetailAPIView.as_view(), name='user_import_detail'),
 ]
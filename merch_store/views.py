@@ -1,12 +1,40 @@
-from django.db import transaction
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.http import StreamingHttpResponse
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken, UntypedToken
 
 # Импорт моделей и сериализаторов (используем организации-специфичные импорты)
-from merch_store.models import User, Transaction, Inventory, Merch
+from merch_store import events, grants, inventory, outbox, provisioning, retry, revocation, rollups, sharding, stock, \
+    streaming
+from merch_store.models import CoinGrant, ProvisioningJob, User, Merch
+from merch_store.exports import ExportError, aiter_chunks, export_rows, iter_export, parse_period
+from merch_store.retry import RetriesExhausted, retry_atomic
+from merch_store.routers import choose_read_alias, current_read_alias, pin_to_primary, read_replica
 from merch_store.serializers import CreateUserSerializer
+from merch_store.transfers import InsufficientFunds, transfer
+
+
+def user_shard(request):
+    return request.user._state.db or DEFAULT_DB_ALIAS
+
+
+def busy_response():
+    """Ответ, когда транзакция не прошла из-за конфликтов блокировок даже после повторов."""
+    return Response(
+        {"errors": "Сервис перегружен, повторите запрос позже."},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "1"},
+    )
 
 
 class AuthAPIView(APIView):
@@ -33,21 +61,119 @@ class AuthAPIView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         try:
-            user = User.objects.get(email=email)
+            user = sharding.get_user(email)
             if not user.check_password(password):
                 return Response(
                     {"errors": "Неверный пароль."},
                     status=status.HTTP_400_BAD_REQUEST
                 )
         except User.DoesNotExist:
-            serializer = CreateUserSerializer(data={'email': email, 'password': password})
-            serializer.is_valid(raise_exception=True)
-            user = serializer.save()
+            # Новый пользователь создается на шарде, выбранном по email
+            with sharding.use_shard(sharding.shard_for_email(email)):
+                serializer = CreateUserSerializer(data={'email': email, 'password': password})
+                serializer.is_valid(raise_exception=True)
+                user = serializer.save()
 
         token = CreateUserSerializer().get_token(user)
         return Response({'token': token}, status=status.HTTP_200_OK)
 
 
+class LogoutAPIView(APIView):
+    """
+    Выход: отзыв токенов текущего пользователя.
+
+    URL: /api/auth/logout
+    Метод: POST
+
+    Ожидаемые данные в теле запроса (application/json, все поля необязательны):
+      - refresh: строка (refresh-токен этой сессии, отзывается вместе с access-токеном)
+      - all: true — отозвать все выданные пользователю токены (выход на всех устройствах)
+
+    Ответ 200: токены отозваны.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        if request.data.get('all') is True:
+            revocation.revoke_user(request.user.pk)
+            # Отзыв пользователя не затрагивает токены, выданные в ту же секунду: текущий отзывается явно
+            if request.auth is not None:
+                revocation.revoke(request.auth)
+            return Response({"info": "Все токены пользователя отозваны."}, status=status.HTTP_200_OK)
+
+        refresh = None
+        if request.data.get('refresh'):
+            try:
+                refresh = RefreshToken(request.data['refresh'])
+            except TokenError:
+                return Response({"errors": "Некорректный refresh-токен."}, status=status.HTTP_400_BAD_REQUEST)
+            if refresh.get(api_settings.USER_ID_CLAIM) != request.user.pk:
+                return Response({"errors": "Refresh-токен выдан другому пользователю."},
+                                status=status.HTTP_400_BAD_REQUEST)
+            revocation.revoke(refresh)
+        if request.auth is not None:
+            revocation.revoke(request.auth)
+        return Response({"info": "Выход выполнен."}, status=status.HTTP_200_OK)
+
+
+class TokenRevokeAPIView(APIView):
+    """
+    Отзыв токенов сотрудником (например, при компрометации учетной записи).
+
+    URL: /api/auth/revoke
+    Метод: POST
+
+    Ожидаемые данные в теле запроса (application/json), одно из полей:
+      - token: строка (access- или refresh-токен, отзывается только он)
+      - user: строка (email пользователя, отзываются все выданные ему токены)
+
+    Ответ 200: токены отозваны.
+    """
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        if request.data.get('token'):
+            try:
+                token = UntypedToken(request.data['token'])
+            except TokenError:
+                return Response({"errors": "Некорректный или истекший токен."}, status=status.HTTP_400_BAD_REQUEST)
+            revocation.revoke(token)
+            return Response({"info": "Токен отозван."}, status=status.HTTP_200_OK)
+
+        if request.data.get('user'):
+            try:
+                user = sharding.get_user(request.data['user'])
+            except User.DoesNotExist:
+                return Response({"errors": "Пользователь не найден."}, status=status.HTTP_404_NOT_FOUND)
+            revocation.revoke_user(user.pk)
+            return Response({"info": "Все токены пользователя отозваны."}, status=status.HTTP_200_OK)
+
+        return Response({"errors": "Нужно указать 'token' или 'user'."}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class EventTicketAPIView(APIView):
+    """
+    Билет для подключения к потоку событий из браузера.
+
+    URL: /api/events/ticket
+    Метод: POST
+
+    Браузерные EventSource и WebSocket не передают заголовок Authorization,
+    а access-токен в URL попадает в логи. Вместо него в параметре ticket
+    передается этот билет: одноразовый, короткоживущий и пригодный только
+    для /api/events и /api/events/ws.
+
+    Ответ 200: { "ticket": "...", "expires_in": секунды }
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        return Response({
+            "ticket": streaming.issue_ticket(request.user),
+            "expires_in": settings.EVENTS_TICKET_SECONDS,
+        }, status=status.HTTP_200_OK)
+
+
 class SendCoinAPIView(APIView):
     """
     Эндпойнт для передачи монет от одного пользователя другому.
@@ -60,10 +186,10 @@ class SendCoinAPIView(APIView):
       - amount: число (количество монет)
 
     Ответ 200: Успешный ответ, содержащий данные транзакции.
+    Ответ 503: транзакция не прошла из-за конфликтов блокировок (см. Retry-After).
     """
     permission_classes = [IsAuthenticated]
 
-    @transaction.atomic
     def post(self, request):
         sender = request.user
         recipient_email = request.data.get('toUser')
@@ -93,21 +219,25 @@ class SendCoinAPIView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         try:
-            recipient = User.objects.get(email=recipient_email)
+            recipient = sharding.get_user(recipient_email)
         except User.DoesNotExist:
             return Response(
                 {"errors": "Пользователь с указанным email не найден."},
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        # Выполнение транзакции: обновляем балансы пользователей
-        sender.coins -= amount
-        recipient.coins += amount
-        sender.save()
-        recipient.save()
-
-        transaction_record = Transaction.objects.create(sender=sender,
-                                                        recipient=recipient, amount=amount)
+        # Баланс перечитывается под блокировкой; перевод на другой шард
+        # выполняется сагой (см. merch_store/transfers.py)
+        try:
+            transaction_record, sender, recipient = transfer(sender, recipient, amount)
+        except InsufficientFunds:
+            return Response(
+                {"errors": "Недостаточно монет для выполнения транзакции."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except RetriesExhausted:
+            return busy_response()
+        pin_to_primary(sender)
         response_data = {
             "Отправитель": sender.email,
             "Получатель": recipient.email,
@@ -159,13 +289,20 @@ class InfoAPIView(APIView):
         user = request.user
         coins = user.coins
 
+        # История читается с реплики, если пользователь недавно ничего не менял
+        with read_replica(user):
+            # Баланс читается из той же БД, что и история: иначе получатель мог бы
+            # увидеть новый баланс без перевода, который его изменил
+            alias = current_read_alias()
+            if alias != DEFAULT_DB_ALIAS and not sharding.is_sharded():
+                coins = User.objects.using(alias).values_list('coins', flat=True).get(pk=user.pk)
+            data = self._build_info(user, coins)
+        return Response(data)
+
+    def _build_info(self, user, coins):
+        """Собирает инвентарь и историю транзакций пользователя"""
         # Формирование инвентаря: используем название мерча как "type"
-        inventory_items = []
-        for item in user.inventory.all():
-            inventory_items.append({
-                "type": item.merch.name,
-                "quantity": item.quantity
-            })
+        inventory_items = inventory.items_of(user)
 
         # Формирование истории транзакций отдельно для отправленных и полученных монет
         sent_transactions = user.sent_transactions.all()
@@ -193,7 +330,7 @@ class InfoAPIView(APIView):
                 "sent": sent_history
             }
         }
-        return Response(data)
+        return data
 
 
 class BuyItemAPIView(APIView):
@@ -206,8 +343,10 @@ class BuyItemAPIView(APIView):
     Логика:
       1. Поиск товара (Merch) по его имени, передаваемому в путевом параметре.
       2. Проверка, хватает ли у пользователя монет для покупки.
-      3. Списание монет с баланса пользователя.
-      4. Добавление или обновление записи в инвентаре пользователя.
+      3. Для товаров ограниченного тиража — списание единицы из остатка
+         (ответ 409, если товар закончился).
+      4. Списание монет с баланса пользователя.
+      5. Добавление или обновление записи в инвентаре пользователя.
 
     Ответ 200 (application/json):
     {
@@ -217,13 +356,28 @@ class BuyItemAPIView(APIView):
             "Цена за товар": <integer>
         }
     }
+    Ответ 503: транзакция не прошла из-за конфликтов блокировок (см. Retry-After).
     """
     permission_classes = [IsAuthenticated]
 
-    @transaction.atomic
     def get(self, request, item_name):
-        user = request.user
-
+        # Единица товара, списанная в основной БД отдельно от транзакции покупки на шарде
+        self._reserved = None
+        # Покупка целиком выполняется на шарде пользователя
+        with sharding.use_shard(user_shard(request)):
+            try:
+                response = self._buy(request, item_name)
+            except RetriesExhausted:
+                response = busy_response()
+            except BaseException:
+                self._release()
+                raise
+        if response.status_code != status.HTTP_200_OK:
+            self._release()
+        return response
+
+    @retry_atomic(using=lambda self, request, *args, **kwargs: user_shard(request))
+    def _buy(self, request, item_name):
         try:
             merch_item = Merch.objects.get(name=item_name)
         except Merch.DoesNotExist:
@@ -232,21 +386,40 @@ class BuyItemAPIView(APIView):
                 status=status.HTTP_404_NOT_FOUND
             )
 
+        # Баланс перечитывается под блокировкой строки: покупки одного
+        # пользователя выполняются строго по очереди
+        user = User.objects.select_for_update().get(pk=request.user.pk)
+
         if user.coins < merch_item.price:
             return Response(
                 {"errors": "Недостаточно монет для покупки данного товара."},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        user.coins -= merch_item.price
-        user.save()
+        # Остатки хранятся в основной БД. Если это БД покупки, списание
+        # откатывается вместе с попыткой; иначе см. _reserve()
+        if merch_item.is_limited and not self._reserve(merch_item, user_shard(request)):
+            return Response(
+                {"errors": "Товар закончился."},
+                status=status.HTTP_409_CONFLICT
+            )
 
-        inventory_item, created = Inventory.objects.get_or_create(
-            user=user, merch=merch_item, defaults={'quantity': 1}
-        )
-        if not created:
-            inventory_item.quantity += 1
-            inventory_item.save()
+        user.coins -= merch_item.price
+        user.save(update_fields=['coins'])
+
+        quantity = inventory.add_item(user, merch_item, using=user_shard(request))
+        rollups.record_purchase(user, merch_item)
+        outbox.publish(outbox.PURCHASE_TOPIC, {
+            "user": user.email,
+            "merch": merch_item.name,
+            "price": merch_item.price,
+            "quantity": quantity,
+        })
+        events.notify(user, 'purchase', using=user_shard(request), inventory={
+            "type": merch_item.name,
+            "quantity": quantity,
+        })
+        pin_to_primary(user)
 
         response_data = {
             "info": "Покупка успешно совершена. Ваш инвентарь пополнился новыми вещами.",
@@ -256,3 +429,278 @@ class BuyItemAPIView(APIView):
             }
         }
         return Response(response_data, status=status.HTTP_200_OK)
+
+    def _reserve(self, merch_item, using):
+        """
+        Списывает единицу товара для покупки на шарде using.
+
+        Если шард — не основная БД, списание фиксируется сразу, один раз на запрос:
+        повторные попытки покупки используют его же, а get() возвращает единицу
+        в остаток, если покупка так и не состоялась.
+        """
+        if using == DEFAULT_DB_ALIAS:
+            return stock.reserve_unit(merch_item)
+        if self._reserved is None:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                if not stock.reserve_unit(merch_item):
+                    return False
+            self._reserved = merch_item
+        return True
+
+    def _release(self):
+        if self._reserved is not None:
+            stock.release_unit(self._reserved)
+            self._reserved = None
+
+
+class LeaderboardAPIView(ABC, APIView):
+    """
+    Абстрактный эндпойнт рейтинга: отдает топ-N из предрасчитанных агрегатов.
+    Подклассы реализуют get_leaderboard().
+
+    Параметры запроса:
+      - limit: размер рейтинга (по умолчанию 10, максимум 100)
+    """
+    permission_classes = [IsAuthenticated]
+    default_limit = 10
+    max_limit = 100
+
+    def get(self, request):
+        try:
+            params = self.parse_params(request)
+        except ValueError as error:
+            return Response({"errors": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        with read_replica(request.user):
+            data = self.get_leaderboard(**params)
+        return Response(data)
+
+    def parse_params(self, request):
+        error = f"Параметр 'limit' должен быть целым числом от 1 до {self.max_limit}."
+        try:
+            limit = int(request.query_params.get('limit', self.default_limit))
+        except ValueError:
+            raise ValueError(error)
+        if not 0 < limit <= self.max_limit:
+            raise ValueError(error)
+        return {'limit': limit}
+
+    @abstractmethod
+    def get_leaderboard(self, limit):
+        """Данные рейтинга для параметров из parse_params()."""
+
+
+class TopReceiversAPIView(LeaderboardAPIView):
+    """
+    Пользователи, получившие больше всего монет за месяц.
+
+    URL: /api/stats/top-receivers
+    Метод: GET
+
+    Параметры запроса:
+      - month: месяц в формате YYYY-MM (по умолчанию текущий)
+    """
+
+    def parse_params(self, request):
+        params = super().parse_params(request)
+        month = request.query_params.get('month')
+        try:
+            params['month'] = (datetime.strptime(month, '%Y-%m').date() if month
+                               else rollups.month_of())
+        except ValueError:
+            raise ValueError("Параметр 'month' должен быть в формате YYYY-MM.")
+        return params
+
+    def get_leaderboard(self, limit, month):
+        return {"month": f"{month:%Y-%m}", "results": rollups.top_receivers(month, limit)}
+
+
+class TopSpendersAPIView(LeaderboardAPIView):
+    """
+    Пользователи, потратившие больше всего монет на мерч.
+
+    URL: /api/stats/top-spenders
+    Метод: GET
+    """
+
+    def get_leaderboard(self, limit):
+        return {"results": rollups.top_spenders(limit)}
+
+
+class TopMerchAPIView(LeaderboardAPIView):
+    """
+    Самые продаваемые товары.
+
+    URL: /api/stats/top-merch
+    Метод: GET
+    """
+
+    def get_leaderboard(self, limit):
+        return {"results": rollups.top_merch(limit)}
+
+
+class TransactionExportAPIView(APIView):
+    """
+    Потоковая выгрузка всей истории транзакций (только для сотрудников).
+
+    URL: /api/transactions/export
+    Метод: GET
+
+    Параметры запроса:
+      - output: "ndjson" (по умолчанию) или "csv"
+      - since, until: границы периода (YYYY-MM-DD или ISO 8601)
+      - user: email пользователя (отправителя или получателя)
+
+    Строки читаются серверным курсором порциями, поэтому потребление
+    памяти не зависит от размера таблицы (под ASGI ответ отдается
+    асинхронным итератором, см. exports.aiter_chunks).
+    При шардировании выгружаются все шарды; перевод между шардами
+    выгружается одной строкой.
+    """
+    permission_classes = [IsAdminUser]
+    content_types = {
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv',
+    }
+
+    def get(self, request):
+        export_format = request.query_params.get('output', 'ndjson')
+        try:
+            since, until = parse_period(request.query_params.get('since'),
+                                        request.query_params.get('until'))
+            rows = export_rows(
+                since=since,
+                until=until,
+                user_email=request.query_params.get('user'),
+                using=choose_read_alias(request.user),
+            )
+            stream = iter_export(export_format, rows)
+        except ExportError as error:
+            return Response({"errors": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        if isinstance(request._request, ASGIRequest):
+            stream = aiter_chunks(stream)
+
+        response = StreamingHttpResponse(stream, content_type=self.content_types[export_format])
+        response['Content-Disposition'] = f'attachment; filename="transactions.{export_format}"'
+        return response
+
+
+class CoinGrantAPIView(APIView):
+    """
+    Массовое начисление монет (только для сотрудников).
+
+    URL: /api/grants
+    Метод: POST
+
+    Ожидаемые данные в теле запроса (application/json):
+      - amount: число (монет каждому пользователю)
+      - reason: строка (основание, например "Премия за 3 квартал")
+      - filters: необязательный объект с полями email_domain, emails,
+        joined_after, joined_before
+
+    Начисление выполняется в фоне пачками; ответ 202 содержит id начисления,
+    по которому можно следить за прогрессом.
+    """
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        filters = request.data.get('filters') or {}
+        if not isinstance(filters, dict):
+            return Response({"errors": "Поле 'filters' должно быть объектом."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            grant = grants.create_grant(request.data.get('amount'), request.data.get('reason'),
+                                        filters=filters, created_by=request.user.email)
+        except grants.GrantError as error:
+            return Response({"errors": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        grants.launch(grant)
+        return Response(grants.summary(grant), status=status.HTTP_202_ACCEPTED)
+
+
+class CoinGrantDetailAPIView(APIView):
+    """
+    Прогресс массового начисления.
+
+    URL: /api/grants/{id}
+    Метод: GET
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, grant_id):
+        try:
+            grant = CoinGrant.objects.using(DEFAULT_DB_ALIAS).get(pk=grant_id)
+        except CoinGrant.DoesNotExist:
+            return Response({"errors": "Начисление не найдено."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(grants.summary(grant))
+
+
+class RetryStatsAPIView(APIView):
+    """
+    Счетчики повторов транзакций текущего процесса (только для сотрудников).
+
+    URL: /api/stats/retries
+    Метод: GET
+
+    Ответ 200: {"deadlocks": ..., "serialization_failures": ..., "lock_timeouts": ...,
+                "retries": ..., "gave_up": ...}
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(retry.counters())
+
+
+class UserImportAPIView(APIView):
+    """
+    Импорт сотрудников из CSV или JSON (только для сотрудников).
+
+    URL: /api/users/import
+    Метод: POST
+
+    Данные: файл .csv или .json в поле "file" (multipart/form-data)
+    или JSON-список объектов {"email", "password", "first_name"} в теле запроса.
+
+    Импорт выполняется в фоне, пароли хешируются в пуле процессов;
+    ответ 202 содержит id импорта для отслеживания прогресса.
+    """
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        try:
+            rows = self.read_rows(request)
+        except provisioning.ProvisioningError as error:
+            return Response({"errors": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        job = provisioning.create_job(rows, created_by=request.user.email)
+        provisioning.launch(job, rows)
+        return Response(provisioning.summary(job), status=status.HTTP_202_ACCEPTED)
+
+    @staticmethod
+    def read_rows(request):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return provisioning.validate_rows(request.data)
+        file_format = request.data.get('format') or provisioning.format_of(upload.name)
+        try:
+            content = upload.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise provisioning.ProvisioningError('Файл должен быть в кодировке UTF-8.')
+        return provisioning.parse(content, file_format)
+
+
+class UserImportDetailAPIView(APIView):
+    """
+    Прогресс импорта сотрудников.
+
+    URL: /api/users/import/{id}
+    Метод: GET
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, job_id):
+        try:
+            job = ProvisioningJob.objects.using(DEFAULT_DB_ALIAS).get(pk=job_id)
+        except ProvisioningJob.DoesNotExist:
+            return Response({"errors": "Импорт не найден."}, status=status.HTTP_404_NOT_FOUND)
+        # Импорт, брошенный завершившимся процессом, показывается прерванным, а не выполняющимся
+        if provisioning.fail_stale(job):
+            job.refresh_from_db(using=DEFAULT_DB_ALIAS)
+        return Response(provisioning.summary(job))